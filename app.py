@@ -2,22 +2,93 @@ from datetime import datetime
 import json
 import os
 
+from responses import MAX_BATCH_SIZE
+from responses import STREAM_CHUNK_SIZE
+from responses import answered_response
+from responses import failure_response
+from responses import page_limit
+from responses import page_response
+from responses import parse_request_ids
+from responses import parse_transfers
+from responses import stream_response
+from responses import success_response
+
+import async_server
+import bulk
 import db
+import feed
+import history
+import ledger
+import metrics
+import querylog
+import replica
+import rollups
 
 from flask import Flask
+from flask import Response
 from flask import request
 
 
-DB = db.DatabaseDriver()
+# GROUP_COMMIT=1 funnels payments through one writer thread that commits them in batches.
+# ASYNC_SERVER=1 serves the routes from an asyncio event loop (async_server.py) and always
+# uses that writer, so payments, accepts and user deletes are applied by a single owner.
+# LEDGER=1 keeps balances in the append-only ledger (ledger.py) instead of user.BALANCE
+ASYNC_SERVER = os.environ.get("ASYNC_SERVER") == "1"
+DB = db.DatabaseDriver(
+    # a connection for every server thread, none of them ever waits for one
+    pool_size=max(16, async_server.READ_WORKERS + async_server.WRITE_WORKERS) if ASYNC_SERVER else 16,
+    group_commit=os.environ.get("GROUP_COMMIT") == "1" or ASYNC_SERVER,
+    traced=metrics.ENABLED or querylog.ENABLED,
+    use_ledger=ledger.ENABLED,
+    use_feed=feed.ENABLED,
+    use_rollups=rollups.ENABLED,
+    use_replica=replica.ENABLED,
+)
 app = Flask(__name__)
 
-
-# generalized response formats
-def success_response(data, code=200):
-    return json.dumps({"success": True, "data": data}), code
-
-def failure_response(message, code=404):
-    return json.dumps({"success": False, "error": message}), code
+# METRICS=1 times requests and SQLite statements and serves them at /metrics
+if metrics.ENABLED:
+    metrics.install(app)
+    DB.add_query_listener(metrics.observe_query)
+    if DB.user_cache is not None:
+        metrics.add_stats("kessef_user_cache", DB.user_cache.stats)
+    if DB.writer is not None:
+        metrics.add_stats("kessef_group_commit", DB.writer.stats)
+        # statements the writer runs for a request count towards that request
+        DB.writer.capture = metrics.capture_request
+
+# SLOW_QUERY_MS=N logs statements slower than N ms with their query plan
+if querylog.ENABLED:
+    DB.add_query_listener(querylog.profiler_for(DB.filename))
+
+# SQL_JSON=1 has SQLite render list and detail payloads (db.json_object_sql), byte for byte
+# the JSON the dict path writes
+SQL_JSON = os.environ.get("SQL_JSON") == "1"
+
+
+# ?stream=true streams everything after ?after=, ?limit= returns a single page,
+# without either the whole table is returned in one piece as before
+def list_response(get_all, get_page, iter_rows):
+    after = request.args.get("after", 0, type=int)
+    if request.args.get("stream") in ("1", "true", "True"):
+        return stream_response(iter_rows(after, STREAM_CHUNK_SIZE))
+    if "limit" in request.args or "after" in request.args:
+        limit = page_limit(request.args)
+        return page_response(get_page(limit, after), limit)
+    return success_response(get_all())
+
+
+# each request thread borrows a pooled connection, streamed responses keep it until the last chunk
+@app.teardown_appcontext
+def release_connection(exception):
+    DB.release()
+
+# READ_REPLICA=1 serves the read routes from a snapshot of the database (replica.py) while it
+# is within the staleness bound, unless the request asks to read its own writes
+if DB.replica is not None:
+    @app.before_request
+    def route_reads():
+        DB.replica.use(replica.wants_replica(request))
 
 
 @app.route("/")
@@ -25,12 +96,16 @@ def failure_response(message, code=404):
 #get all users
 @app.route("/api/users/")
 def get_users():
-    return success_response(DB.get_all_users())   
+    if SQL_JSON:
+        return list_response(DB.get_all_users_json, DB.get_users_page_json, DB.iter_users)
+    return list_response(DB.get_all_users, DB.get_users_page, DB.iter_users)
 
 #get the transactions of every user (only for testing)
 @app.route("/api/users/transactions/")
 def get_transactions():
-    return success_response(DB.get_all_transactions())   
+    if SQL_JSON:
+        return list_response(DB.get_all_transactions_json, DB.get_transactions_page_json, DB.iter_transactions)
+    return list_response(DB.get_all_transactions, DB.get_transactions_page, DB.iter_transactions)
 
 
 #delete entire user database (only for testing)
@@ -44,6 +119,17 @@ def delete_all_transactions():
     return success_response(DB.delete_transactions_table())
 
 
+# every user or transaction row as ?format=csv (the default) or jsonl, streamed a chunk at a
+# time; passwords and session tokens are left out, python bulk.py export writes full dumps
+@app.route("/api/export/<table>/")
+def export_table(table):
+    fmt = request.args.get("format", "csv")
+    if table not in bulk.TABLES or fmt not in bulk.FORMATS:
+        return failure_response("Unknown table or format")
+    columns = bulk.public_columns(DB.filename, table)
+    return Response(DB.export_lines(table, fmt, columns), mimetype=bulk.MIMETYPES[fmt])
+
+
 @app.route("/api/users/", methods=["POST"])
 def create_user():
     body = json.loads(request.data)
@@ -62,9 +148,20 @@ def create_user():
     
 
 
+# ?fields=id,balance returns only those fields, ?include=transactions adds the sent transactions,
+# without either the full user with transactions is returned as before
 @app.route("/api/user/<int:user_id>/")
 def get_user(user_id):
-    user = DB.get_user_by_id(user_id)
+    fields = request.args.get("fields")
+    include = request.args.get("include")
+    if fields is None and include is None:
+        user = DB.get_user_json(user_id) if SQL_JSON else DB.get_user_by_id(user_id)
+    else:
+        fields = fields.split(",") if fields else None
+        if fields is not None and any(f not in db.USER_FIELDS for f in fields):
+            return failure_response("Unknown field, expected some of " + ",".join(db.USER_FIELDS))
+        include_transactions = "transactions" in (include or "").split(",")
+        user = DB.get_user(user_id, fields, include_transactions)
     if user is None:
         return failure_response("User not found")
     return success_response(user)
@@ -74,12 +171,106 @@ def get_user(user_id):
 #get all transactions of user (only for testing)
 @app.route("/api/users/<int:user_id>/transactions/")
 def get_transactions_of_user(user_id):
-    user = DB.get_user_by_id(user_id)
+    user = DB.get_user(user_id, ["id"])
     if user is None:
         return failure_response("User not found")   
+    if SQL_JSON:
+        return success_response(DB.get_transactions_of_user_json(user_id))
     return success_response(DB.get_transactions_of_user(user_id))
 
 
+# sent and received transactions, newest first, ?limit=N&before=ID pages (pass "next" as before),
+# filtered by ?direction=sent|received, ?accepted=true|false, ?counterparty=ID, ?min_amount=, ?max_amount=
+@app.route("/api/user/<int:user_id>/history/")
+def get_history(user_id):
+    try:
+        filters = history.parse_filters(request.args)
+    except ValueError as e:
+        return failure_response(str(e))
+    if DB.get_user(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    limit = page_limit(request.args)
+    before = request.args.get("before", type=int)
+    return page_response(DB.get_history(user_id, limit, before, **filters), limit)
+
+
+# sent, received and pending totals per day or month from the rollups (ROLLUPS=1),
+# ?from=YYYY-MM-DD&to=YYYY-MM-DD (this month so far by default)&period=day|month
+@app.route("/api/user/<int:user_id>/statement/")
+def get_statement(user_id):
+    if DB.rollups is None:
+        return failure_response("Rollups are not enabled")
+    try:
+        start, end, period = rollups.parse_range(request.args)
+    except ValueError as e:
+        return failure_response(str(e))
+    if DB.get_user(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    return success_response(DB.get_statement(user_id, start, end, period))
+
+
+# payment requests waiting for the user to pay them, newest first, paged like the history
+@app.route("/api/user/<int:user_id>/requests/")
+def get_pending_requests(user_id):
+    if DB.get_user(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    limit = page_limit(request.args)
+    before = request.args.get("before", type=int)
+    return page_response(DB.get_pending_requests(user_id, limit, before), limit)
+
+
+# body: {"password": ..., "accept": [ids], "deny": [ids]}, answered in one transaction;
+# ids that are not pending requests to the user come back as skipped
+@app.route("/api/user/<int:user_id>/requests/", methods=["POST"])
+def answer_pending_requests(user_id):
+    body = json.loads(request.data)
+    password = body.get("password")
+    parsed = parse_request_ids(body)
+    if not isinstance(parsed, tuple):
+        return failure_response(parsed)
+    accept_ids, deny_ids = parsed
+
+    user = DB.get_user(user_id, ["password"])
+    if user is None:
+        return failure_response("User not found")
+    if user["password"] != password:
+        return failure_response("Incorrect password")
+    return answered_response(accept_ids, deny_ids, DB.answer_requests(user_id, accept_ids, deny_ids))
+
+
+# transactions of the user and of the users they follow, newest first, paged like the history
+@app.route("/api/user/<int:user_id>/feed/")
+def get_feed(user_id):
+    if DB.feed is None:
+        return failure_response("Feeds are not enabled")
+    if DB.get_user(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    limit = page_limit(request.args)
+    before = request.args.get("before", type=int)
+    return page_response(DB.get_feed(user_id, limit, before), limit)
+
+
+# body: {"user_id": <id to follow>}, payments they make or receive from now on show up in the feed
+@app.route("/api/user/<int:user_id>/follow/", methods=["POST"])
+def follow_user(user_id):
+    if DB.feed is None:
+        return failure_response("Feeds are not enabled")
+    body = json.loads(request.data)
+    followed_id = int(body.get("user_id"))
+    if DB.get_user(user_id, ["id"]) is None or DB.get_user(followed_id, ["id"]) is None:
+        return failure_response("User not found")
+    DB.follow(user_id, followed_id)
+    return success_response({"follower_id": user_id, "followed_id": followed_id}, 201)
+
+
+@app.route("/api/user/<int:user_id>/follow/<int:followed_id>/", methods=["DELETE"])
+def unfollow_user(user_id, followed_id):
+    if DB.feed is None:
+        return failure_response("Feeds are not enabled")
+    DB.unfollow(user_id, followed_id)
+    return success_response({"follower_id": user_id, "followed_id": followed_id})
+
+
 @app.route("/api/user/<int:user_id>/", methods=["DELETE"])
 def delete_user(user_id):
     user = DB.get_user_by_id(user_id)
@@ -105,19 +296,19 @@ def send_money():
     message = body.get("message")
     password = body.get("password")
 
-    sender = DB.get_user_by_id(sender_id)
+    sender = DB.get_user(sender_id, ["password"])
     if sender is None:
         return failure_response("Not an acceptable sender id")
     real_password = sender["password"]
     if real_password != password:
         return failure_response("Incorrect password")
-    receiver = DB.get_user_by_id(receiver_id)
+    receiver = DB.get_user(receiver_id, ["id"])
     if receiver is None:
         return failure_response("Not an acceptable receiver id")
     if amount < 0:
         return failure_response("Not a valid amount") 
     
-    transaction_id = DB.send_money_by_user_id(sender_id, receiver_id, amount)
+    transaction_id = DB.send_money_by_user_id(sender_id, receiver_id, amount, message)
     if transaction_id == False:
         return failure_response("Insufficient funds to complete transaction")
     transactions = DB.get_transaction_by_id(transaction_id, message)
@@ -125,6 +316,50 @@ def send_money():
         return failure_response("Could not create transaction")
     return success_response(transactions)
 
+#pay many receivers at once, authenticated once and committed once
+@app.route("/api/transactions/batch/", methods=["POST"])
+def send_money_batch():
+    body = json.loads(request.data)
+    sender_id = int(body.get("sender_id"))
+    password = body.get("password")
+    transfers = body.get("transfers")
+    if not isinstance(transfers, list) or len(transfers) == 0:
+        return failure_response("Did not supply any transfers")
+    if len(transfers) > MAX_BATCH_SIZE:
+        return failure_response("Too many transfers, the limit is %d" % MAX_BATCH_SIZE)
+
+    sender = DB.get_user(sender_id, ["password"])
+    if sender is None:
+        return failure_response("Not an acceptable sender id")
+    real_password = sender["password"]
+    if real_password != password:
+        return failure_response("Incorrect password")
+
+    parsed = parse_transfers(transfers)
+    transaction_ids = DB.send_money_batch(sender_id, [p for p in parsed if isinstance(p, tuple)])
+    if transaction_ids is False:
+        return failure_response("Insufficient funds to complete transactions")
+    transaction_ids = iter(transaction_ids)
+    results = []
+    for item, transfer in zip(transfers, parsed):
+        if not isinstance(transfer, tuple):
+            results.append({"success": False, "error": transfer})
+            continue
+        transaction_id = next(transaction_ids)
+        if transaction_id is None:
+            results.append({"success": False, "error": "Not an acceptable receiver id"})
+            continue
+        receiver_id, amount = transfer
+        results.append({"success": True, "data": {
+            "id": transaction_id,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "amount": amount,
+            "accepted": True,
+            "message": item.get("message")
+        }})
+    return success_response(results)
+
 @app.route("/api/transactions/request/", methods=["POST"])
 def request_money():
     body = json.loads(request.data)
@@ -134,13 +369,13 @@ def request_money():
     message = body.get("message")
     password = body.get("password")
 
-    sender = DB.get_user_by_id(sender_id)
+    sender = DB.get_user(sender_id, ["password"])
     if sender is None:
         return failure_response("Not an acceptable sender id")
     real_password = sender["password"]
     if real_password != password:
         return failure_response("Incorrect password")
-    receiver = DB.get_user_by_id(receiver_id)
+    receiver = DB.get_user(receiver_id, ["id"])
     if receiver is None:
         return failure_response("Not an acceptable receiver id")
     if amount < 0:
@@ -161,13 +396,13 @@ def accept_or_deny_payment(transaction_id):
     password = body.get("password")
 
     transactions = DB.get_transaction_by_id(transaction_id, message)
+    if transactions is None:
+        return failure_response("Transaction not found")
     receiver_id = transactions["receiver_id"]
-    receiver = DB.get_user_by_id(receiver_id)
+    receiver = DB.get_user(receiver_id, ["password"])
     real_password = receiver["password"]
     if real_password != password:
         return failure_response("Incorrect password")
-    if transactions is None:
-        return failure_response("Transaction not found")
     if accepted == "True":
         transaction_id = DB.accept_transaction(transaction_id)
         if transaction_id == False:
@@ -182,7 +417,10 @@ def accept_or_deny_payment(transaction_id):
 
 
 if __name__ == "__main__":
-    app.run(host="0.0.0.0", port=5000, debug=True)
+    if ASYNC_SERVER:
+        async_server.serve(app, "0.0.0.0", 5000)
+    else:
+        app.run(host="0.0.0.0", port=5000, debug=True)
 
     #bind to PORT if defined, otherwise use default 5000 above
     #port = int(os.environ.get('PORT', 5000))
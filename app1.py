@@ -1,36 +1,128 @@
 from datetime import datetime
 import json
 import os
+import time
 
 from db1 import db
 from db1 import User
+from db1 import FEED
+from db1 import LEDGER
+from db1 import ROLLUPS
 from db1 import Transactions as trans
-
+from db1 import export_lines
+from db1 import rebuild_rollups
+from responses import MAX_BATCH_SIZE
+from responses import STREAM_CHUNK_SIZE
+from responses import answered_response
+from responses import failure_response
+from responses import page_limit
+from responses import page_response
+from responses import parse_request_ids
+from responses import parse_transfers
+from responses import stream_response
+from responses import success_response
+
+import bulk
+import connection_pool
+import db1
+import history
+import metrics
+import migrations
+import querylog
+import replica
+import rollups
+import tokens
 import users_dao
 import transactions_dao
 
 from flask import Flask
+from flask import Response
 from flask import request
+from sqlalchemy import event
 
 
 db_filename = "auth.db"
 app = Flask(__name__)
 
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % db_filename
+app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///%s" % os.path.abspath(db_filename)
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
-app.config["SQLALCHEMY_ECHO"] = True
+# logs every statement, SLOW_QUERY_MS=N logs only the slow ones (with their query plan)
+app.config["SQLALCHEMY_ECHO"] = os.environ.get("SQLALCHEMY_ECHO") == "1"
 
 db.init_app(app)
 with app.app_context():
+    # same WAL/busy_timeout/cache settings as the SQLite3 driver's connection pool
+    @event.listens_for(db.engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        for name, value in connection_pool.DEFAULT_PRAGMAS:
+            dbapi_connection.execute("PRAGMA %s = %s;" % (name, value))
+    # statement timing for METRICS=1 (/metrics) and SLOW_QUERY_MS=N (slow-query log),
+    # listeners get (statement, parameters, seconds) like DatabaseDriver's
+    query_listeners = []
+    if metrics.ENABLED:
+        query_listeners.append(metrics.observe_query)
+    if querylog.ENABLED:
+        query_listeners.append(querylog.profiler_for(os.path.abspath(db_filename)))
+    if query_listeners:
+        @event.listens_for(db.engine, "before_cursor_execute")
+        def start_query_timer(conn, cursor, statement, parameters, context, executemany):
+            conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+        @event.listens_for(db.engine, "after_cursor_execute")
+        def record_query(conn, cursor, statement, parameters, context, executemany):
+            seconds = time.perf_counter() - conn.info["query_started"].pop()
+            for listener in query_listeners:
+                listener(statement, None if executemany else parameters, seconds)
+    if metrics.ENABLED:
+        @event.listens_for(db.engine, "commit")
+        def record_commit(conn):
+            metrics.observe_commit()
+    db.engine.dispose()
     db.create_all()
-
-
-# generalized response formats
-def success_response(data, code=200):
-    return json.dumps({"success": True, "data": data}), code
-
-def failure_response(message, code=404):
-    return json.dumps({"success": False, "error": message}), code
+    conn = db.engine.raw_connection()
+    try:
+        migrations.migrate(conn, migrations.AUTH_MIGRATIONS)
+        # LEDGER=1: opening entries for users created before the ledger was on
+        if LEDGER is not None:
+            LEDGER.open_missing_accounts(conn.cursor())
+            conn.commit()
+    finally:
+        conn.close()
+    # ROLLUPS=1 on a database that has transactions but no rollups yet
+    if ROLLUPS is not None and ROLLUPS.is_empty(transactions_dao.session_cursor()):
+        rebuild_rollups()
+    db.session.remove()
+    # READ_REPLICA=1: the read routes are served from a snapshot (replica.py)
+    if replica.ENABLED:
+        db1.use_replica()
+
+# replica.READ_ENDPOINTS read from the replica while it is within the staleness bound,
+# unless the request asks to read its own writes
+if replica.ENABLED:
+    @app.before_request
+    def route_reads():
+        db1.REPLICA.use(replica.wants_replica(request))
+
+    @app.teardown_appcontext
+    def reset_reads(exception):
+        db1.REPLICA.use(False)
+
+if metrics.ENABLED:
+    metrics.install(app)
+
+
+# ?stream=true streams everything after ?after=, ?limit= returns a single page,
+# without either the whole table is returned in one piece as before
+def list_response(model):
+    after = request.args.get("after", 0, type=int)
+    query = model.query.filter(model.id > after).order_by(model.id)
+    if request.args.get("stream") in ("1", "true", "True"):
+        rows = query.yield_per(STREAM_CHUNK_SIZE)
+        return stream_response(t.serialize() for t in rows)
+    if "limit" in request.args or "after" in request.args:
+        limit = page_limit(request.args)
+        return page_response([t.serialize() for t in query.limit(limit)], limit)
+    return success_response([t.serialize() for t in model.query.all()])
 
 
 @app.route("/")
@@ -38,12 +130,12 @@ def failure_response(message, code=404):
 #get all users
 @app.route("/api/users/")
 def get_users():
-    return success_response( [t.serialize() for t in User.query.all()] )
+    return list_response(User)
 
 #get the transactions of every user (only for testing)
 @app.route("/api/users/transactions/")
 def get_transactions(): 
-    return success_response( [t.serialize() for t in trans.query.all()]
+    return list_response(trans)
 
 
 #delete entire user database (only for testing)
@@ -73,13 +165,26 @@ def get_transactions():
 #     return success_response(new_user.serialize(), 201)
 
 
+# ?fields=id,balance returns only those fields, ?include=transactions adds the sent transactions
 @app.route("/api/user/<int:user_id>/")
 def get_user(user_id):
-    #user = users_dao.get_user_by_id(user_id)
-    user = User.query.filter_by(id=user_id).first()
+    fields = request.args.get("fields")
+    include = request.args.get("include")
+    if fields is None and include is None:
+        user = User.query.filter_by(id=user_id).first()
+        if user is None:
+            return failure_response('User not found')
+        return success_response(user.serialize())
+
+    fields = fields.split(",") if fields else users_dao.USER_FIELDS
+    if any(f not in users_dao.USER_FIELDS for f in fields):
+        return failure_response("Unknown field, expected some of " + ",".join(users_dao.USER_FIELDS))
+    user = users_dao.get_user_fields(user_id, [f for f in users_dao.USER_FIELDS if f in fields])
     if user is None:
         return failure_response('User not found')
-    return success_response(user.serialize())
+    if "transactions" in (include or "").split(","):
+        user["transactions"] = [t.serialize() for t in trans.query.filter_by(sender_id=user_id)]
+    return success_response(user)
 
 
 
@@ -89,7 +194,110 @@ def get_transactions_of_user(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found")   
-    return success_response(user.transactions)
+    return success_response([t.serialize() for t in user.transactions])
+
+
+# every user or transaction row as ?format=csv (the default) or jsonl, streamed a chunk at a
+# time; passwords and session tokens are left out, python bulk.py export writes full dumps
+@app.route("/api/export/<table>/")
+def export_table(table):
+    fmt = request.args.get("format", "csv")
+    if table not in bulk.TABLES or fmt not in bulk.FORMATS:
+        return failure_response("Unknown table or format")
+    columns = bulk.public_columns(db.engine.url.database, table)
+    return Response(export_lines(table, fmt, columns), mimetype=bulk.MIMETYPES[fmt])
+
+
+# sent and received transactions, newest first, ?limit=N&before=ID pages (pass "next" as before),
+# filtered by ?direction=sent|received, ?accepted=true|false, ?counterparty=ID, ?min_amount=, ?max_amount=
+@app.route("/api/user/<int:user_id>/history/")
+def get_history(user_id):
+    try:
+        filters = history.parse_filters(request.args)
+    except ValueError as e:
+        return failure_response(str(e))
+    if users_dao.get_user_fields(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    limit = page_limit(request.args)
+    before = request.args.get("before", type=int)
+    return page_response(transactions_dao.get_history(user_id, limit, before, **filters), limit)
+
+
+# sent, received and pending totals per day or month from the rollups (ROLLUPS=1),
+# ?from=YYYY-MM-DD&to=YYYY-MM-DD (this month so far by default)&period=day|month
+@app.route("/api/user/<int:user_id>/statement/")
+def get_statement(user_id):
+    if ROLLUPS is None:
+        return failure_response("Rollups are not enabled")
+    try:
+        start, end, period = rollups.parse_range(request.args)
+    except ValueError as e:
+        return failure_response(str(e))
+    if users_dao.get_user_fields(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    return success_response(transactions_dao.get_statement(user_id, start, end, period))
+
+
+# payment requests waiting for the user to pay them, newest first, paged like the history
+@app.route("/api/user/<int:user_id>/requests/")
+def get_pending_requests(user_id):
+    if users_dao.get_user_fields(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    limit = page_limit(request.args)
+    before = request.args.get("before", type=int)
+    return page_response(transactions_dao.get_pending_requests(user_id, limit, before), limit)
+
+
+# body: {"password": ..., "accept": [ids], "deny": [ids]}, answered in one transaction;
+# ids that are not pending requests to the user come back as skipped
+@app.route("/api/user/<int:user_id>/requests/", methods=["POST"])
+def answer_pending_requests(user_id):
+    body = json.loads(request.data)
+    password = body.get("password")
+    parsed = parse_request_ids(body)
+    if not isinstance(parsed, tuple):
+        return failure_response(parsed)
+    accept_ids, deny_ids = parsed
+
+    user = User.query.filter_by(id=user_id).first()
+    if user is None:
+        return failure_response("User not found")
+    if password is None or not user.verify_password(password):
+        return failure_response("Incorrect password")
+    return answered_response(accept_ids, deny_ids, transactions_dao.answer_requests(user_id, accept_ids, deny_ids))
+
+
+# transactions of the user and of the users they follow, newest first, paged like the history
+@app.route("/api/user/<int:user_id>/feed/")
+def get_feed(user_id):
+    if FEED is None:
+        return failure_response("Feeds are not enabled")
+    if users_dao.get_user_fields(user_id, ["id"]) is None:
+        return failure_response("User not found")
+    limit = page_limit(request.args)
+    before = request.args.get("before", type=int)
+    return page_response(transactions_dao.get_feed(user_id, limit, before), limit)
+
+
+# body: {"user_id": <id to follow>}, payments they make or receive from now on show up in the feed
+@app.route("/api/user/<int:user_id>/follow/", methods=["POST"])
+def follow_user(user_id):
+    if FEED is None:
+        return failure_response("Feeds are not enabled")
+    body = json.loads(request.data)
+    followed_id = int(body.get("user_id"))
+    if users_dao.get_user_fields(user_id, ["id"]) is None or users_dao.get_user_fields(followed_id, ["id"]) is None:
+        return failure_response("User not found")
+    transactions_dao.follow(user_id, followed_id)
+    return success_response({"follower_id": user_id, "followed_id": followed_id}, 201)
+
+
+@app.route("/api/user/<int:user_id>/follow/<int:followed_id>/", methods=["DELETE"])
+def unfollow_user(user_id, followed_id):
+    if FEED is None:
+        return failure_response("Feeds are not enabled")
+    transactions_dao.unfollow(user_id, followed_id)
+    return success_response({"follower_id": user_id, "followed_id": followed_id})
 
 
 @app.route("/api/user/<int:user_id>/", methods=["DELETE"])
@@ -97,8 +305,14 @@ def delete_user(user_id):
     user = User.query.filter_by(id=user_id).first()
     if user is None:
         return failure_response("User not found")
+    if FEED is not None:
+        FEED.forget(transactions_dao.session_cursor(), user_id)
+    if ROLLUPS is not None:
+        ROLLUPS.forget(transactions_dao.session_cursor(), user_id)
     db.session.delete(user)
     db.session.commit()
+    if FEED is not None:
+        FEED.invalidate([user_id])
     return success_response(user.serialize())
 
 
@@ -122,8 +336,7 @@ def send_money():
     sender = User.query.filter_by(id=sender_id).first()
     if sender is None:
         return failure_response("Not an acceptable sender id")
-    real_password = sender.password_digest
-    if real_password != password:
+    if password is None or not sender.verify_password(password):
         return failure_response("Incorrect password")
     receiver = User.query.filter_by(id=receiver_id).first()
     if receiver is None:
@@ -139,6 +352,42 @@ def send_money():
         return failure_response("Could not create transaction")
     return success_response(transactions.serialize())
 
+#pay many receivers at once, authenticated once and committed once
+@app.route("/api/transactions/batch/", methods=["POST"])
+def send_money_batch():
+    body = json.loads(request.data)
+    sender_id = int(body.get("sender_id"))
+    password = body.get("password")
+    transfers = body.get("transfers")
+    if not isinstance(transfers, list) or len(transfers) == 0:
+        return failure_response("Did not supply any transfers")
+    if len(transfers) > MAX_BATCH_SIZE:
+        return failure_response("Too many transfers, the limit is %d" % MAX_BATCH_SIZE)
+
+    sender = User.query.filter_by(id=sender_id).first()
+    if sender is None:
+        return failure_response("Not an acceptable sender id")
+    if password is None or not sender.verify_password(password):
+        return failure_response("Incorrect password")
+
+    parsed = parse_transfers(transfers)
+    valid = [(p[0], p[1], item.get("message")) for item, p in zip(transfers, parsed) if isinstance(p, tuple)]
+    transactions = transactions_dao.send_money_batch(sender_id, valid)
+    if transactions is None:
+        return failure_response("Insufficient funds to complete transactions")
+    transactions = iter(transactions)
+    results = []
+    for transfer in parsed:
+        if not isinstance(transfer, tuple):
+            results.append({"success": False, "error": transfer})
+            continue
+        transaction = next(transactions)
+        if transaction is None:
+            results.append({"success": False, "error": "Not an acceptable receiver id"})
+            continue
+        results.append({"success": True, "data": transaction})
+    return success_response(results)
+
 @app.route("/api/transactions/request/", methods=["POST"])
 def request_money():
     body = json.loads(request.data)
@@ -151,8 +400,7 @@ def request_money():
     sender = User.query.filter_by(id=sender_id).first()
     if sender is None:
         return failure_response("Not an acceptable sender id")
-    real_password = sender.password_digest
-    if real_password != password:
+    if password is None or not sender.verify_password(password):
         return failure_response("Incorrect password")
     receiver = User.query.filter_by(id=receiver_id).first()
     if receiver is None:
@@ -175,30 +423,49 @@ def accept_or_deny_payment(transaction_id):
     password = body.get("password")
 
     transactions = trans.query.filter_by(id=transaction_id).first()
+    if transactions is None:
+        return failure_response("Transaction not found")
     transactions.message = message
     
     receiver_id = transactions.receiver_id
     receiver = User.query.filter_by(id=receiver_id).first()
-    real_password = receiver.password_digest
-    if real_password != password:
+    if password is None or not receiver.verify_password(password):
         return failure_response("Incorrect password")
-    if transactions is None:
-        return failure_response("Transaction not found")
     if accepted == "True":
         transaction_id = transactions_dao.accept_transaction(transaction_id)
         if transaction_id == None:
             return failure_response("Insufficient funds to complete transaction")
         transactions = trans.query.filter_by(id=transaction_id).first()
-        return success_response(transactions.serialize)
+        return success_response(transactions.serialize())
     else:
-        db.session.delete(transactions)
-        db.session.commit()
+        transactions_dao.delete_transaction(transactions)
         return success_response(transactions.serialize())
     
 
 
 #authentication 
 
+# STATELESS_SESSIONS=1 hands out signed tokens (see tokens.py) that are verified without
+# a database lookup, keys come from SESSION_SECRET_KEYS
+STATELESS_SESSIONS = os.environ.get("STATELESS_SESSIONS") == "1"
+session_tokens = tokens.SessionTokens(tokens.secret_keys_from_env(), os.path.abspath(db_filename)) if STATELESS_SESSIONS else None
+
+def session_response(user):
+    if session_tokens is not None:
+        return stateless_session_response(user.id)
+    return json.dumps({
+        "session_token": user.session_token,
+        "session_expiration": str(user.session_expiration),
+        "update_token": user.update_token
+        })
+
+def stateless_session_response(user_id):
+    return json.dumps({
+        "session_token": session_tokens.issue(user_id, "session"),
+        "session_expiration": str(datetime.fromtimestamp(session_tokens.expiration("session"))),
+        "update_token": session_tokens.issue(user_id, "update")
+        })
+
 def extract_token(request):
     auth_header = request.headers.get("Authorization")
     if auth_header is None:
@@ -228,11 +495,7 @@ def register_account():
     if not was_created:
         return failure_response("User already exists")
     
-    return json.dumps({
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token
-        })
+    return session_response(user)
 
     
 @app.route("/login/", methods=["POST"])
@@ -249,11 +512,7 @@ def login():
     if not was_successful:
         return failure_response("Incorrect email or password")
 
-    return json.dumps({
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token
-        })
+    return session_response(user)
 
 @app.route("/session/", methods=["POST"])
 def update_session():
@@ -261,17 +520,19 @@ def update_session():
 
     if not was_successful:
         return update_token
+
+    if session_tokens is not None:
+        user_id = session_tokens.consume(update_token, "update")
+        if user_id is None:
+            return json.dumps({"error": "Invalid update token"})
+        return stateless_session_response(user_id)
     
     try:
         user = users_dao.renew_session(update_token)
     except Exception as e:
         return json.dumps({"error": f"Invalid update token: {str(e)}"})
     
-    return json.dumps({
-        "session_token": user.session_token,
-        "session_expiration": str(user.session_expiration),
-        "update_token": user.update_token
-        })
+    return session_response(user)
 
 
 @app.route("/secret/", methods=["GET"])
@@ -280,6 +541,11 @@ def secret_message():
 
     if not was_successful:
         return session_token
+
+    if session_tokens is not None:
+        if session_tokens.verify(session_token, "session") is None:
+            return failure_response("Invalid session token")
+        return success_response("You have successfully implemented sessions")
     
     user = users_dao.get_user_by_session_token(session_token)
     if not user or not user.verify_session_token(session_token):
@@ -0,0 +1,356 @@
+import asyncio
+import io
+import os
+import signal
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from email.utils import formatdate
+from urllib.parse import unquote_to_bytes
+
+
+# each request thread holds a pooled connection while it runs, so together they match
+# DatabaseDriver's default pool of 16 (app.py sizes the pool to READ + WRITE_WORKERS)
+READ_WORKERS = int(os.environ.get("READ_WORKERS", 12))
+WRITE_WORKERS = int(os.environ.get("WRITE_WORKERS", 4))
+# seconds an open connection may wait for its next request line
+KEEPALIVE_TIMEOUT = 75
+# seconds each read of a request's headers or body may wait for data: an upload that keeps
+# sending is never cut off, one that stalls gets a 408
+READ_TIMEOUT = float(os.environ.get("READ_TIMEOUT", 30))
+# bytes per read of a request body
+READ_SIZE = 64 * 1024
+# seconds a stopping server gives open requests to finish (see serve_until_stopped)
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", 30))
+MAX_HEADER_SIZE = 64 * 1024
+MAX_BODY_SIZE = 16 * 1024 * 1024
+READ_METHODS = ("GET", "HEAD", "OPTIONS")
+
+REASONS = {
+    100: "Continue", 400: "Bad Request", 408: "Request Timeout", 411: "Length Required",
+    413: "Payload Too Large", 431: "Request Header Fields Too Large", 500: "Internal Server Error",
+}
+
+
+class BadRequest(Exception):
+    def __init__(self, code):
+        Exception.__init__(self, code)
+        self.code = code
+
+
+class AsyncWSGIServer(object):
+    """
+    HTTP/1.1 server on an asyncio event loop for a WSGI app (the Flask apps).
+    Each open connection is a coroutine, so idle keep-alive clients cost no threads.
+    A request's WSGI call, including iterating its body, runs on one worker thread
+    (GET/HEAD/OPTIONS on the read pool, everything else on the write pool) because the
+    connection pool leases connections per thread. Body chunks are passed back to the
+    loop through a bounded queue, so a slow client slows down its own stream only.
+    Pass sock to accept on an already listening socket (serve.py's workers share one).
+    """
+
+    def __init__(self, app, host="0.0.0.0", port=5000, read_workers=READ_WORKERS,
+                 write_workers=WRITE_WORKERS, keepalive_timeout=KEEPALIVE_TIMEOUT, read_timeout=READ_TIMEOUT,
+                 sock=None):
+        self.app = app
+        self.host = host
+        self.port = port
+        self.sock = sock
+        self.keepalive_timeout = keepalive_timeout
+        self.read_timeout = read_timeout
+        self.readers = ThreadPoolExecutor(read_workers, thread_name_prefix="read")
+        self.writers = ThreadPoolExecutor(write_workers, thread_name_prefix="write")
+        self.server = None
+        #open connections' tasks, mapped to whether they are waiting for their next request
+        self.connections = {}
+        self.closing = False
+
+    async def start(self):
+        if self.sock is not None:
+            self.server = await asyncio.start_server(self.handle, sock=self.sock, limit=MAX_HEADER_SIZE)
+        else:
+            self.server = await asyncio.start_server(
+                self.handle, self.host, self.port, limit=MAX_HEADER_SIZE
+            )
+        return self.server
+
+    async def serve_forever(self):
+        server = await self.start()
+        async with server:
+            await server.serve_forever()
+
+    #serve until one of stop_signals arrives, then stop gracefully; on_ready() is called
+    #once the server accepts connections
+    async def serve_until_stopped(self, stop_signals=(signal.SIGTERM,), on_ready=None, timeout=GRACEFUL_TIMEOUT):
+        await self.start()
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for signum in stop_signals:
+            loop.add_signal_handler(signum, stop.set)
+        if on_ready is not None:
+            on_ready()
+        await stop.wait()
+        await self.shutdown(timeout)
+
+    #stop accepting, drop idle keep-alive connections and give the requests in flight
+    #up to timeout seconds to finish; their connections close after the response
+    async def shutdown(self, timeout=GRACEFUL_TIMEOUT):
+        self.closing = True
+        self.server.close()
+        for task, idle in list(self.connections.items()):
+            if idle:
+                task.cancel()
+        if self.connections:
+            await asyncio.wait(list(self.connections), timeout=timeout)
+
+    def close(self):
+        if self.server is not None:
+            self.server.close()
+        self.readers.shutdown(wait=False)
+        self.writers.shutdown(wait=False)
+
+    #one keep-alive connection: read a request, answer it, repeat until either side closes
+    async def handle(self, reader, writer):
+        peer = writer.get_extra_info("peername") or ("", 0)
+        task = asyncio.current_task()
+        try:
+            keep_alive = True
+            while keep_alive and not self.closing:
+                self.connections[task] = True
+                try:
+                    request = await self.read_request(reader, writer)
+                except BadRequest as e:
+                    await self.send_error(writer, e.code)
+                    break
+                if request is None:
+                    break
+                self.connections[task] = False
+                environ, keep_alive = request
+                environ["REMOTE_ADDR"], environ["REMOTE_PORT"] = str(peer[0]), str(peer[1])
+                keep_alive = await self.respond(environ, writer, keep_alive)
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.connections.pop(task, None)
+            writer.close()
+
+    #(environ, keep_alive) of the next request, None once the client closes the connection or
+    #sends nothing for keepalive_timeout seconds
+    async def read_request(self, reader, writer):
+        try:
+            line = await asyncio.wait_for(reader.readline(), self.keepalive_timeout)
+        except asyncio.TimeoutError:
+            return None
+        except (asyncio.LimitOverrunError, ValueError):
+            raise BadRequest(431)
+        if not line:
+            return None
+        try:
+            method, target, version = line.decode("latin-1").split()
+        except ValueError:
+            raise BadRequest(400)
+        headers = {}
+        environ = {}
+        size = 0
+        while True:
+            try:
+                line = await self.read(reader.readline())
+            except (asyncio.LimitOverrunError, ValueError):
+                raise BadRequest(431)
+            size += len(line)
+            if size > MAX_HEADER_SIZE:
+                raise BadRequest(431)
+            if line in (b"\r\n", b"\n", b""):
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            name, value = name.strip().lower(), value.strip()
+            headers[name] = value
+            key = name.upper().replace("-", "_")
+            if key not in ("CONTENT_TYPE", "CONTENT_LENGTH"):
+                key = "HTTP_" + key
+            environ[key] = environ[key] + "," + value if key in environ else value
+
+        connection = headers.get("connection", "").lower()
+        if version == "HTTP/1.1":
+            keep_alive = connection != "close"
+        else:
+            keep_alive = connection == "keep-alive"
+
+        if headers.get("expect", "").lower() == "100-continue":
+            writer.write(b"HTTP/1.1 100 Continue\r\n\r\n")
+        if "chunked" in headers.get("transfer-encoding", "").lower():
+            body = await self.read_chunked(reader)
+        else:
+            try:
+                length = int(headers.get("content-length", 0))
+            except ValueError:
+                raise BadRequest(400)
+            if length > MAX_BODY_SIZE:
+                raise BadRequest(413)
+            body = await self.read_exactly(reader, length)
+        environ["CONTENT_LENGTH"] = str(len(body))
+
+        path, _, query = target.partition("?")
+        environ.update({
+            "REQUEST_METHOD": method.upper(),
+            "SCRIPT_NAME": "",
+            "PATH_INFO": unquote_to_bytes(path).decode("latin-1"),
+            "QUERY_STRING": query,
+            "SERVER_NAME": self.host,
+            "SERVER_PORT": str(self.port),
+            "SERVER_PROTOCOL": version,
+            "wsgi.version": (1, 0),
+            "wsgi.url_scheme": "http",
+            "wsgi.input": io.BytesIO(body),
+            "wsgi.errors": sys.stderr,
+            "wsgi.multithread": True,
+            "wsgi.multiprocess": False,
+            "wsgi.run_once": False,
+        })
+        return environ, keep_alive
+
+    #a read of the request's headers or body, 408 when no data comes for read_timeout seconds
+    async def read(self, awaitable):
+        try:
+            return await asyncio.wait_for(awaitable, self.read_timeout)
+        except asyncio.TimeoutError:
+            raise BadRequest(408)
+
+    #length bytes of a body, READ_SIZE at a time, so read_timeout applies to each read and
+    #not to the whole upload
+    async def read_exactly(self, reader, length):
+        parts = []
+        remaining = length
+        while remaining > 0:
+            part = await self.read(reader.read(min(remaining, READ_SIZE)))
+            if not part:
+                raise asyncio.IncompleteReadError(b"".join(parts), length)
+            parts.append(part)
+            remaining -= len(part)
+        return b"".join(parts)
+
+    async def read_chunked(self, reader):
+        chunks = []
+        size = 0
+        while True:
+            line = await self.read(reader.readline())
+            try:
+                length = int(line.split(b";")[0].strip(), 16)
+            except ValueError:
+                raise BadRequest(400)
+            if length == 0:
+                while (await self.read(reader.readline())) not in (b"\r\n", b"\n", b""):
+                    pass
+                return b"".join(chunks)
+            size += length
+            if size > MAX_BODY_SIZE:
+                raise BadRequest(413)
+            chunks.append(await self.read_exactly(reader, length))
+            await self.read_exactly(reader, 2)
+
+    #run the app on a worker thread and write what it produces, returns whether to keep the connection
+    async def respond(self, environ, writer, keep_alive):
+        loop = asyncio.get_running_loop()
+        queue = asyncio.Queue(maxsize=8)
+        executor = self.readers if environ["REQUEST_METHOD"] in READ_METHODS else self.writers
+        worker = loop.run_in_executor(executor, self.call_app, environ, loop, queue)
+        finished = False
+        try:
+            kind, status, headers = await queue.get()
+            if kind == "error":
+                await self.send_error(writer, 500)
+                finished = True
+                return False
+            names = {name.lower() for name, _ in headers}
+            chunked = "content-length" not in names and environ["SERVER_PROTOCOL"] == "HTTP/1.1"
+            if ("content-length" not in names and not chunked) or self.closing:
+                keep_alive = False
+            head = ["HTTP/1.1 %s" % status]
+            head.extend("%s: %s" % (name, value) for name, value in headers)
+            if "date" not in names:
+                head.append("Date: %s" % formatdate(usegmt=True))
+            if chunked:
+                head.append("Transfer-Encoding: chunked")
+            head.append("Connection: %s" % ("keep-alive" if keep_alive else "close"))
+            writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1"))
+            send_body = environ["REQUEST_METHOD"] != "HEAD"
+            while True:
+                kind, data, _ = await queue.get()
+                if kind != "data":
+                    break
+                if send_body:
+                    writer.write(b"%x\r\n%s\r\n" % (len(data), data) if chunked else data)
+                    await writer.drain()
+            finished = True
+            if kind == "error":
+                # the status line is already out, all we can do is cut the response short
+                return False
+            if chunked and send_body:
+                writer.write(b"0\r\n\r\n")
+            await writer.drain()
+            return keep_alive
+        finally:
+            if not finished:
+                # the client went away mid-response: let the worker finish into the void
+                while True:
+                    kind, _, _ = await queue.get()
+                    if kind in ("end", "error"):
+                        break
+            await worker
+
+    #runs on a worker thread: the whole WSGI call, from app() to close()
+    def call_app(self, environ, loop, queue):
+        def put(item):
+            asyncio.run_coroutine_threadsafe(queue.put(item), loop).result()
+
+        response = []
+        def start_response(status, headers, exc_info=None):
+            if exc_info is not None and sent:
+                raise exc_info[1].with_traceback(exc_info[2])
+            response[:] = [status, headers]
+            return write
+
+        sent = []
+        def write(data):
+            if not sent:
+                sent.append(True)
+                put(("start",) + tuple(response))
+            if data:
+                put(("data", bytes(data), None))
+
+        try:
+            result = self.app(environ, start_response)
+            try:
+                for data in result:
+                    write(data)
+            finally:
+                if hasattr(result, "close"):
+                    result.close()
+            if not sent:
+                sent.append(True)
+                put(("start",) + tuple(response))
+            put(("end", None, None))
+        except Exception as e:
+            print("Error handling %s %s: %r" % (environ["REQUEST_METHOD"], environ["PATH_INFO"], e),
+                  file=sys.stderr)
+            put(("error", None, None))
+
+    async def send_error(self, writer, code):
+        reason = REASONS.get(code, "Error")
+        body = reason.encode("latin-1")
+        writer.write(
+            b"HTTP/1.1 %d %s\r\nContent-Type: text/plain\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s"
+            % (code, reason.encode("latin-1"), len(body), body)
+        )
+        await writer.drain()
+
+
+def serve(app, host="0.0.0.0", port=5000, **kwargs):
+    server = AsyncWSGIServer(app, host, port, **kwargs)
+    print("Serving on http://%s:%d (asyncio, %d read / %d write threads)"
+          % (host, port, server.readers._max_workers, server.writers._max_workers))
+    try:
+        asyncio.run(server.serve_forever())
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.close()
@@ -0,0 +1,424 @@
+import argparse
+import datetime
+import json
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from collections import deque
+
+
+# Load and latency benchmark for app.py (SQLite3) and app1.py (SQLAlchemy).
+#
+#   python benchmark.py --app app --users 1000 --transactions 100000 --workers 8
+#   python benchmark.py --app app1 --save baseline-app1.json
+#   python benchmark.py --app app1 --compare baseline-app1.json
+#   python benchmark.py --app app --url http://127.0.0.1:5000    (against a running server)
+#
+# Locally the app is imported inside a temporary directory, so it creates a fresh
+# todo.db/auth.db there, which is seeded with synthetic users and transactions and
+# driven through Flask's test client. Every scenario runs its requests across the
+# worker threads, then the total balance is checked against the seeded total.
+
+PASSWORD = "password"
+BALANCE = 1000000
+# sends a read to the primary when the app serves reads from a replica (READ_REPLICA=1)
+READ_YOUR_WRITES = {"X-Read-Your-Writes": "1"}
+
+
+#clients return (status code, parsed JSON or None)
+class TestClient(object):
+    def __init__(self, flask_app):
+        self.client = flask_app.test_client()
+
+    def request(self, method, path, body=None, headers=None):
+        data = json.dumps(body) if body is not None else None
+        response = self.client.open(path, method=method, data=data, headers=headers)
+        return response.status_code, parse_body(response.get_data())
+
+
+class HTTPClient(object):
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+
+    def request(self, method, path, body=None, headers=None):
+        data = json.dumps(body).encode("utf8") if body is not None else None
+        headers = dict(headers or {})
+        if data is not None:
+            # urllib would send it as a form, which leaves request.data empty
+            headers["Content-Type"] = "application/json"
+        request = urllib.request.Request(self.url + path, data=data, method=method, headers=headers)
+        try:
+            with urllib.request.urlopen(request) as response:
+                return response.status, parse_body(response.read())
+        except urllib.error.HTTPError as e:
+            return e.code, parse_body(e.read())
+
+def parse_body(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        return None
+
+def succeeded(status, body):
+    return status < 400 and isinstance(body, dict) and body.get("success", True) is not False
+
+
+#seeding, local runs write straight into the fresh database
+def seed_app(module, users, transactions, rng):
+    conn = module.DB.conn
+    conn.executemany(
+        "INSERT INTO user (NAME, USERNAME, EMAIL, PASSWORD, BALANCE) VALUES (?, ?, ?, ?, ?);",
+        [("User %d" % i, "user%d" % i, "user%d@example.com" % i, PASSWORD, BALANCE) for i in range(users)]
+    )
+    conn.executemany(
+        "INSERT INTO transactions (SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED) VALUES (?, ?, ?, ?);",
+        [random_transaction(rng, users) for _ in range(transactions)]
+    )
+    conn.commit()
+    if module.DB.ledger is not None:
+        module.DB.open_ledger_accounts()
+    if module.DB.rollups is not None:
+        module.DB.rebuild_rollups()
+    module.DB.release()
+
+def seed_app1(module, users, transactions, rng):
+    import passwords
+    from db1 import db, User, Transactions, LEDGER, ROLLUPS, session_cursor, rebuild_rollups
+    digest = passwords.hash_password(PASSWORD)
+    expiration = datetime.datetime.now() + datetime.timedelta(days=1)
+    with module.app.app_context():
+        db.engine.echo = False
+        db.session.execute(User.__table__.insert(), [{
+            "name": "User %d" % i,
+            "username": "user%d" % i,
+            "email": "user%d@example.com" % i,
+            "password_digest": digest,
+            "balance": BALANCE,
+            "session_token": os.urandom(20).hex(),
+            "session_expiration": expiration,
+            "update_token": os.urandom(20).hex()
+        } for i in range(users)])
+        if transactions:
+            db.session.execute(Transactions.__table__.insert(), [
+                dict(zip(("sender_id", "receiver_id", "amount", "accepted"), random_transaction(rng, users)))
+                for _ in range(transactions)
+            ])
+        db.session.commit()
+        if LEDGER is not None:
+            LEDGER.open_missing_accounts(session_cursor())
+            db.session.commit()
+        if ROLLUPS is not None:
+            rebuild_rollups()
+
+#remote runs go through the API, transactions in batches from the first user
+def seed_http(client, app_name, users, transactions, rng):
+    for i in range(users):
+        body = {"name": "User %d" % i, "username": "bench%d_%d" % (os.getpid(), i),
+                "email": "bench%d_%d@example.com" % (os.getpid(), i), "password": PASSWORD, "balance": BALANCE}
+        client.request("POST", "/register/" if app_name == "app1" else "/api/users/", body)
+    status, body = client.request("GET", "/api/users/?stream=true", headers=READ_YOUR_WRITES)
+    ids = [u["id"] for u in body["data"]][-users:]
+    for start in range(0, transactions, 10000):
+        transfers = [{"receiver_id": rng.choice(ids), "amount": 1} for _ in range(min(10000, transactions - start))]
+        client.request("POST", "/api/transactions/batch/", {"sender_id": ids[0], "password": PASSWORD, "transfers": transfers})
+    return ids
+
+def random_transaction(rng, users):
+    sender = rng.randint(1, users)
+    receiver = rng.randint(1, users)
+    return (sender, receiver, rng.randint(1, 100), rng.random() < 0.8)
+
+
+#total money in the system
+def total_balance(app_name, module, client, user_ids):
+    if module is None:
+        total = 0
+        for user_id in user_ids:
+            status, body = client.request("GET", "/api/user/%d/?fields=balance" % user_id, headers=READ_YOUR_WRITES)
+            total += body["data"]["balance"]
+        return total
+    if app_name == "app":
+        total = module.DB.conn.execute("SELECT SUM(%s) FROM user;" % module.DB.balance_column).fetchone()[0]
+        module.DB.release()
+        return total
+    import ledger
+    from db1 import db, User, LEDGER
+    with module.app.app_context():
+        if LEDGER is not None:
+            return db.session.execute(db.text("SELECT SUM(%s) FROM user;" % ledger.balance_sql("user.id"))).scalar()
+        return db.session.query(db.func.sum(User.balance)).scalar()
+
+
+#with READ_REPLICA=1 the seeded rows reach the read routes with the next snapshot, wait
+#until reads of the last user and of the first user's transactions (the sender of the
+#remote seed batches) agree with the same reads from the primary; False if they never do
+def wait_for_replica(client, user_ids, timeout=30):
+    paths = ["/api/users/?limit=1&after=%d" % (max(user_ids) - 1), "/api/users/%d/transactions/" % user_ids[0]]
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if all(client.request("GET", p) == client.request("GET", p, headers=READ_YOUR_WRITES) for p in paths):
+            return True
+        time.sleep(0.1)
+    return False
+
+
+class Scenarios(object):
+    """
+    One method per endpoint, each makes a single request and returns (status, body).
+    Shared state (pending requests, tokens) is kept in thread-safe deques.
+    """
+
+    def __init__(self, app_name, user_ids, rng_seed):
+        self.app_name = app_name
+        self.user_ids = user_ids
+        self.rng_seed = rng_seed
+        # pending requests, alternately left for the accept and the deny scenario
+        self.pending = {"True": deque(), "False": deque()}
+        self.requested = 0
+        # username -> latest (session token, update token), renewing replaces both
+        self.sessions = {}
+        self.registered = 0
+        self.lock = threading.Lock()
+
+    def names(self):
+        names = ["users_page", "user", "user_transactions", "send", "request", "accept", "deny"]
+        if self.app_name == "app1":
+            names += ["register", "login", "session", "secret"]
+        return names
+
+    def pair(self, rng):
+        sender, receiver = rng.sample(self.user_ids, 2)
+        return sender, receiver
+
+    def users_page(self, client, rng):
+        return client.request("GET", "/api/users/?limit=100&after=%d" % rng.choice(self.user_ids))
+
+    def user(self, client, rng):
+        return client.request("GET", "/api/user/%d/" % rng.choice(self.user_ids))
+
+    def user_transactions(self, client, rng):
+        return client.request("GET", "/api/users/%d/transactions/" % rng.choice(self.user_ids))
+
+    def send(self, client, rng):
+        sender, receiver = self.pair(rng)
+        return client.request("POST", "/api/transactions/send/", {
+            "sender_id": sender, "receiver_id": receiver, "amount": rng.randint(1, 100),
+            "message": "benchmark", "password": PASSWORD
+        })
+
+    def request(self, client, rng):
+        sender, receiver = self.pair(rng)
+        status, body = client.request("POST", "/api/transactions/request/", {
+            "sender_id": sender, "receiver_id": receiver, "amount": rng.randint(1, 100),
+            "message": "benchmark", "password": PASSWORD
+        })
+        if succeeded(status, body):
+            with self.lock:
+                self.requested += 1
+                accepted = "True" if self.requested % 2 else "False"
+            self.pending[accepted].append(body["data"]["id"])
+        return status, body
+
+    def _answer(self, client, rng, accepted):
+        try:
+            transaction_id = self.pending[accepted].popleft()
+        except IndexError:
+            return 0, None
+        return client.request("POST", "/api/transaction/%d/" % transaction_id, {
+            "accepted": accepted, "password": PASSWORD
+        })
+
+    def accept(self, client, rng):
+        return self._answer(client, rng, "True")
+
+    def deny(self, client, rng):
+        return self._answer(client, rng, "False")
+
+    def register(self, client, rng):
+        with self.lock:
+            self.registered += 1
+            n = self.registered
+        name = "bench%d_%d_%d" % (self.rng_seed, os.getpid(), n)
+        return client.request("POST", "/register/", {
+            "name": name, "username": name, "email": name + "@example.com", "password": PASSWORD
+        })
+
+    def _remember(self, username, body):
+        if body and "session_token" in body:
+            with self.lock:
+                self.sessions[username] = (body["session_token"], body["update_token"])
+
+    def _pick_session(self, rng):
+        with self.lock:
+            if not self.sessions:
+                return None, (None, None)
+            username = rng.choice(list(self.sessions))
+            return username, self.sessions.pop(username)
+
+    def login(self, client, rng):
+        username = "user%d" % (rng.choice(self.user_ids) - 1)
+        status, body = client.request("POST", "/login/", {"username": username, "password": PASSWORD})
+        self._remember(username, body)
+        return status, body
+
+    def session(self, client, rng):
+        username, (session_token, update_token) = self._pick_session(rng)
+        if username is None:
+            return 0, None
+        status, body = client.request("POST", "/session/", headers={"Authorization": "Bearer " + update_token})
+        self._remember(username, body)
+        return status, body
+
+    def secret(self, client, rng):
+        username, tokens = self._pick_session(rng)
+        if username is None:
+            return 0, None
+        status, body = client.request("GET", "/secret/", headers={"Authorization": "Bearer " + tokens[0]})
+        with self.lock:
+            self.sessions.setdefault(username, tokens)
+        return status, body
+
+
+#run one scenario requests times across workers threads
+def run_scenario(name, scenarios, make_client, requests, workers, seed):
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    per_worker = [requests // workers + (1 if i < requests % workers else 0) for i in range(workers)]
+
+    def work(index, count):
+        client = make_client()
+        rng = random.Random("%s-%s-%d" % (seed, name, index))
+        action = getattr(scenarios, name)
+        mine = []
+        failed = 0
+        for _ in range(count):
+            started = time.perf_counter()
+            status, body = action(client, rng)
+            elapsed = time.perf_counter() - started
+            if status == 0:
+                continue
+            mine.append(elapsed)
+            if not succeeded(status, body):
+                failed += 1
+        with lock:
+            latencies.extend(mine)
+            errors[0] += failed
+
+    threads = [threading.Thread(target=work, args=(i, n)) for i, n in enumerate(per_worker) if n]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    wall = time.perf_counter() - started
+    return summarize(latencies, errors[0], wall)
+
+def percentile(ordered, p):
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, int(round(p / 100.0 * (len(ordered) - 1))))]
+
+def summarize(latencies, errors, wall):
+    ordered = sorted(latencies)
+    return {
+        "requests": len(ordered),
+        "errors": errors,
+        "throughput": len(ordered) / wall if wall > 0 else 0.0,
+        "p50_ms": percentile(ordered, 50) * 1000,
+        "p95_ms": percentile(ordered, 95) * 1000,
+        "p99_ms": percentile(ordered, 99) * 1000,
+    }
+
+
+#slower p95 or lower throughput than the baseline by more than tolerance
+def regressions(results, baseline, tolerance):
+    found = []
+    for name, current in results["scenarios"].items():
+        previous = baseline.get("scenarios", {}).get(name)
+        if previous is None or not previous["requests"] or not current["requests"]:
+            continue
+        if current["p95_ms"] > previous["p95_ms"] * (1 + tolerance):
+            found.append("%s: p95 %.2fms -> %.2fms" % (name, previous["p95_ms"], current["p95_ms"]))
+        if current["throughput"] < previous["throughput"] * (1 - tolerance):
+            found.append("%s: throughput %.0f/s -> %.0f/s" % (name, previous["throughput"], current["throughput"]))
+    return found
+
+def print_report(results):
+    print("%-18s %8s %7s %10s %9s %9s %9s" % ("scenario", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms"))
+    for name, r in results["scenarios"].items():
+        print("%-18s %8d %7d %10.0f %9.2f %9.2f %9.2f" % (
+            name, r["requests"], r["errors"], r["throughput"], r["p50_ms"], r["p95_ms"], r["p99_ms"]))
+    print("money conserved: %s (%s -> %s)" % (
+        results["money_conserved"], results["balance_before"], results["balance_after"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Kessef load and latency benchmark")
+    parser.add_argument("--app", choices=["app", "app1"], default="app")
+    parser.add_argument("--url", help="benchmark a running server instead of the test client")
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--transactions", type=int, default=100000)
+    parser.add_argument("--requests", type=int, default=500, help="requests per scenario")
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--scenarios", help="comma separated subset of scenarios")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="baseline JSON to check for regressions")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    args.save = os.path.abspath(args.save) if args.save else None
+    args.compare = os.path.abspath(args.compare) if args.compare else None
+
+    rng = random.Random(args.seed)
+    module = None
+    if args.url:
+        client = HTTPClient(args.url)
+        make_client = lambda: HTTPClient(args.url)
+        user_ids = seed_http(client, args.app, args.users, args.transactions, rng)
+    else:
+        workdir = tempfile.mkdtemp(prefix="kessef-bench-")
+        os.chdir(workdir)
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        module = __import__(args.app)
+        if args.app == "app":
+            seed_app(module, args.users, args.transactions, rng)
+        else:
+            seed_app1(module, args.users, args.transactions, rng)
+        user_ids = list(range(1, args.users + 1))
+        make_client = lambda: TestClient(module.app)
+        client = make_client()
+        print("seeded %d users and %d transactions in %s" % (args.users, args.transactions, workdir))
+
+    if not wait_for_replica(client, user_ids):
+        print("warning: the read replica did not catch up with the seeded data", file=sys.stderr)
+    scenarios = Scenarios(args.app, user_ids, args.seed)
+    names = args.scenarios.split(",") if args.scenarios else scenarios.names()
+    before = total_balance(args.app, module, client, user_ids)
+    results = {"app": args.app, "config": vars(args), "scenarios": {}}
+    for name in names:
+        results["scenarios"][name] = run_scenario(name, scenarios, make_client, args.requests, args.workers, args.seed)
+    after = total_balance(args.app, module, client, user_ids)
+    results.update(balance_before=before, balance_after=after, money_conserved=before == after)
+
+    print_report(results)
+    if args.save:
+        with open(args.save, "w") as f:
+            json.dump(results, f, indent=2)
+    failed = not results["money_conserved"]
+    if args.compare:
+        with open(args.compare) as f:
+            found = regressions(results, json.load(f), args.tolerance)
+        for line in found:
+            print("REGRESSION " + line)
+        failed = failed or bool(found)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,307 @@
+import csv
+import datetime
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import sys
+
+import connection_pool
+import ledger
+import rollups
+
+
+# Streaming bulk import/export of the user and transactions tables as CSV or JSON lines,
+# for todo.db (db.DatabaseDriver) and auth.db (the db1 models) alike. Columns are matched
+# by name against the table and extra ones are ignored, so transaction files load into
+# either; user files differ in the password column (PASSWORD vs password_digest).
+# python bulk.py import|export <database file> user|transactions <file>
+
+FORMATS = ("csv", "jsonl")
+MIMETYPES = {"csv": "text/csv", "jsonl": "application/x-ndjson"}
+TABLES = ("user", "transactions")
+# columns the HTTP export routes leave out
+SECRET_COLUMNS = ("password", "password_digest", "session_token", "session_expiration", "update_token")
+
+# rows per executemany
+CHUNK_SIZE = 10000
+
+# for the import connection only: a bigger page cache and in-memory sorting for the index builds
+IMPORT_PRAGMAS = [
+    ("cache_size", -200000),
+    ("temp_store", "MEMORY"),
+]
+
+
+def connect(filename, pragmas=()):
+    conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+    for name, value in list(connection_pool.DEFAULT_PRAGMAS) + list(pragmas):
+        conn.execute("PRAGMA %s = %s;" % (name, value))
+    return conn
+
+
+#lower-case column names in table order
+def table_columns(conn, table):
+    if table not in TABLES:
+        raise ValueError("table must be one of %s" % ", ".join(TABLES))
+    return [row[1].lower() for row in conn.execute('PRAGMA table_info("%s");' % table)]
+
+
+#csv or jsonl from a file's extension, csv when there is none
+def format_of(path):
+    extension = os.path.splitext(path)[1].lstrip(".").lower()
+    if extension in ("json", "jsonl", "ndjson"):
+        return "jsonl"
+    return "csv"
+
+
+#dicts from an iterable of text lines (an open file, a request stream decoded to str)
+def read_rows(lines, fmt="csv"):
+    if fmt == "csv":
+        return csv.DictReader(lines)
+    if fmt == "jsonl":
+        return (json.loads(line) for line in lines if line.strip())
+    raise ValueError("format must be one of %s" % ", ".join(FORMATS))
+
+
+#columns that take "true"/"false" from a file as booleans
+BOOLEAN_COLUMNS = ("accepted", "requested")
+BOOLEAN_STRINGS = {"true": True, "false": False}
+
+
+def _to_boolean(value):
+    if isinstance(value, str):
+        return BOOLEAN_STRINGS.get(value.lower(), value)
+    return value
+
+def _empty_to_null(value):
+    return None if value == "" else value
+
+#(column, conversion) for the columns whose file values need one: "true"/"false" in the
+#boolean columns, and "" (an empty CSV field) as NULL in nullable columns without text
+#affinity. Every other value, an empty name or a user called "true" included, goes in as is
+def _conversions(conn, table):
+    conversions = []
+    for _, name, declared_type, notnull, _, _ in conn.execute('PRAGMA table_info("%s");' % table).fetchall():
+        name = name.lower()
+        text = any(t in (declared_type or "").upper() for t in ("CHAR", "CLOB", "TEXT"))
+        if name in BOOLEAN_COLUMNS:
+            conversions.append((name, _to_boolean))
+        if not notnull and not text:
+            conversions.append((name, _empty_to_null))
+    return conversions
+
+
+def _chunks(rows, size, conversions=()):
+    chunk = []
+    for row in rows:
+        row = {key.lower(): value for key, value in row.items()}
+        for column, convert in conversions:
+            if column in row:
+                row[column] = convert(row[column])
+        chunk.append(row)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+#auth.db users need a bcrypt digest and session tokens; plain passwords are hashed a
+#chunk at a time across the password pool, which is slow, so large loads should bring
+#password_digest along (as exported). passwords is imported here as only auth.db needs bcrypt
+def _prepare_auth_users(chunk):
+    import passwords
+    plain = [row for row in chunk if not row.get("password_digest")]
+    if plain:
+        for row, digest in zip(plain, passwords.hash_passwords([row.pop("password") for row in plain])):
+            row["password_digest"] = digest
+    expiration = str(datetime.datetime.now() + datetime.timedelta(days=1))
+    for row in chunk:
+        if row.get("balance") is None:
+            row["balance"] = 0
+        for token in ("session_token", "update_token"):
+            if not row.get(token):
+                row[token] = hashlib.sha1(os.urandom(64)).hexdigest()
+        if not row.get("session_expiration"):
+            row["session_expiration"] = expiration
+    return chunk
+
+
+#non-unique CREATE INDEX indexes of the table: dropped for the load and rebuilt once at
+#the end, which is much cheaper than updating them row by row. Unique ones stay, so the
+#load still fails on duplicates instead of leaving an index that cannot be rebuilt
+def _deferrable_indexes(conn, table):
+    indexes = []
+    for _, name, unique, origin, _ in conn.execute('PRAGMA index_list("%s");' % table).fetchall():
+        if origin == "c" and not unique:
+            sql = conn.execute("SELECT sql FROM sqlite_master WHERE type = 'index' AND name = ?;", (name,)).fetchone()[0]
+            indexes.append((name, sql))
+    return indexes
+
+
+#insert rows (dicts keyed by column name, extra keys ignored) with chunked executemany;
+#the columns come from the first row. Rows are copied as they are: imported transactions
+#do not move balances. Returns the row count.
+#By default the load is one transaction that drops the deferrable indexes and rebuilds
+#them before it commits, so no other connection ever sees the table without them and a
+#killed import leaves the database as it was. transaction_rows=N commits every N rows
+#instead (a long import then does not hold the write lock throughout), which keeps the
+#indexes in place: a commit must never publish the table without them
+def import_rows(conn, table, rows, chunk_size=CHUNK_SIZE, transaction_rows=None, defer_indexes=None):
+    if defer_indexes is None:
+        defer_indexes = transaction_rows is None
+    if defer_indexes and transaction_rows is not None:
+        raise ValueError("defer_indexes needs the import in one transaction (transaction_rows=None)")
+    columns = table_columns(conn, table)
+    prepare = _prepare_auth_users if table == "user" and "password_digest" in columns else None
+    chunks = _chunks(rows, chunk_size, _conversions(conn, table))
+    first = next(chunks, None)
+    if first is None:
+        return 0
+    if prepare is not None:
+        first = prepare(first)
+    names = [c for c in columns if c in first[0]]
+    sql = 'INSERT INTO "%s" (%s) VALUES (%s);' % (table, ", ".join(names), ", ".join("?" * len(names)))
+    indexes = _deferrable_indexes(conn, table) if defer_indexes else []
+    count = 0
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE;")
+    try:
+        for name, _ in indexes:
+            cur.execute('DROP INDEX "%s";' % name)
+        chunk = first
+        pending = 0
+        while chunk is not None:
+            cur.executemany(sql, [[row.get(c) for c in names] for row in chunk])
+            count += len(chunk)
+            pending += len(chunk)
+            if transaction_rows is not None and pending >= transaction_rows:
+                cur.execute("COMMIT;")
+                cur.execute("BEGIN IMMEDIATE;")
+                pending = 0
+            chunk = next(chunks, None)
+            if chunk is not None and prepare is not None:
+                chunk = prepare(chunk)
+        for _, index_sql in indexes:
+            cur.execute(index_sql)
+    except BaseException:
+        cur.execute("ROLLBACK;")
+        raise
+    cur.execute("COMMIT;")
+    return count
+
+
+#every row of the table as a dict in id order, chunk_size rows per keyset query, so
+#memory stays flat and no read transaction is held for the whole export. expressions
+#replaces columns with SQL, e.g. {"balance": ledger.balance_sql("user.ID")}
+def export_rows(conn, table, columns=None, expressions=None, after=0, chunk_size=CHUNK_SIZE):
+    if columns is None:
+        columns = table_columns(conn, table)
+    columns = ["id"] + [c for c in columns if c != "id"]
+    expressions = expressions or {}
+    sql = 'SELECT %s FROM "%s" WHERE ID > ? ORDER BY ID LIMIT ?;' % (
+        ", ".join(expressions.get(c, c) for c in columns), table
+    )
+    while True:
+        rows = conn.execute(sql, (after, chunk_size)).fetchall()
+        for row in rows:
+            yield dict(zip(columns, (v.decode("utf8") if isinstance(v, bytes) else v for v in row)))
+        if len(rows) < chunk_size:
+            return
+        after = rows[-1][0]
+
+
+#text lines of a file for export_rows(), header first for csv
+def encode_rows(rows, fmt="csv"):
+    if fmt == "jsonl":
+        return (json.dumps(row) + "\n" for row in rows)
+    if fmt == "csv":
+        return _csv_lines(rows)
+    raise ValueError("format must be one of %s" % ", ".join(FORMATS))
+
+
+def _csv_lines(rows):
+    buffer = io.StringIO()
+    writer = None
+    for row in rows:
+        if writer is None:
+            writer = csv.DictWriter(buffer, list(row))
+            writer.writeheader()
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+
+
+#import_rows()/export_rows() on a connection of their own, for callers holding a file name
+def import_file(filename, table, lines, fmt="csv", **options):
+    conn = connect(filename, IMPORT_PRAGMAS)
+    try:
+        return import_rows(conn, table, read_rows(lines, fmt), **options)
+    finally:
+        conn.close()
+
+
+def export_file(filename, table, fmt="csv", columns=None, expressions=None):
+    conn = connect(filename)
+    try:
+        for line in encode_rows(export_rows(conn, table, columns, expressions), fmt):
+            yield line
+    finally:
+        conn.close()
+
+
+#the public columns of the table, for the HTTP export routes
+def public_columns(filename, table):
+    conn = connect(filename)
+    try:
+        return [c for c in table_columns(conn, table) if c not in SECRET_COLUMNS]
+    finally:
+        conn.close()
+
+
+#step(cursor) in one write transaction on a connection of its own
+def _write(filename, step):
+    conn = connect(filename)
+    try:
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            result = step(cur)
+        except BaseException:
+            cur.execute("ROLLBACK;")
+            raise
+        cur.execute("COMMIT;")
+        return result
+    finally:
+        conn.close()
+
+
+#python bulk.py import todo.db user users.csv | export auth.db transactions transactions.jsonl
+#(the database has to exist, start the app on it once; - reads stdin or writes stdout as csv)
+if __name__ == "__main__":
+    if len(sys.argv) != 5 or sys.argv[1] not in ("import", "export"):
+        print("usage: python bulk.py import|export <database file> user|transactions <csv or jsonl file>")
+        sys.exit(1)
+    command, filename, table, path = sys.argv[1:]
+    fmt = format_of(path)
+    if command == "import":
+        source = sys.stdin if path == "-" else open(path, newline="")
+        with source:
+            count = import_file(filename, table, source, fmt)
+        # what DatabaseDriver.import_rows and db1.import_rows do after an import
+        if table == "user" and ledger.ENABLED:
+            _write(filename, ledger.Ledger().open_missing_accounts)
+        if table == "transactions" and rollups.ENABLED:
+            _write(filename, rollups.Rollups().rebuild)
+        print("imported %d rows into %s" % (count, table), file=sys.stderr)
+    else:
+        expressions = None
+        if table == "user" and ledger.ENABLED:
+            expressions = {"balance": ledger.balance_sql("user.ID")}
+        target = sys.stdout if path == "-" else open(path, "w", newline="")
+        with target:
+            for line in export_file(filename, table, fmt, expressions=expressions):
+                target.write(line)
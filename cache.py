@@ -0,0 +1,90 @@
+import collections
+import os
+import threading
+import time
+
+
+# entries per cache (users in db.py, first feed pages in feed.py), 0 turns them off.
+# Invalidations stay within one process, so serve.py turns them off for multiple workers
+CACHE_SIZE = int(os.environ.get("CACHE_SIZE", 10000))
+
+
+class LRUCache(object):
+    """
+    Bounded least-recently-used cache whose entries also expire after ttl seconds.
+
+    Reads that miss go to the database and store the result with fill(). To keep a
+    slow reader from storing a value that a writer has already replaced, begin_fill()
+    hands out the current generation of the key's stripe and fill() only stores if no
+    invalidate() touched that stripe in the meantime.
+    """
+
+    def __init__(self, max_size=10000, ttl=30, stripes=1024):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.generations = [0] * stripes
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.rejected_fills = 0
+
+    def _stripe(self, key):
+        return hash(key) % len(self.generations)
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def begin_fill(self, key):
+        with self.lock:
+            return self.generations[self._stripe(key)]
+
+    def fill(self, key, value, token):
+        with self.lock:
+            if self.generations[self._stripe(key)] != token:
+                self.rejected_fills += 1
+                return False
+            self.entries[key] = (time.monotonic() + self.ttl, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+            return True
+
+    def invalidate(self, *keys):
+        with self.lock:
+            for key in keys:
+                self.generations[self._stripe(key)] += 1
+                self.entries.pop(key, None)
+                self.invalidations += 1
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.generations = [g + 1 for g in self.generations]
+
+    def stats(self):
+        with self.lock:
+            return {
+                "size": len(self.entries),
+                "max_size": self.max_size,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "invalidations": self.invalidations,
+                "rejected_fills": self.rejected_fills,
+            }
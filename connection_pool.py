@@ -0,0 +1,158 @@
+import queue
+import sqlite3
+import threading
+import time
+
+
+#PRAGMAs applied to every new connection
+DEFAULT_PRAGMAS = [
+    ("journal_mode", "WAL"),     # readers don't block on the writer and vice versa
+    ("synchronous", "NORMAL"),   # fsync at checkpoints only, safe with WAL
+    ("busy_timeout", 5000),      # wait up to 5s for the write lock instead of failing
+    ("cache_size", -20000),      # ~20MB page cache per connection
+    ("foreign_keys", 1),
+]
+
+
+class TracedCursor(sqlite3.Cursor):
+    # times every statement and reports it to the connection's listeners
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            self.connection.notify(sql, parameters, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            self.connection.notify(sql, None, time.perf_counter() - started)
+
+
+class TracedConnection(sqlite3.Connection):
+    """
+    sqlite3 connection whose statements and commits are passed to
+    listener(statement, parameters, seconds) callables; a commit is reported as "COMMIT".
+    Only used when the pool is created with traced=True.
+    """
+
+    listeners = ()
+
+    def cursor(self, factory=TracedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+    def commit(self):
+        started = time.perf_counter()
+        try:
+            return super().commit()
+        finally:
+            self.notify("COMMIT", None, time.perf_counter() - started)
+
+    def notify(self, sql, parameters, seconds):
+        for listener in self.listeners:
+            listener(sql, parameters, seconds)
+
+
+class _Lease(object):
+    # returns the connection to the pool if its thread exits without releasing it
+    def __init__(self, pool, conn):
+        self.pool = pool
+        self.conn = conn
+
+    def __del__(self):
+        if self.conn is not None:
+            self.pool._checkin(self.conn)
+            self.conn = None
+
+
+class ConnectionPool(object):
+    """
+    Bounded pool of sqlite3 connections to one database file.
+    The first call to connection() in a thread checks a connection out for that
+    thread, later calls return the same one until release() hands it back.
+    With traced=True connections report their statements to the callables in listeners.
+    """
+
+    def __init__(self, filename, size=16, timeout=30, pragmas=DEFAULT_PRAGMAS, cached_statements=256,
+                 traced=False):
+        self.filename = filename
+        self.size = size
+        self.timeout = timeout
+        self.pragmas = pragmas
+        self.cached_statements = cached_statements
+        self.traced = traced
+        self.listeners = []
+        self.idle = queue.LifoQueue()
+        self.slots = threading.BoundedSemaphore(size)
+        self.local = threading.local()
+
+    #open and configure a new connection, sqlite3 keeps up to cached_statements
+    #prepared statements per connection so repeated queries skip the parser
+    def connect(self):
+        factory = TracedConnection if self.traced else sqlite3.Connection
+        conn = sqlite3.connect(
+            self.filename, check_same_thread=False, cached_statements=self.cached_statements,
+            factory=factory
+        )
+        if self.traced:
+            conn.listeners = self.listeners
+        for name, value in self.pragmas:
+            conn.execute("PRAGMA %s = %s;" % (name, value))
+        return conn
+
+    #the calling thread's connection
+    def connection(self):
+        pinned = getattr(self.local, "pinned", None)
+        if pinned is not None:
+            return pinned
+        lease = getattr(self.local, "lease", None)
+        if lease is not None:
+            return lease.conn
+        if not self.slots.acquire(timeout=self.timeout):
+            raise Exception("Timed out waiting for a database connection")
+        try:
+            conn = self.idle.get_nowait()
+        except queue.Empty:
+            try:
+                conn = self.connect()
+            except Exception:
+                self.slots.release()
+                raise
+        self.local.lease = _Lease(self, conn)
+        return conn
+
+    #make conn (from connect(), outside the pool's slots) the calling thread's connection
+    #for good, for a long-lived thread that must never wait for one (the group-commit writer)
+    def pin(self, conn):
+        self.local.pinned = conn
+
+    #give the calling thread's connection back, rolling back anything left open
+    def release(self):
+        lease = getattr(self.local, "lease", None)
+        if lease is None:
+            return
+        self.local.lease = None
+        conn, lease.conn = lease.conn, None
+        self._checkin(conn)
+
+    def _checkin(self, conn):
+        if conn.in_transaction:
+            conn.rollback()
+        self.idle.put(conn)
+        self.slots.release()
+
+    #close every idle connection (checked out ones are closed when released)
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
@@ -1,19 +1,190 @@
+import contextlib
+import json
 import os
-import sqlite3
+import queue
+import re
+import threading
+import time
 
 import datetime
 import hashlib
 
+import bulk
+import cache
+import connection_pool
+import feed
+import history
+import ledger
+import migrations
+import replica
+import rollups
 
-#helper functions
-def parse_row(row, columns):
-    parsed_row = {}
-    for i in range(len(columns)):
-        parsed_row[columns[i]] = row[i]
-    return parsed_row
 
-def parse_cursor(cursor, columns):
-    return [parse_row(row, columns) for row in cursor]
+#seconds a write waits for the group-commit writer to start it before giving up
+WRITE_TIMEOUT = 30
+
+USER_FIELDS = ["id", "name", "username", "email", "password", "balance"]
+USER_FIELD_POSITIONS = {f: i for i, f in enumerate(USER_FIELDS)}
+
+
+#the same exception for the column and the ledger balances
+InsufficientFunds = ledger.InsufficientFunds
+
+
+#row records
+class Record(object):
+    """
+    Read-only query row backed by the sqlite3 row tuple, readable like a dict
+    (record["balance"]) and turned into one only when it is encoded for a response.
+    extra holds values added on top of the columns, e.g. a user's transactions;
+    a key in extra that is also a column replaces the column's value in place.
+    """
+    __slots__ = ("row", "extra")
+    FIELDS = ()
+    POSITIONS = {}
+
+    def __init__(self, row, extra=None):
+        self.row = row
+        self.extra = extra
+
+    @classmethod
+    def row_factory(cls, cursor, row):
+        return cls(row)
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            return self.extra[key]
+        return self.row[self.POSITIONS[key]]
+
+    def __contains__(self, key):
+        return key in self.POSITIONS or (self.extra is not None and key in self.extra)
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def serialize(self):
+        data = dict(zip(self.FIELDS, self.row))
+        if self.extra:
+            data.update(self.extra)
+        return data
+
+    def __repr__(self):
+        return "%s(%r)" % (type(self).__name__, self.serialize())
+
+
+_record_types = {}
+
+#Record subclass for a column layout, positions are worked out once per layout
+def record_type(name, fields):
+    fields = tuple(fields)
+    key = (name, fields)
+    if key not in _record_types:
+        _record_types[key] = type(name, (Record,), {
+            "__slots__": (),
+            "FIELDS": fields,
+            "POSITIONS": {f: i for i, f in enumerate(fields)},
+        })
+    return _record_types[key]
+
+TRANSACTION_FIELDS = ["id", "sender_id", "receiver_id", "amount", "accepted"]
+TRANSACTION_COLUMNS = ", ".join(TRANSACTION_FIELDS)
+
+UserSummary = record_type("UserSummary", ["id", "name", "username"])
+User = record_type("User", USER_FIELDS)
+Transaction = record_type("Transaction", TRANSACTION_FIELDS)
+FeedItem = record_type("FeedItem", feed.FEED_FIELDS)
+
+
+class HistoryEntry(record_type("HistoryEntry", history.HISTORY_FIELDS)):
+    """
+    History row, serialized by history.serialize like app1's so accepted comes out as a bool.
+    """
+    __slots__ = ()
+
+    def serialize(self):
+        return history.serialize(self.row)
+
+def iter_records(cursor, chunk_size=500):
+    while True:
+        rows = cursor.fetchmany(chunk_size)
+        if not rows:
+            return
+        for row in rows:
+            yield row
+
+
+#JSON rendering
+class RawJSON(str):
+    """
+    JSON text that is already encoded, e.g. built by SQLite, and goes into the response as is.
+    For a list, count and last_id describe the rows in it.
+    """
+    count = 0
+    last_id = None
+
+
+def serialize_record(obj):
+    if isinstance(obj, Record):
+        return obj.serialize()
+    raise TypeError("Object of type %s is not JSON serializable" % type(obj).__name__)
+
+#encoder for the dict based payloads, JSON_ENCODER=orjson swaps it in when it is installed
+#(orjson writes compact, unescaped UTF-8, so its bytes differ from json.dumps')
+def load_json_encoder(name):
+    if name == "orjson":
+        try:
+            import orjson
+        except ImportError:
+            orjson = None
+        if orjson is not None:
+            return lambda data: orjson.dumps(data, default=serialize_record).decode("utf8")
+    return lambda data: json.dumps(data, default=serialize_record)
+
+json_encoder = load_json_encoder(os.environ.get("JSON_ENCODER", "json"))
+
+def encode_json(data):
+    if isinstance(data, RawJSON):
+        return data
+    return json_encoder(data)
+
+#SQL expressions that render a row as the same text json.dumps writes for its dict: ", " and ": "
+#separators, values through json_quote(), which escapes strings as json.dumps does except
+#for non-ASCII characters (left to ascii_json)
+def json_object_sql(members):
+    return "('{' || %s || '}')" % " || ', ' || ".join("'\"%s\": ' || %s" % member for member in members)
+
+def json_columns_sql(fields, columns):
+    return [(field, "json_quote(%s)" % column) for field, column in zip(fields, columns)]
+
+def json_array_sql(item):
+    return "('[' || COALESCE(group_concat(%s, ', '), '') || ']')" % item
+
+_NON_ASCII = re.compile(r"[^\x00-\x7e]")
+
+def _escape_non_ascii(match):
+    code = ord(match.group(0))
+    if code < 0x10000:
+        return "\\u%04x" % code
+    code -= 0x10000
+    return "\\u%04x\\u%04x" % (0xd800 | (code >> 10), 0xdc00 | (code & 0x3ff))
+
+#json.dumps' ensure_ascii for JSON text built by SQLite, which keeps non-ASCII characters and DEL as they are
+def ascii_json(text):
+    return RawJSON(_NON_ASCII.sub(_escape_non_ascii, text))
+
+#Record.serialize() payloads rendered by SQLite, see json_object_sql()
+USER_SUMMARY_JSON = json_object_sql(json_columns_sql(UserSummary.FIELDS, ["ID", "NAME", "USERNAME"]))
+TRANSACTION_JSON = json_object_sql(json_columns_sql(
+    Transaction.FIELDS, ["ID", "SENDER_ID", "RECEIVER_ID", "AMOUNT", "ACCEPTED"]
+))
+
+#a user with its sent transactions, balance is DatabaseDriver.balance_column
+def user_with_transactions_json(balance):
+    transactions = "(SELECT %s FROM (SELECT %s AS item FROM transactions WHERE SENDER_ID = user.ID ORDER BY ID))" % (
+        json_array_sql("item"), TRANSACTION_JSON
+    )
+    columns = ["ID", "NAME", "USERNAME", "EMAIL", "PASSWORD", "(%s)" % balance]
+    return json_object_sql(json_columns_sql(USER_FIELDS, columns) + [("transactions", transactions)])
 
 
 class DatabaseDriver(object):
@@ -23,67 +194,200 @@ class DatabaseDriver(object):
     """
 
     #constructor for connection to SQL    
-    def __init__(self):
-        self.conn = sqlite3.connect(
-            "todo.db", check_same_thread=False
-        )
-        self.conn.execute("PRAGMA foreign_keys = 1")
-        self.create_user_table()
-        self.create_transactions_table()
+    def __init__(self, filename="todo.db", pool_size=16, group_commit=False,
+                 max_batch_size=256, max_wait=0.001, cache_size=cache.CACHE_SIZE, cache_ttl=30, traced=False,
+                 use_ledger=False, use_feed=False, use_rollups=False, use_replica=False):
+        self.filename = filename
+        #traced=True times every statement, see add_query_listener()
+        self.pool = connection_pool.ConnectionPool(filename, size=pool_size, traced=traced)
+        self.replica = None
+        #user rows by id, cache_size=0 turns it off
+        self.user_cache = cache.LRUCache(cache_size, cache_ttl) if cache_size else None
+        self.local = threading.local()
+        #use_ledger=True keeps balances in ledger.Ledger instead of the BALANCE column
+        self.ledger = ledger.Ledger() if use_ledger else None
+        self.balance_column = ledger.balance_sql("user.ID") if use_ledger else "BALANCE"
+        self.user_json = user_with_transactions_json(self.balance_column)
+        #use_feed=True fans accepted transactions out into follower timelines
+        self.feed = feed.Feed(cache_size=cache_size, cache_ttl=cache_ttl) if use_feed else None
+        #use_rollups=True keeps per-user and per-day totals (see get_statement)
+        self.rollups = rollups.Rollups() if use_rollups else None
+        self.migrate()
+        if self.ledger is not None:
+            self.open_ledger_accounts()
+        if self.rollups is not None and self.rollups.is_empty(self.conn.cursor()):
+            self.rebuild_rollups()
+        self.release()
+        #use_replica=True lets threads read from a snapshot copy, see replica.Replica.use()
+        if use_replica:
+            self.replica = replica.Replica(filename)
+            self.replica_pool = connection_pool.ConnectionPool(self.replica.path, size=pool_size, traced=traced)
+        self.writer = None
+        if group_commit:
+            self.writer = GroupCommitWriter(self, max_batch_size, max_wait)
 
-    #create datatable   
-    def create_user_table(self):
-        try:
-            self.conn.execute(
-                """
-                CREATE TABLE user (
-                    ID INTEGER PRIMARY KEY,
-                    NAME TEXT NOT NULL,
-                    USERNAME CHAR(50),
-                    EMAIL TEXT NOT NULL,
-                    PASSWORD TEXT NOT NULL,
-                    BALANCE INTEGER
-                );
-                """
-            )
-        except Exception as e:
-            print(e)
-       
-    def create_transactions_table(self):
-        try:
-            self.conn.execute(
-                """
-                CREATE TABLE transactions (
-                    ID INTEGER PRIMARY KEY,
-                    SENDER_ID INTEGER SECONDARY KEY NOT NULL,
-                    RECEIVER_ID INTEGER SECONDARY KEY NOT NULL,
-                    AMOUNT INTEGER,
-                    ACCEPTED BOOL
-                );
-                """
-            )
-        except Exception as e:
-            print(e)
+    #the calling thread's connection, checked out of the pool on first use; a replica
+    #connection while the thread reads from the replica
+    @property
+    def conn(self):
+        if self.replica is not None and self.replica.active():
+            return self.replica_pool.connection()
+        return self.pool.connection()
+
+    #hand the calling thread's connection back to the pool (end of a request)
+    def release(self):
+        self.pool.release()
+        if self.replica is not None:
+            self.replica.use(False)
+            self.replica_pool.release()
+
+    #rows read from the replica can be older than the cache, so they are not cached
+    def on_replica(self):
+        return self.replica is not None and self.replica.active()
+
+    #count a commit towards the next replica refresh
+    def committed(self):
+        if self.replica is not None:
+            self.replica.note_commit()
+
+    #listener(statement, parameters, seconds) is called after every statement and commit
+    #(needs traced=True)
+    def add_query_listener(self, listener):
+        self.pool.listeners.append(listener)
+
+    #create/upgrade datatables to the latest schema version
+    def migrate(self):
+        return migrations.migrate(self.conn, migrations.DRIVER_MIGRATIONS)
+
+    #opening ledger entries for users added without one (e.g. before the ledger was on)
+    def open_ledger_accounts(self):
+        with self.transaction() as cur:
+            return self.ledger.open_missing_accounts(cur)
 
-         
-    #delete datatable   
+    #snapshot every ledger account, see ledger.Ledger.compact()
+    def compact_ledger(self, prune=False):
+        with self.transaction() as cur:
+            return self.ledger.compact(cur, prune)
+
+    #recompute the rollups from the transactions table (after running without them)
+    def rebuild_rollups(self):
+        with self.transaction() as cur:
+            return self.rollups.rebuild(cur)
+
+    #dict of user_id's totals from start to end (dates) per day or month, see rollups.py
+    def get_statement(self, user_id, start, end, period="day"):
+        return self.rollups.statement(self.conn.cursor(), user_id, start, end, period)
+
+    #bulk load "user" or "transactions" rows from CSV or JSON lines on a connection of its
+    #own, see bulk.import_rows(); cached users are dropped and, with the ledger on,
+    #imported users get their opening entries
+    def import_rows(self, table, lines, fmt="csv", **options):
+        count = bulk.import_file(self.filename, table, lines, fmt, **options)
+        if table == "transactions" and self.rollups is not None:
+            self.rebuild_rollups()
+        if table == "user":
+            if self.ledger is not None:
+                self.open_ledger_accounts()
+            if self.user_cache is not None:
+                self.user_cache.clear()
+        return count
+
+    #every row of the table as CSV or JSON lines, generated a chunk at a time for a file
+    #or a streamed response; balances are exported as the app reports them
+    def export_lines(self, table, fmt="csv", columns=None):
+        expressions = {"balance": self.balance_column} if table == "user" else None
+        return bulk.export_file(self.filename, table, fmt, columns, expressions)
+
+    #delete datatable (resets the schema version so it is recreated on the next startup)
     def delete_user_table(self):
         self.conn.execute("DROP TABLE IF EXISTS user;")
+        migrations.set_version(self.conn, 0)
+        if self.user_cache is not None:
+            self.user_cache.clear()
     
     def delete_transactions_table(self):
         self.conn.execute("DROP TABLE IF EXISTS transactions;")
+        migrations.set_version(self.conn, 0)
     
     
     #get all users/transactions
+    #run a query whose rows come back as record instances
+    def query(self, record, sql, params=()):
+        cursor = self.conn.cursor()
+        cursor.row_factory = record.row_factory
+        return cursor.execute(sql, params)
+
     def get_all_users(self):
-        cursor = self.conn.execute("SELECT * FROM user;")
-        users = parse_cursor(cursor, ["id", "name", "username"])
-        return users
+        cursor = self.query(UserSummary, "SELECT ID, NAME, USERNAME FROM user;")
+        return cursor.fetchall()
 
     def get_all_transactions(self):
-        cursor = self.conn.execute("SELECT * FROM transactions;")
-        transactions = parse_cursor(cursor, ["id", "sender_id", "receiver_id", "amount", "accepted"])
-        return transactions
+        cursor = self.query(Transaction, "SELECT %s FROM transactions;" % TRANSACTION_COLUMNS)
+        return cursor.fetchall()
+
+    #get one page of users/transactions, keyed on id (keyset pagination)
+    def get_users_page(self, limit, after=0):
+        cursor = self.query(
+            UserSummary, "SELECT ID, NAME, USERNAME FROM user WHERE ID > ? ORDER BY ID LIMIT ?;", (after, limit)
+        )
+        return cursor.fetchall()
+
+    def get_transactions_page(self, limit, after=0):
+        cursor = self.query(
+            Transaction,
+            "SELECT %s FROM transactions WHERE ID > ? ORDER BY ID LIMIT ?;" % TRANSACTION_COLUMNS,
+            (after, limit)
+        )
+        return cursor.fetchall()
+
+    #stream users/transactions straight off the cursor, chunk_size rows at a time
+    def iter_users(self, after=0, chunk_size=500):
+        cursor = self.query(UserSummary, "SELECT ID, NAME, USERNAME FROM user WHERE ID > ? ORDER BY ID;", (after,))
+        return iter_records(cursor, chunk_size)
+
+    def iter_transactions(self, after=0, chunk_size=500):
+        cursor = self.query(
+            Transaction, "SELECT %s FROM transactions WHERE ID > ? ORDER BY ID;" % TRANSACTION_COLUMNS, (after,)
+        )
+        return iter_records(cursor, chunk_size)
+
+
+    #the same payloads rendered to JSON by SQLite, returned as RawJSON
+    def __json_array(self, item, query, params=()):
+        cursor = self.conn.execute(
+            "SELECT %s, COUNT(*), MAX(id) FROM (SELECT ID AS id, %s AS item %s);"
+            % (json_array_sql("item"), item, query),
+            params
+        )
+        text, count, last_id = cursor.fetchone()
+        data = ascii_json(text)
+        data.count = count
+        data.last_id = last_id
+        return data
+
+    def get_all_users_json(self):
+        return self.__json_array(USER_SUMMARY_JSON, "FROM user ORDER BY ID")
+
+    def get_all_transactions_json(self):
+        return self.__json_array(TRANSACTION_JSON, "FROM transactions ORDER BY ID")
+
+    def get_users_page_json(self, limit, after=0):
+        return self.__json_array(USER_SUMMARY_JSON, "FROM user WHERE ID > ? ORDER BY ID LIMIT ?", (after, limit))
+
+    def get_transactions_page_json(self, limit, after=0):
+        return self.__json_array(TRANSACTION_JSON, "FROM transactions WHERE ID > ? ORDER BY ID LIMIT ?", (after, limit))
+
+    def get_transactions_of_user_json(self, sender_id):
+        return self.__json_array(TRANSACTION_JSON, "FROM transactions WHERE SENDER_ID = ? ORDER BY ID", (sender_id,))
+
+    def get_user_json(self, id):
+        cursor = self.conn.execute(
+            "SELECT %s FROM user WHERE ID = ?;" % self.user_json, (id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return ascii_json(row[0])
 
 
     #insert user/transaction into table
@@ -92,149 +396,601 @@ class DatabaseDriver(object):
         cur.execute(
             "INSERT INTO user (NAME, USERNAME, EMAIL, PASSWORD, BALANCE) VALUES (?, ?, ?, ?, ?);", (name, username, email, password, balance)
         )
+        if self.ledger is not None:
+            self.ledger.open_account(cur, cur.lastrowid, balance)
         self.conn.commit()
+        self.committed()
         return cur.lastrowid
 
-    def insert_transactions_table(self, sender_id, receiver_id, amount, accepted):
+    def insert_transactions_table(self, sender_id, receiver_id, amount, accepted, requested=False):
         cur = self.conn.cursor()
+        created_at = rollups.now()
         cur.execute(
-            "INSERT INTO transactions (SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED) VALUES (?, ?, ?, ?);", (sender_id, receiver_id, amount, accepted)
+            "INSERT INTO transactions (SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED, REQUESTED, CREATED_AT) VALUES (?, ?, ?, ?, ?, ?);",
+            (sender_id, receiver_id, amount, accepted, requested, created_at)
         )
+        if self.rollups is not None:
+            self.rollups.apply(cur, added=[(sender_id, receiver_id, amount, requested, accepted, created_at)])
         self.conn.commit()
+        self.committed()
         return cur.lastrowid
     
     
     
     #get user/transaction by attributes
 
+    #full user with every transaction they sent
     def get_user_by_id(self, id):
-        cursor = self.conn.execute("SELECT * FROM user WHERE ID = ?", (id,))
-        for row in cursor:
-            data = parse_row(row, ["id", "name", "username", "email", "password", "balance"])
-            data["transactions"] = self.get_transactions_of_user(id)
-            return data
-        return None
+        return self.get_user(id, include_transactions=True)
+
+    #only the requested columns (all of them if fields is None), transactions on request.
+    #With the user cache on, the whole row is cached and projected here
+    def get_user(self, id, fields=None, include_transactions=False):
+        if fields is None:
+            fields = USER_FIELDS
+        else:
+            fields = [f for f in USER_FIELDS if f in fields] or ["id"]
+        record = User if fields == USER_FIELDS else record_type("User", fields)
+        if self.user_cache is None:
+            cursor = self.conn.execute(
+                "SELECT %s FROM user WHERE ID = ?;" % self.__user_columns(fields), (id,)
+            )
+            row = cursor.fetchone()
+        else:
+            row = self.__get_cached_user_row(id)
+            if row is not None and record is not User:
+                row = tuple(row[USER_FIELD_POSITIONS[f]] for f in fields)
+        if row is None:
+            return None
+        if include_transactions:
+            return record(row, {"transactions": self.get_transactions_of_user(id)})
+        return record(row)
+
+    def __get_cached_user_row(self, id):
+        row = self.user_cache.get(id)
+        if row is not None:
+            return row
+        token = self.user_cache.begin_fill(id)
+        cursor = self.conn.execute(
+            "SELECT %s FROM user WHERE ID = ?;" % self.__user_columns(USER_FIELDS), (id,)
+        )
+        row = cursor.fetchone()
+        if row is not None and not self.on_replica():
+            self.user_cache.fill(id, row, token)
+        return row
 
     def get_user_by_email(self, email):
-        cursor = self.conn.execute("SELECT * FROM user WHERE EMAIL = ?", (email,))
-        for row in cursor:
-            data = parse_row(row, ["id", "name", "username", "email", "password", "balance"])
-            return data
-        return None
+        cursor = self.query(User, "SELECT %s FROM user WHERE EMAIL = ?;" % self.__user_columns(USER_FIELDS), (email,))
+        return cursor.fetchone()
+
+    #select list for user fields, the balance comes from the ledger when it is on
+    def __user_columns(self, fields):
+        return ", ".join(self.balance_column if f == "balance" else f for f in fields)
     
     
     def get_transaction_by_id(self, transaction_id, message = None):
-        cursor = self.conn.execute("SELECT * FROM transactions WHERE ID = ?;", (transaction_id,))
-        for row in cursor:
-            data = parse_row(row, ["id", "sender_id", "receiver_id", "amount", "accepted"])
-            data["accepted"] = bool(data["accepted"])
-            data["message"] = message
-            return data
-        return None
+        cursor = self.conn.execute(
+            "SELECT %s FROM transactions WHERE ID = ?;" % TRANSACTION_COLUMNS, (transaction_id,)
+        )
+        row = cursor.fetchone()
+        if row is None:
+            return None
+        return Transaction(row, {"accepted": bool(row[4]), "message": message})
 
     
     def get_transactions_of_user(self, sender_id):
-        cursor = self.conn.execute("SELECT * FROM transactions WHERE sender_id = ?;", (sender_id,))
-        data = parse_cursor(cursor, ["id", "sender_id", "receiver_id", "amount", "accepted"])
-        return data
+        cursor = self.query(
+            Transaction, "SELECT %s FROM transactions WHERE SENDER_ID = ?;" % TRANSACTION_COLUMNS, (sender_id,)
+        )
+        return cursor.fetchall()
 
     
+    #a page of sent and received transactions, newest first; pass the last id as before
+    #for the next page. filters are history.FILTERS
+    def get_history(self, user_id, limit, before=None, **filters):
+        sql, params = history.history_query(user_id, limit, before, **filters)
+        return self.query(HistoryEntry, sql, params).fetchall()
+
+    #feeds
+    def follow(self, follower_id, followed_id):
+        self.feed.follow(self.conn.cursor(), follower_id, followed_id)
+        self.conn.commit()
+        self.committed()
+
+    def unfollow(self, follower_id, followed_id):
+        self.feed.unfollow(self.conn.cursor(), follower_id, followed_id)
+        self.conn.commit()
+        self.committed()
+
+    #newest first, pass the last id as before for the next page
+    def get_feed(self, user_id, limit, before=None):
+        rows = self.feed.page(self.conn.cursor(), user_id, limit, before, fill=not self.on_replica())
+        return [FeedItem(row) for row in rows]
+
     #delete user/transaction by id
+    #goes through the writer like the balance changes, so it cannot interleave with a payment
     def delete_user_by_id(self, id):
-        self.conn.execute(
+        return self.__write(self.__delete_user, id)
+
+    def delete_transaction_by_id(self, transaction_id):
+        return self.__write(self.__delete_transaction, transaction_id)
+
+
+       
+    #one BEGIN IMMEDIATE ... COMMIT block, rolled back if anything inside raises
+    @contextlib.contextmanager
+    def transaction(self):
+        conn = self.conn
+        cur = conn.cursor()
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            yield cur
+        except BaseException:
+            conn.rollback()
+            self.flush_touched_users(False)
+            raise
+        conn.commit()
+        self.committed()
+        self.flush_touched_users(True)
+
+    #runs operation(cur, *args) in its own transaction, or hands it to the group-commit
+    #writer when that is enabled; InsufficientFunds from the operation becomes False
+    def __write(self, operation, *args):
+        if self.writer is not None:
+            return self.writer.submit(operation, *args)
+        try:
+            with self.transaction() as cur:
+                return operation(cur, *args)
+        except InsufficientFunds:
+            return False
+
+    #handeling a transaction - sending money    
+    def send_money_by_user_id(self, sender_id, receiver_id, amount, message=None):
+        return self.__write(self.__send_money, sender_id, receiver_id, amount, message)
+
+    #pay many receivers from one sender in one transaction: a single debit for the total,
+    #one grouped credit per receiver and an insert per transfer. transfers is a list of
+    #(receiver_id, amount); returns a transaction id per transfer (None where the receiver
+    #does not exist), or False if the sender cannot cover the total
+    def send_money_batch(self, sender_id, transfers):
+        return self.__write(self.__send_money_batch, sender_id, transfers)
+
+    #handeling a transaction - requesting money   
+    def request_money_by_user_id(self, sender_id, receiver_id, amount):
+        transaction_id = self.insert_transactions_table(sender_id, receiver_id, amount, False, requested=True)
+        return transaction_id
+    
+    #the receiver of a request pays its sender, accepting twice is a no-op
+    def accept_transaction(self, transaction_id):
+        return self.__write(self.__accept_transaction, transaction_id)
+
+    #requests waiting for user_id to pay them, newest first
+    def get_pending_requests(self, user_id, limit, before=None):
+        return self.get_history(user_id, limit, before, direction="received", accepted=False)
+
+    #accept and deny many of user_id's pending requests in one transaction: one debit for
+    #the accepted total, grouped credits to the requesters, deletes for the denied ones.
+    #Ids that are not pending requests to user_id are skipped. Returns the (accepted,
+    #denied) ids, or False if the user cannot cover the accepted total
+    def answer_requests(self, user_id, accept_ids, deny_ids):
+        return self.__write(self.__answer_requests, user_id, accept_ids, deny_ids)
+
+
+    #write operations, each runs inside a transaction on cur and raises InsufficientFunds
+    #before writing anything when a balance does not cover the debit
+    def __send_money(self, cur, sender_id, receiver_id, amount, message=None):
+        created_at = rollups.now()
+        cur.execute(
+            "INSERT INTO transactions (SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED, CREATED_AT) VALUES (?, ?, ?, ?, ?);",
+            (sender_id, receiver_id, amount, True, created_at)
+        )
+        transaction_id = cur.lastrowid
+        self.transfer(cur, sender_id, receiver_id, amount, transaction_id)
+        self.fan_out(cur, [(transaction_id, sender_id, receiver_id, amount, message)])
+        if self.rollups is not None:
+            self.rollups.apply(cur, added=[(sender_id, receiver_id, amount, False, True, created_at)])
+        return transaction_id
+
+    def __send_money_batch(self, cur, sender_id, transfers):
+        results = [None] * len(transfers)
+        existing = self.__existing_user_ids(cur, set(r for r, _ in transfers))
+        valid = [(i, r, a) for i, (r, a) in enumerate(transfers) if r in existing]
+        if not valid:
+            return results
+        #SQLite picks each id and it is read back from lastrowid (executemany does not set
+        #it, and RETURNING needs SQLite 3.35); the statement is prepared once and cached
+        created_at = rollups.now()
+        rows = []
+        for i, receiver_id, amount in valid:
+            cur.execute(
+                "INSERT INTO transactions (SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED, CREATED_AT) VALUES (?, ?, ?, ?, ?);",
+                (sender_id, receiver_id, amount, True, created_at)
+            )
+            results[i] = cur.lastrowid
+            rows.append((cur.lastrowid, sender_id, receiver_id, amount, True, created_at))
+        self.fan_out(cur, [(t, s, r, a, None) for t, s, r, a, _, _ in rows])
+        if self.rollups is not None:
+            self.rollups.apply(cur, added=[(s, r, a, False, True, c) for _, s, r, a, _, c in rows])
+        if self.ledger is not None:
+            self.ledger.transfer_many(cur, sender_id, [(r, a, t) for t, _, r, a, _, _ in rows])
+            self.touch(sender_id, *set(r for _, r, _ in valid))
+            return results
+        self.__debit(cur, sender_id, sum(a for _, _, a in valid))
+        credits = {}
+        for _, receiver_id, amount in valid:
+            credits[receiver_id] = credits.get(receiver_id, 0) + amount
+        self.__credit(cur, credits)
+        self.touch(sender_id, *credits)
+        return results
+
+    def __answer_requests(self, cur, user_id, accept_ids, deny_ids):
+        pending = self.__pending_requests(cur, user_id, set(accept_ids) | set(deny_ids))
+        accepted = [t for t in dict.fromkeys(accept_ids) if t in pending]
+        denied = [t for t in dict.fromkeys(deny_ids) if t in pending]
+        if accepted:
+            if self.ledger is not None:
+                self.ledger.transfer_many(cur, user_id, [(pending[t][0], pending[t][1], t) for t in accepted])
+            else:
+                self.__debit(cur, user_id, sum(pending[t][1] for t in accepted))
+                credits = {}
+                for t in accepted:
+                    sender_id, amount, _ = pending[t]
+                    credits[sender_id] = credits.get(sender_id, 0) + amount
+                self.__credit(cur, credits)
+            self.touch(user_id, *set(pending[t][0] for t in accepted))
+            cur.executemany("UPDATE transactions SET ACCEPTED = 1, REQUESTED = 1 WHERE ID = ?;", [(t,) for t in accepted])
+            self.fan_out(cur, [(t, pending[t][0], user_id, pending[t][1], None) for t in accepted])
+        if denied:
+            cur.executemany("DELETE FROM transactions WHERE ID = ?;", [(t,) for t in denied])
+        if self.rollups is not None:
+            self.rollups.apply(
+                cur,
+                added=[(pending[t][0], user_id, pending[t][1], True, True, pending[t][2]) for t in accepted],
+                removed=[(pending[t][0], user_id, pending[t][1], True, False, pending[t][2]) for t in accepted + denied]
+            )
+        return accepted, denied
+
+    def __delete_user(self, cur, id):
+        cur.execute(
             """
             DELETE FROM user
             WHERE ID = ?;
             """,
             (id,)
         )
-        self.conn.commit()
+        if self.feed is not None:
+            self.feed.forget(cur, id)
+            self.touch_feeds([id])
+        if self.rollups is not None:
+            self.rollups.forget(cur, id)
+        self.touch(id)
 
-    def delete_transaction_by_id(self, transaction_id):
-        self.conn.execute(
+    def __delete_transaction(self, cur, transaction_id):
+        cur.execute(
+            "SELECT SENDER_ID, RECEIVER_ID, AMOUNT, REQUESTED, ACCEPTED, CREATED_AT FROM transactions WHERE ID = ?;",
+            (transaction_id,)
+        )
+        row = cur.fetchone()
+        cur.execute(
             """
             DELETE FROM transactions
             WHERE ID = ?;
             """,
             (transaction_id,)
         )
-        self.conn.commit()
-
-
-       
-    #handeling a transaction - sending money    
-    def send_money_by_user_id(self, sender_id, receiver_id, amount):
-        transaction_function = "send"
-        accepted_sender = self.__update_sender(sender_id, amount, transaction_function)
-        if accepted_sender == False:
-            return False
-        self.__update_receiver(receiver_id, amount, transaction_function)
-        transaction_id = self.insert_transactions_table(sender_id, receiver_id, amount, True)
-        return transaction_id
+        if row is not None and self.rollups is not None:
+            self.rollups.apply(cur, removed=[row])
 
-    #handeling a transaction - requesting money   
-    def request_money_by_user_id(self, sender_id, receiver_id, amount):
-        transaction_id = self.insert_transactions_table(sender_id, receiver_id, amount, False)
-        return transaction_id
-    
-    def accept_transaction(self, transaction_id):
-        transaction_data = self.get_transaction_by_id(transaction_id)
-        sender_id = transaction_data["sender_id"]
-        receiver_id = transaction_data["receiver_id"]
-        amount = transaction_data["amount"]
-        accepted_receiver = self.__update_receiver(receiver_id, amount, "request")
-        if accepted_receiver == False:
+    def __accept_transaction(self, cur, transaction_id):
+        cur.execute(
+            "SELECT SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED, CREATED_AT FROM transactions WHERE ID = ?;",
+            (transaction_id,)
+        )
+        row = cur.fetchone()
+        if row is None:
             return False
-        self.__update_sender(sender_id, amount, "request")
-        self.conn.execute(
+        sender_id, receiver_id, amount, accepted, created_at = row
+        if accepted:
+            return transaction_id
+        self.transfer(cur, receiver_id, sender_id, amount, transaction_id)
+        self.fan_out(cur, [(transaction_id, sender_id, receiver_id, amount, None)])
+        if self.rollups is not None:
+            self.rollups.apply(
+                cur,
+                added=[(sender_id, receiver_id, amount, True, True, created_at)],
+                removed=[(sender_id, receiver_id, amount, True, False, created_at)]
+            )
+        cur.execute(
             """
             UPDATE transactions
-            SET accepted = ?
+            SET accepted = ?, REQUESTED = 1
             WHERE ID = ?;
             """,
             (True, transaction_id)
         )
-        self.conn.commit()
-        return transaction_id      
+        return transaction_id
 
 
+    #user cache upkeep: writes touch() the users they change and the cached rows are
+    #dropped once the transaction commits, so a reader can never re-cache the old row
+    #after the invalidation. The debit check itself never reads the cache
+    def invalidate_users(self, *user_ids):
+        if self.user_cache is not None:
+            self.user_cache.invalidate(*user_ids)
+
+    def touch(self, *user_ids):
+        if self.user_cache is None:
+            return
+        touched = getattr(self.local, "touched", None)
+        if touched is None:
+            touched = self.local.touched = set()
+        touched.update(user_ids)
+
+    def flush_touched_users(self, committed):
+        touched = getattr(self.local, "touched", None)
+        if touched:
+            self.local.touched = None
+            if committed:
+                self.invalidate_users(*touched)
+        feeds = getattr(self.local, "touched_feeds", None)
+        if feeds:
+            self.local.touched_feeds = None
+            if committed:
+                self.feed.invalidate(feeds)
+
+    #write the accepted transactions into the feeds, the cached feeds go after commit like the users
+    def fan_out(self, cur, items):
+        if self.feed is None:
+            return
+        self.touch_feeds(self.feed.fan_out(cur, items))
+
+    def touch_feeds(self, user_ids):
+        touched = getattr(self.local, "touched_feeds", None)
+        if touched is None:
+            touched = self.local.touched_feeds = set()
+        touched.update(user_ids)
+
     #helper transaction methods
-    def __update_sender(self, sender_id, amount, transaction_function):
-        sender = self.get_user_by_id(sender_id)
-        balance  = int(sender["balance"])
-        if transaction_function == "send":
-            new_balance = balance - amount
-            if new_balance < 0:
-                return False
-        elif transaction_function == "request":
-            new_balance = balance + amount
-        self.conn.execute(
-            """
-            UPDATE user
-            SET balance = ?
-            WHERE ID = ?;
-            """,
-            (new_balance, sender_id)
-        )
-        self.conn.commit()
-        return True
-
-    def __update_receiver(self, receiver_id, amount, transaction_function):
-        receiver = self.get_user_by_id(receiver_id)
-        balance  = int(receiver["balance"])
-        if transaction_function == "send":
-            new_balance = balance + amount
-        elif transaction_function == "request":
-            new_balance = balance - amount
-            if new_balance < 0:
-                return False
-        self.conn.execute(
+    def __existing_user_ids(self, cur, user_ids, chunk_size=500):
+        user_ids = list(user_ids)
+        existing = set()
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            cur.execute(
+                "SELECT ID FROM user WHERE ID IN (%s);" % ", ".join("?" * len(chunk)), chunk
+            )
+            existing.update(row[0] for row in cur)
+        return existing
+
+    #{id: (sender_id, amount, created_at)} of the given ids that are pending requests to user_id,
+    #read on the (RECEIVER_ID, ACCEPTED, ID) index
+    def __pending_requests(self, cur, user_id, ids, chunk_size=500):
+        ids = list(ids)
+        pending = {}
+        for start in range(0, len(ids), chunk_size):
+            chunk = ids[start:start + chunk_size]
+            cur.execute(
+                "SELECT ID, SENDER_ID, AMOUNT, CREATED_AT FROM transactions WHERE RECEIVER_ID = ? AND ACCEPTED = 0 AND ID IN (%s);"
+                % ", ".join("?" * len(chunk)),
+                [user_id] + chunk
+            )
+            pending.update((t, (sender_id, amount, created_at)) for t, sender_id, amount, created_at in cur)
+        return pending
+
+    #must run inside transaction(), the debit only applies if the balance covers it
+    def transfer(self, cur, debit_id, credit_id, amount, transaction_id=None):
+        if self.ledger is not None:
+            self.ledger.transfer(cur, transaction_id, debit_id, credit_id, amount)
+            self.touch(debit_id, credit_id)
+            return
+        self.__debit(cur, debit_id, amount)
+        self.__credit(cur, {credit_id: amount})
+        self.touch(debit_id, credit_id)
+
+    #conditional debit of the user row
+    def __debit(self, cur, debit_id, amount):
+        cur.execute(
             """
             UPDATE user
-            SET balance = ?
-            WHERE ID = ?;
+            SET balance = balance - ?
+            WHERE ID = ? AND balance >= ?;
             """,
-            (new_balance, receiver_id)
+            (amount, debit_id, amount)
         )
-        self.conn.commit()
-        return True
+        if cur.rowcount != 1:
+            raise InsufficientFunds(debit_id)
+
+    #credits is {user_id: amount}
+    def __credit(self, cur, credits):
+        if len(credits) == 1:
+            (credit_id, amount), = credits.items()
+            cur.execute(
+                """
+                UPDATE user
+                SET balance = balance + ?
+                WHERE ID = ?;
+                """,
+                (amount, credit_id)
+            )
+        elif credits:
+            cur.executemany(
+                "UPDATE user SET balance = balance + ? WHERE ID = ?;",
+                [(amount, credit_id) for credit_id, amount in credits.items()]
+            )
+
+
+class _PendingWrite(object):
+    def __init__(self, operation, args, context):
+        self.operation = operation
+        self.args = args
+        #entered by the writer around the operation, see GroupCommitWriter.capture
+        self.context = context
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        #claim() by the writer before running it, or cancel() by a caller that gave up
+        self.lock = threading.Lock()
+        self.state = "queued"
+
+    def claim(self):
+        with self.lock:
+            if self.state == "queued":
+                self.state = "running"
+            return self.state == "running"
+
+    def cancel(self):
+        with self.lock:
+            if self.state == "queued":
+                self.state = "cancelled"
+            return self.state == "cancelled"
+
+
+class GroupCommitWriter(object):
+    """
+    Single writer thread for DatabaseDriver.
+    Request threads submit write operations, the writer applies whatever is queued
+    (up to max_batch_size, waiting at most max_wait seconds for more) inside one
+    transaction, commits once and then wakes every caller with its own result.
+    Each operation runs under its own savepoint, so one failing does not undo the others.
+    The writer has a connection of its own, outside the pool, so request threads holding
+    every pooled connection while they wait in submit() cannot starve it.
+    capture, when set, is called in submit() on the request thread and returns a context
+    manager the writer runs that operation in, e.g. metrics.capture_request.
+    """
+
+    def __init__(self, driver, max_batch_size=256, max_wait=0.001, timeout=WRITE_TIMEOUT):
+        self.driver = driver
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self.timeout = timeout
+        self.capture = None
+        self.conn = driver.pool.connect()
+        self.queue = queue.Queue()
+        self.metrics_lock = threading.Lock()
+        self.batches = 0
+        self.operations = 0
+        self.largest_batch = 0
+        self.batch_sizes = {}
+        self.commit_seconds = 0.0
+        self.slowest_commit = 0.0
+        self.thread = threading.Thread(target=self.run, name="group-commit-writer")
+        self.thread.daemon = True
+        self.thread.start()
+
+    #called from request threads, blocks until the batch holding the operation is committed.
+    #Raises if the writer has not started the operation within timeout seconds, which then
+    #never runs; one that has started is waited for, its batch always ends
+    def submit(self, operation, *args):
+        context = self.capture() if self.capture is not None else contextlib.nullcontext()
+        pending = _PendingWrite(operation, args, context)
+        self.queue.put(pending)
+        if not pending.done.wait(self.timeout):
+            if pending.cancel():
+                raise Exception("Timed out waiting for the group-commit writer")
+            pending.done.wait()
+        if pending.error is not None:
+            raise pending.error
+        return pending.result
+
+    #finish what is queued and stop the writer thread
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        self.driver.pool.pin(self.conn)
+        stopping = False
+        while not stopping:
+            batch, stopping = self.collect()
+            batch = [pending for pending in batch if pending.claim()]
+            if not batch:
+                continue
+            try:
+                self.apply(batch)
+            except Exception as e:
+                # apply() fails its batch itself, this only keeps the writer alive
+                self.fail(batch, e)
+        self.conn.close()
+
+    def fail(self, batch, error):
+        for pending in batch:
+            if not pending.done.is_set():
+                pending.result = None
+                pending.error = error
+                pending.done.set()
+
+    #block for the first operation, then take whatever else arrives within max_wait
+    def collect(self):
+        first = self.queue.get()
+        if first is None:
+            return [], True
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    pending = self.queue.get(timeout=timeout)
+                else:
+                    pending = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if pending is None:
+                return batch, True
+            batch.append(pending)
+        return batch, False
+
+    def apply(self, batch):
+        conn = self.conn
+        try:
+            cur = conn.cursor()
+            cur.execute("BEGIN IMMEDIATE;")
+            for pending in batch:
+                cur.execute("SAVEPOINT operation;")
+                try:
+                    with pending.context:
+                        pending.result = pending.operation(cur, *pending.args)
+                except InsufficientFunds:
+                    cur.execute("ROLLBACK TO operation;")
+                    pending.result = False
+                except Exception as e:
+                    cur.execute("ROLLBACK TO operation;")
+                    pending.error = e
+                cur.execute("RELEASE operation;")
+            started = time.perf_counter()
+            conn.commit()
+            self.record(len(batch), time.perf_counter() - started)
+            self.driver.committed()
+            self.driver.flush_touched_users(True)
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            self.driver.flush_touched_users(False)
+            self.fail(batch, e)
+        for pending in batch:
+            pending.done.set()
+
+    def record(self, size, commit_seconds):
+        bucket = 1 << (size - 1).bit_length()
+        with self.metrics_lock:
+            self.batches += 1
+            self.operations += size
+            self.largest_batch = max(self.largest_batch, size)
+            self.batch_sizes[bucket] = self.batch_sizes.get(bucket, 0) + 1
+            self.commit_seconds += commit_seconds
+            self.slowest_commit = max(self.slowest_commit, commit_seconds)
+
+    #batch sizes are bucketed by the next power of two (1, 2, 4, 8, ...)
+    def stats(self):
+        with self.metrics_lock:
+            batches = max(self.batches, 1)
+            return {
+                "batches": self.batches,
+                "operations": self.operations,
+                "mean_batch_size": self.operations / batches,
+                "max_batch_size": self.largest_batch,
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "commit_seconds_total": self.commit_seconds,
+                "commit_seconds_mean": self.commit_seconds / batches,
+                "commit_seconds_max": self.slowest_commit,
+            }
@@ -2,11 +2,90 @@ import os
 import datetime
 import hashlib
 
-import bcrypt
+import bulk
+import connection_pool
+import feed
+import ledger
+import passwords
+import replica
+import rollups
 
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import create_engine
+from sqlalchemy import event
 db = SQLAlchemy()
 
+# LEDGER=1: balances live in the append-only ledger, used by users_dao and transactions_dao
+LEDGER = ledger.Ledger() if ledger.ENABLED else None
+# FEED=1: accepted transactions fan out into follower timelines, written by transactions_dao
+FEED = feed.Feed() if feed.ENABLED else None
+# ROLLUPS=1: per-user and per-day totals, kept by transactions_dao
+ROLLUPS = rollups.Rollups() if rollups.ENABLED else None
+# READ_REPLICA=1: snapshot copy for the read routes, set up by use_replica()
+REPLICA = None
+
+
+# sqlite3 cursor on the session's connection, inside its transaction (for ledger.Ledger)
+def session_cursor():
+    return db.session.connection().connection.cursor()
+
+# take SQLite's write lock now: pysqlite only begins a transaction at the first write,
+# so reads before it would otherwise run outside the transaction
+def begin_write():
+    conn = db.session.connection().connection
+    if not conn.in_transaction:
+        conn.cursor().execute("BEGIN IMMEDIATE;")
+
+# bulk.py import/export on the models' database file (needs the app context for the engine);
+# balances are exported as serialize() reports them
+def import_rows(table, lines, fmt="csv", **options):
+    count = bulk.import_file(db.engine.url.database, table, lines, fmt, **options)
+    if table == "user" and LEDGER is not None:
+        LEDGER.open_missing_accounts(session_cursor())
+        db.session.commit()
+    if table == "transactions" and ROLLUPS is not None:
+        rebuild_rollups()
+    return count
+
+def rebuild_rollups():
+    begin_write()
+    count = ROLLUPS.rebuild(session_cursor())
+    db.session.commit()
+    return count
+
+# copy the models' database into a replica.Replica (needs the app context for the engine)
+# and bind the sessions of threads reading from it to an engine on the copy
+def use_replica():
+    global REPLICA
+    REPLICA = replica.Replica(db.engine.url.database)
+    replica_engine = create_engine("sqlite:///%s" % REPLICA.path)
+
+    @event.listens_for(replica_engine, "connect")
+    def set_sqlite_pragmas(dbapi_connection, connection_record):
+        for name, value in connection_pool.DEFAULT_PRAGMAS:
+            dbapi_connection.execute("PRAGMA %s = %s;" % (name, value))
+
+    @event.listens_for(db.engine, "commit")
+    def count_commit(conn):
+        REPLICA.note_commit()
+
+    factory = db.session.session_factory
+    session_class = factory.class_
+
+    def get_bind(self, mapper=None, clause=None, **kwargs):
+        if reading_replica():
+            return replica_engine
+        return session_class.get_bind(self, mapper, clause, **kwargs)
+
+    factory.class_ = type(session_class.__name__, (session_class,), {"get_bind": get_bind})
+
+def reading_replica():
+    return REPLICA is not None and REPLICA.active()
+
+def export_lines(table, fmt="csv", columns=None):
+    expressions = {"balance": ledger.balance_sql("user.id")} if table == "user" and LEDGER is not None else None
+    return bulk.export_file(db.engine.url.database, table, fmt, columns, expressions)
+
 
 class User(db.Model):
     __tablename__ = "user"
@@ -17,7 +96,7 @@ class User(db.Model):
     email = db.Column(db.String, nullable=False, unique=True)
     password_digest = db.Column(db.String, nullable=False)
     balance = db.Column(db.Integer)
-    transactions = db.relationship('Transactions', cascade='delete')
+    transactions = db.relationship('Transactions', cascade='delete', foreign_keys='Transactions.sender_id')
     # Session information
     session_token = db.Column(db.String, nullable=False, unique=True)
     session_expiration = db.Column(db.DateTime, nullable=False)
@@ -27,7 +106,11 @@ class User(db.Model):
         self.name = kwargs.get("name")
         self.username = kwargs.get("username")
         self.email = kwargs.get("email")
-        self.password_digest = bcrypt.hashpw(kwargs.get("password").encode("utf8"), bcrypt.gensalt(rounds=13))
+        # callers can hash ahead of time (see users_dao.create_user), otherwise it happens here
+        password_digest = kwargs.get("password_digest")
+        if password_digest is None:
+            password_digest = passwords.hash_password(kwargs.get("password"))
+        self.password_digest = password_digest
         self.balance = kwargs.get("balance", 0)
         self.renew_session()
     
@@ -37,9 +120,15 @@ class User(db.Model):
             'name': self.name,
             'username': self.username,
             'email': self.email,
-            'balance': self.balance
+            'balance': self.current_balance()
         }
 
+    # with LEDGER=1 the balance column is only brought up to date by ledger compaction
+    def current_balance(self):
+        if LEDGER is None:
+            return self.balance
+        return LEDGER.balance_of(session_cursor(), self.id)
+
     # Used to randomly generate session/update tokens
     def _urlsafe_base_64(self):
         return hashlib.sha1(os.urandom(64)).hexdigest()
@@ -51,7 +140,7 @@ class User(db.Model):
         self.update_token = self._urlsafe_base_64()
 
     def verify_password(self, password):
-        return bcrypt.checkpw(password.encode("utf8"), self.password_digest)
+        return passwords.verify_password(password, self.password_digest)
 
     # Checks if session token is valid and hasn't expired
     def verify_session_token(self, session_token):
@@ -69,12 +158,26 @@ class Transactions(db.Model):
     amount = db.Column(db.Integer, nullable=False)
     accepted = db.Column(db.Boolean, nullable=False)
     message = db.Column(db.String)
+    # unix seconds, and whether the receiver pays (see rollups.py)
+    created_at = db.Column(db.Integer)
+    requested = db.Column(db.Boolean, nullable=False, default=False, server_default="0")
+    # same index names as migrations.AUTH_MIGRATIONS, which adds them to existing files
+    __table_args__ = (
+        db.Index('ix_transactions_sender_id_id', 'sender_id', 'id'),
+        db.Index('ix_transactions_receiver_id_id', 'receiver_id', 'id'),
+        db.Index('ix_transactions_sender_id_accepted_id', 'sender_id', 'accepted', 'id'),
+        db.Index('ix_transactions_receiver_id_accepted_id', 'receiver_id', 'accepted', 'id'),
+        db.Index('ix_transactions_sender_id_receiver_id_id', 'sender_id', 'receiver_id', 'id'),
+    )
 
     def __init__(self, **kwargs):
         self.sender_id = kwargs.get('sender_id')
         self.receiver_id = kwargs.get('receiver_id')
         self.amount = kwargs.get('amount')
         self.accepted = kwargs.get('accepted', False)
+        self.message = kwargs.get('message')
+        self.created_at = kwargs.get('created_at', rollups.now())
+        self.requested = kwargs.get('requested', False)
 
     def serialize(self):
         return {
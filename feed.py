@@ -0,0 +1,136 @@
+import os
+
+import cache
+
+
+# FEED=1 fans accepted transactions out into per-user timelines (GET /api/user/<id>/feed/)
+ENABLED = os.environ.get("FEED") == "1"
+FEED_CAPACITY = int(os.environ.get("FEED_CAPACITY", 1000))
+
+FEED_FIELDS = ["id", "sender_id", "receiver_id", "amount", "message"]
+
+
+class Feed(object):
+    """
+    Precomputed timelines: each accepted transaction is written, with its message, into
+    the feed of both parties and of everyone following either of them.
+
+    A user's feed is a ring buffer of capacity items. feed_heads holds the next slot, and
+    the item written there replaces whatever had that (USER_ID, SLOT) before. The feed
+    table is clustered on (USER_ID, TRANSACTION_ID) (WITHOUT ROWID), so a page is one
+    range read that needs nothing outside the index.
+    The newest cached_items of each feed are cached; the caller invalidates the users
+    fan_out() returns once its transaction has committed.
+    """
+
+    def __init__(self, capacity=FEED_CAPACITY, cache_size=cache.CACHE_SIZE, cache_ttl=30, cached_items=100):
+        self.capacity = capacity
+        self.cached_items = cached_items
+        self.cache = cache.LRUCache(cache_size, cache_ttl) if cache_size else None
+
+    def follow(self, cur, follower_id, followed_id):
+        cur.execute(
+            "INSERT OR IGNORE INTO follows (FOLLOWED_ID, FOLLOWER_ID) VALUES (?, ?);", (followed_id, follower_id)
+        )
+
+    def unfollow(self, cur, follower_id, followed_id):
+        cur.execute(
+            "DELETE FROM follows WHERE FOLLOWED_ID = ? AND FOLLOWER_ID = ?;", (followed_id, follower_id)
+        )
+
+    #drop a deleted user's follows both ways and their feed
+    def forget(self, cur, user_id):
+        cur.execute("DELETE FROM follows WHERE FOLLOWED_ID = ? OR FOLLOWER_ID = ?;", (user_id, user_id))
+        cur.execute("DELETE FROM feed WHERE USER_ID = ?;", (user_id,))
+        cur.execute("DELETE FROM feed_heads WHERE USER_ID = ?;", (user_id,))
+
+    def followers_of(self, cur, user_ids, chunk_size=500):
+        user_ids = list(user_ids)
+        followers = {}
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            cur.execute(
+                "SELECT FOLLOWED_ID, FOLLOWER_ID FROM follows WHERE FOLLOWED_ID IN (%s);" % ", ".join("?" * len(chunk)),
+                chunk
+            )
+            for followed_id, follower_id in cur.fetchall():
+                followers.setdefault(followed_id, []).append(follower_id)
+        return followers
+
+    def _heads(self, cur, user_ids, chunk_size=500):
+        user_ids = list(user_ids)
+        heads = dict.fromkeys(user_ids, 0)
+        for start in range(0, len(user_ids), chunk_size):
+            chunk = user_ids[start:start + chunk_size]
+            cur.execute(
+                "SELECT USER_ID, NEXT_SLOT FROM feed_heads WHERE USER_ID IN (%s);" % ", ".join("?" * len(chunk)),
+                chunk
+            )
+            heads.update(cur.fetchall())
+        return heads
+
+    #items are (transaction_id, sender_id, receiver_id, amount, message) in id order,
+    #written inside the caller's transaction; returns the users whose feeds changed
+    def fan_out(self, cur, items):
+        if not items:
+            return set()
+        parties = set()
+        for _, sender_id, receiver_id, _, _ in items:
+            parties.update((sender_id, receiver_id))
+        followers = self.followers_of(cur, parties)
+        audiences = []
+        for _, sender_id, receiver_id, _, _ in items:
+            audience = {sender_id, receiver_id}
+            audience.update(followers.get(sender_id, ()))
+            audience.update(followers.get(receiver_id, ()))
+            audiences.append(audience)
+        users = set().union(*audiences)
+        heads = self._heads(cur, users)
+        rows = []
+        for (transaction_id, sender_id, receiver_id, amount, message), audience in zip(items, audiences):
+            for user_id in audience:
+                rows.append((user_id, transaction_id, heads[user_id] % self.capacity,
+                             sender_id, receiver_id, amount, message))
+                heads[user_id] += 1
+        cur.executemany(
+            """
+            INSERT OR REPLACE INTO feed (USER_ID, TRANSACTION_ID, SLOT, SENDER_ID, RECEIVER_ID, AMOUNT, MESSAGE)
+            VALUES (?, ?, ?, ?, ?, ?, ?);
+            """,
+            rows
+        )
+        cur.executemany(
+            "INSERT OR REPLACE INTO feed_heads (USER_ID, NEXT_SLOT) VALUES (?, ?);", list(heads.items())
+        )
+        return users
+
+    def _read(self, cur, user_id, limit, before):
+        cur.execute(
+            """
+            SELECT TRANSACTION_ID, SENDER_ID, RECEIVER_ID, AMOUNT, MESSAGE FROM feed
+            WHERE USER_ID = ? AND TRANSACTION_ID < ?
+            ORDER BY TRANSACTION_ID DESC LIMIT ?;
+            """,
+            (user_id, before, limit)
+        )
+        return cur.fetchall()
+
+    #newest first as FEED_FIELDS tuples, pass the last id as before for the next page.
+    #fill=False leaves a missed first page out of the cache (cur reads a replica)
+    def page(self, cur, user_id, limit, before=None, fill=True):
+        if before is not None:
+            return self._read(cur, user_id, limit, before)
+        if self.cache is None or limit > self.cached_items:
+            return self._read(cur, user_id, limit, 2 ** 63 - 1)
+        rows = self.cache.get(user_id)
+        if rows is None:
+            if not fill:
+                return self._read(cur, user_id, limit, 2 ** 63 - 1)
+            token = self.cache.begin_fill(user_id)
+            rows = self._read(cur, user_id, self.cached_items, 2 ** 63 - 1)
+            self.cache.fill(user_id, rows, token)
+        return rows[:limit]
+
+    def invalidate(self, user_ids):
+        if self.cache is not None and user_ids:
+            self.cache.invalidate(*user_ids)
@@ -0,0 +1,83 @@
+# Transaction history of one user, sent and received merged newest first and paged by
+# keyset (?before=ID). Shared by db.DatabaseDriver and transactions_dao.
+
+HISTORY_FIELDS = ["id", "sender_id", "receiver_id", "amount", "accepted", "direction"]
+DIRECTIONS = ("sent", "received")
+FILTERS = ("direction", "accepted", "counterparty", "min_amount", "max_amount")
+
+# larger than any id, so the first page runs the same statement as the later ones
+NO_CURSOR = 2 ** 63 - 1
+
+
+#history filters from query string arguments, ValueError (with a message for the client) on bad ones
+def parse_filters(args):
+    filters = {}
+    direction = args.get("direction")
+    if direction is not None:
+        if direction not in DIRECTIONS:
+            raise ValueError("direction must be sent or received")
+        filters["direction"] = direction
+    accepted = args.get("accepted")
+    if accepted is not None:
+        if accepted.lower() in ("1", "true"):
+            filters["accepted"] = True
+        elif accepted.lower() in ("0", "false"):
+            filters["accepted"] = False
+        else:
+            raise ValueError("accepted must be true or false")
+    for name in ("counterparty", "min_amount", "max_amount"):
+        value = args.get(name)
+        if value is not None:
+            try:
+                filters[name] = int(value)
+            except ValueError:
+                raise ValueError("%s must be an integer" % name)
+    return filters
+
+
+#a history row as returned by the routes, with ACCEPTED (0/1 in SQLite) as a bool
+def serialize(row):
+    entry = dict(zip(HISTORY_FIELDS, row))
+    entry["accepted"] = bool(entry["accepted"])
+    return entry
+
+
+#one side of the history. Every filter but the amount range is an equality on an indexed
+#column ahead of ID, so each side is a descending range read of at most limit rows:
+#(party, ID), (party, ACCEPTED, ID), or (SENDER_ID, RECEIVER_ID, ID) with a counterparty
+def _side(direction, accepted, counterparty, min_amount, max_amount):
+    party, other = ("SENDER_ID", "RECEIVER_ID") if direction == "sent" else ("RECEIVER_ID", "SENDER_ID")
+    where = ["%s = :user" % party, "ID < :before"]
+    if direction == "received":
+        # payments to oneself are listed once, as sent
+        where.append("SENDER_ID != :user")
+    if accepted is not None:
+        where.append("ACCEPTED = :accepted")
+    if counterparty is not None:
+        where.append("%s = :counterparty" % other)
+    if min_amount is not None:
+        where.append("AMOUNT >= :min_amount")
+    if max_amount is not None:
+        where.append("AMOUNT <= :max_amount")
+    return (
+        "SELECT * FROM (SELECT ID, SENDER_ID, RECEIVER_ID, AMOUNT, ACCEPTED, '%s' AS DIRECTION "
+        "FROM transactions WHERE %s ORDER BY ID DESC LIMIT :limit)" % (direction, " AND ".join(where))
+    )
+
+
+#(sql, params) for a page of user_id's history with named (:name) parameters
+def history_query(user_id, limit, before=None, direction=None, accepted=None, counterparty=None,
+                  min_amount=None, max_amount=None):
+    directions = DIRECTIONS if direction is None else (direction,)
+    sides = [_side(d, accepted, counterparty, min_amount, max_amount) for d in directions]
+    sql = " UNION ALL ".join(sides) + " ORDER BY ID DESC LIMIT :limit;"
+    params = {
+        "user": user_id,
+        "before": NO_CURSOR if before is None else before,
+        "limit": limit,
+        "accepted": accepted,
+        "counterparty": counterparty,
+        "min_amount": min_amount,
+        "max_amount": max_amount,
+    }
+    return sql, {name: value for name, value in params.items() if ":" + name in sql}
@@ -0,0 +1,152 @@
+import os
+import sqlite3
+import sys
+
+
+# LEDGER=1 keeps balances in the append-only ledger instead of updating user.BALANCE
+# on every payment. Switch it on for a database and leave it on: balances written to
+# the column while it is off are not seen by the ledger (compact() does write the
+# ledger balances back into the column).
+ENABLED = os.environ.get("LEDGER") == "1"
+SNAPSHOT_EVERY = int(os.environ.get("LEDGER_SNAPSHOT_EVERY", 1000))
+
+
+class InsufficientFunds(Exception):
+    pass
+
+
+#SQL expression for the balance of the account given by the SQL expression account,
+#e.g. balance_sql("user.ID") in a user query or balance_sql(":account") with a parameter
+def balance_sql(account):
+    return (
+        "(COALESCE((SELECT BALANCE FROM ledger_snapshots WHERE ACCOUNT_ID = {a}), 0)"
+        " + COALESCE((SELECT SUM(AMOUNT) FROM ledger_entries WHERE ACCOUNT_ID = {a}"
+        " AND ID > COALESCE((SELECT LAST_ENTRY_ID FROM ledger_snapshots WHERE ACCOUNT_ID = {a}), 0)), 0))"
+    ).format(a=account)
+
+BALANCE_OF = "SELECT %s;" % balance_sql(":account")
+TAIL_OF = (
+    "SELECT COUNT(*) FROM ledger_entries WHERE ACCOUNT_ID = :account"
+    " AND ID > COALESCE((SELECT LAST_ENTRY_ID FROM ledger_snapshots WHERE ACCOUNT_ID = :account), 0);"
+)
+
+
+class Ledger(object):
+    """
+    Append-only double-entry ledger in the ledger_entries/ledger_snapshots tables.
+    Every transfer appends a debit (negative) and a credit (positive) entry, no row is
+    ever updated in place. An account's balance is its snapshot plus the entries after
+    it. An account (debited or credited) whose tail grows past snapshot_every entries
+    is snapshotted in the same transaction; compact() snapshots every account at once.
+
+    All methods take a sqlite3 cursor and run inside the caller's transaction, so the
+    ledger commits or rolls back together with the transactions row it belongs to.
+    The debit is written before the balance is checked: the write takes SQLite's write
+    lock, so the check cannot race another payment, and the caller rolls back on
+    InsufficientFunds.
+    """
+
+    def __init__(self, snapshot_every=SNAPSHOT_EVERY):
+        self.snapshot_every = snapshot_every
+
+    def balance_of(self, cur, account_id):
+        cur.execute(BALANCE_OF, {"account": account_id})
+        return cur.fetchone()[0]
+
+    #opening entry for an account created with money in it
+    def open_account(self, cur, account_id, balance):
+        if balance:
+            cur.execute(
+                "INSERT INTO ledger_entries (ACCOUNT_ID, TRANSACTION_ID, AMOUNT) VALUES (?, NULL, ?);",
+                (account_id, balance)
+            )
+
+    #opening entries from user.BALANCE for users the ledger has never seen
+    def open_missing_accounts(self, cur):
+        cur.execute(
+            """
+            INSERT INTO ledger_entries (ACCOUNT_ID, TRANSACTION_ID, AMOUNT)
+            SELECT ID, NULL, BALANCE FROM user
+            WHERE BALANCE != 0
+            AND NOT EXISTS (SELECT 1 FROM ledger_entries WHERE ACCOUNT_ID = user.ID)
+            AND NOT EXISTS (SELECT 1 FROM ledger_snapshots WHERE ACCOUNT_ID = user.ID);
+            """
+        )
+        return cur.rowcount
+
+    def transfer(self, cur, transaction_id, debit_id, credit_id, amount):
+        self.transfer_many(cur, debit_id, [(credit_id, amount, transaction_id)])
+
+    #one debit and one credit entry per (credit_id, amount, transaction_id), then a
+    #single check that the debited account did not go negative and the snapshot check
+    #for every account written to
+    def transfer_many(self, cur, debit_id, credits):
+        entries = []
+        for credit_id, amount, transaction_id in credits:
+            entries.append((debit_id, transaction_id, -amount))
+            entries.append((credit_id, transaction_id, amount))
+        cur.executemany(
+            "INSERT INTO ledger_entries (ACCOUNT_ID, TRANSACTION_ID, AMOUNT) VALUES (?, ?, ?);",
+            entries
+        )
+        if self.balance_of(cur, debit_id) < 0:
+            raise InsufficientFunds(debit_id)
+        for account_id in dict.fromkeys([debit_id] + [credit_id for credit_id, _, _ in credits]):
+            cur.execute(TAIL_OF, {"account": account_id})
+            if cur.fetchone()[0] > self.snapshot_every:
+                self.snapshot(cur, account_id)
+
+    def snapshot(self, cur, account_id):
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO ledger_snapshots (ACCOUNT_ID, BALANCE, LAST_ENTRY_ID)
+            SELECT :account, %s, COALESCE(MAX(ID), 0) FROM ledger_entries WHERE ACCOUNT_ID = :account;
+            """ % balance_sql(":account"),
+            {"account": account_id}
+        )
+
+    #fold every entry so far into the snapshots and copy the balances into user.BALANCE.
+    #prune=True also deletes the folded entries, which gives up their audit trail
+    def compact(self, cur, prune=False):
+        cur.execute("SELECT COALESCE(MAX(ID), 0) FROM ledger_entries;")
+        upto = cur.fetchone()[0]
+        cur.execute(
+            """
+            INSERT OR REPLACE INTO ledger_snapshots (ACCOUNT_ID, BALANCE, LAST_ENTRY_ID)
+            SELECT e.ACCOUNT_ID, COALESCE(s.BALANCE, 0) + SUM(e.AMOUNT), MAX(e.ID)
+            FROM ledger_entries e LEFT JOIN ledger_snapshots s ON s.ACCOUNT_ID = e.ACCOUNT_ID
+            WHERE e.ID > COALESCE(s.LAST_ENTRY_ID, 0) AND e.ID <= ?
+            GROUP BY e.ACCOUNT_ID;
+            """,
+            (upto,)
+        )
+        accounts = cur.rowcount
+        cur.execute(
+            """
+            UPDATE user SET BALANCE = (SELECT BALANCE FROM ledger_snapshots WHERE ACCOUNT_ID = user.ID)
+            WHERE ID IN (SELECT ACCOUNT_ID FROM ledger_snapshots);
+            """
+        )
+        pruned = 0
+        if prune:
+            cur.execute("DELETE FROM ledger_entries WHERE ID <= ?;", (upto,))
+            pruned = cur.rowcount
+        return {"accounts": accounts, "pruned": pruned}
+
+
+#run from cron: python ledger.py todo.db [--prune]
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("usage: python ledger.py <database file> [--prune]")
+        sys.exit(1)
+    conn = sqlite3.connect(sys.argv[1], isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    cur = conn.cursor()
+    cur.execute("BEGIN IMMEDIATE;")
+    try:
+        result = Ledger().compact(cur, prune="--prune" in sys.argv)
+    except BaseException:
+        conn.rollback()
+        raise
+    conn.commit()
+    print("%s: snapshotted %d accounts, pruned %d entries" % (sys.argv[1], result["accounts"], result["pruned"]))
@@ -0,0 +1,208 @@
+import os
+import threading
+import time
+
+
+# METRICS=1 turns on request/DB instrumentation and the /metrics endpoint.
+# When it is off nothing is hooked in, so the only cost is this module being imported.
+ENABLED = os.environ.get("METRICS") == "1"
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+
+
+def _label_text(names, values):
+    if not names:
+        return ""
+    pairs = ['%s="%s"' % (n, str(v).replace("\\", "\\\\").replace('"', '\\"')) for n, v in zip(names, values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+class Counter(object):
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.values = {} if labels else {(): 0}
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1, *labels):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s counter" % self.name]
+        with self.lock:
+            for labels, value in sorted(self.values.items()):
+                lines.append("%s%s %s" % (self.name, _label_text(self.labels, labels), value))
+        return lines
+
+
+class Histogram(object):
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.buckets = tuple(buckets)
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                entry = self.values[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    entry[0][i] += 1
+            entry[1] += value
+            entry[2] += 1
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.help), "# TYPE %s histogram" % self.name]
+        names = self.labels + ("le",)
+        with self.lock:
+            for labels, (counts, total, count) in sorted(self.values.items()):
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append("%s_bucket%s %d" % (self.name, _label_text(names, labels + (bound,)), bucket_count))
+                lines.append("%s_bucket%s %d" % (self.name, _label_text(names, labels + ("+Inf",)), count))
+                lines.append("%s_sum%s %s" % (self.name, _label_text(self.labels, labels), total))
+                lines.append("%s_count%s %d" % (self.name, _label_text(self.labels, labels), count))
+        return lines
+
+
+requests_total = Counter("kessef_requests_total", "HTTP requests", ("route", "method", "status"))
+request_seconds = Histogram("kessef_request_duration_seconds", "HTTP request latency", ("route",))
+request_db_queries = Histogram("kessef_request_db_queries", "Database statements per request", ("route",), COUNT_BUCKETS)
+request_db_seconds = Histogram("kessef_request_db_seconds", "Database time per request", ("route",))
+response_bytes = Histogram("kessef_response_bytes", "Response payload size", ("route",), SIZE_BUCKETS)
+db_queries_total = Counter("kessef_db_queries_total", "Database statements executed")
+db_seconds_total = Counter("kessef_db_seconds_total", "Time spent in database statements")
+db_commits_total = Counter("kessef_db_commits_total", "Database commits")
+password_seconds = Histogram("kessef_password_hash_seconds", "bcrypt hash/check latency", ("operation",))
+
+METRICS = [
+    requests_total, request_seconds, request_db_queries, request_db_seconds, response_bytes,
+    db_queries_total, db_seconds_total, db_commits_total, password_seconds,
+]
+
+# callables returning {"metric_name": value} gauges, e.g. cache or group-commit stats
+collectors = []
+
+#expose the numeric values of a stats() dict as gauges named prefix_key
+def add_stats(prefix, stats):
+    def collect():
+        return {prefix + "_" + k: v for k, v in stats().items() if isinstance(v, (int, float))}
+    collectors.append(collect)
+
+
+_local = threading.local()
+
+# statements that only delimit transactions, timed but not counted as queries
+TRANSACTION_CONTROL = ("BEGIN", "COMMIT", "END", "ROLLBACK", "SAVEPOINT", "RELEASE")
+
+
+class RequestStats(object):
+    """
+    Statement count and database time of one request. The request's thread holds it
+    while the request runs, and the group-commit writer holds it while it runs one of
+    the request's writes (see capture_request), so that work counts towards the request.
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.queries = 0
+        self.db_seconds = 0.0
+
+
+#the first keyword of statement when it is one of TRANSACTION_CONTROL, else None
+def transaction_control(statement):
+    words = statement.lstrip()[:16].split(None, 1)
+    keyword = words[0].rstrip(";").upper() if words else ""
+    return keyword if keyword in TRANSACTION_CONTROL else None
+
+
+#query listener for connection_pool.TracedConnection and the SQLAlchemy engine events
+def observe_query(statement, parameters, seconds):
+    control = transaction_control(statement)
+    if control == "COMMIT":
+        db_commits_total.inc()
+    elif control is None:
+        db_queries_total.inc()
+    db_seconds_total.inc(seconds)
+    stats = getattr(_local, "stats", None)
+    if stats is not None:
+        if control is None:
+            stats.queries += 1
+        stats.db_seconds += seconds
+
+def observe_commit():
+    db_commits_total.inc()
+
+
+class _Attributed(object):
+    def __init__(self, stats):
+        self.stats = stats
+
+    def __enter__(self):
+        self.previous = getattr(_local, "stats", None)
+        _local.stats = self.stats
+
+    def __exit__(self, *exc_info):
+        _local.stats = self.previous
+
+
+#called on a request thread (GroupCommitWriter.capture), returns a context manager under
+#which another thread's statements count towards this thread's request. The writer's
+#BEGIN/COMMIT are shared by a whole batch and only show in the totals and group-commit stats
+def capture_request():
+    return _Attributed(getattr(_local, "stats", None))
+
+
+def begin_request():
+    _local.stats = RequestStats()
+
+def finish_request(route, method, status, size):
+    stats = getattr(_local, "stats", None)
+    if stats is None:
+        return
+    _local.stats = None
+    requests_total.inc(1, route, method, status)
+    request_seconds.observe(time.perf_counter() - stats.started, route)
+    request_db_queries.observe(stats.queries, route)
+    request_db_seconds.observe(stats.db_seconds, route)
+    if size is not None:
+        response_bytes.observe(size, route)
+
+
+def render():
+    lines = []
+    for metric in METRICS:
+        lines.extend(metric.render())
+    for collect in collectors:
+        for name, value in sorted(collect().items()):
+            lines.append("# TYPE %s gauge" % name)
+            lines.append("%s %s" % (name, value))
+    return "\n".join(lines) + "\n"
+
+
+#hook the timers into a Flask app and serve /metrics
+def install(app):
+    from flask import Response
+    from flask import request
+
+    @app.before_request
+    def start_request_timer():
+        begin_request()
+
+    @app.after_request
+    def record_request(response):
+        route = request.url_rule.rule if request.url_rule is not None else "unmatched"
+        finish_request(route, request.method, response.status_code, response.content_length)
+        return response
+
+    def metrics_endpoint():
+        return Response(render(), mimetype="text/plain; version=0.0.4")
+
+    app.add_url_rule("/metrics", "metrics", metrics_endpoint)
@@ -0,0 +1,251 @@
+import os
+import sys
+import sqlite3
+
+
+# Schema migrations for both databases.
+# The schema version is kept in SQLite's PRAGMA user_version, each migration is a
+# (version, description, statements) tuple and they are applied in order, each in
+# its own transaction. A statement is SQL or a step(cursor) callable. Statements are
+# written to be idempotent so a database that was created by hand (or by the old
+# try/except CREATE TABLE code) upgrades cleanly.
+
+
+#ledger.py's tables, the same in both databases
+LEDGER_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS ledger_entries (
+        ID INTEGER PRIMARY KEY AUTOINCREMENT,
+        ACCOUNT_ID INTEGER NOT NULL,
+        TRANSACTION_ID INTEGER,
+        AMOUNT INTEGER NOT NULL
+    );
+    """,
+    # AUTOINCREMENT: ids must not be reused after compact(prune=True) deletes entries,
+    # the snapshots record the last entry id they include.
+    # The index covers the snapshot + tail sum in ledger.balance_sql()
+    "CREATE INDEX IF NOT EXISTS ix_ledger_entries_account_id_id ON ledger_entries (ACCOUNT_ID, ID, AMOUNT);",
+    """
+    CREATE TABLE IF NOT EXISTS ledger_snapshots (
+        ACCOUNT_ID INTEGER PRIMARY KEY,
+        BALANCE INTEGER NOT NULL,
+        LAST_ENTRY_ID INTEGER NOT NULL
+    );
+    """,
+]
+
+#history.py's filters, as equalities ahead of ID. (RECEIVER_ID, ACCEPTED, ID) supersedes
+#the (RECEIVER_ID, ACCEPTED) index
+HISTORY_INDEXES = [
+    "CREATE INDEX IF NOT EXISTS ix_transactions_sender_id_accepted_id ON transactions (SENDER_ID, ACCEPTED, ID);",
+    "CREATE INDEX IF NOT EXISTS ix_transactions_receiver_id_accepted_id ON transactions (RECEIVER_ID, ACCEPTED, ID);",
+    "CREATE INDEX IF NOT EXISTS ix_transactions_sender_id_receiver_id_id ON transactions (SENDER_ID, RECEIVER_ID, ID);",
+    "DROP INDEX IF EXISTS ix_transactions_receiver_id_accepted;",
+]
+
+#feed.py's tables: follows by followed user for the fan-out, and the feed clustered by
+#(USER_ID, TRANSACTION_ID) so a page is one range read; the ring buffer replaces on (USER_ID, SLOT)
+FEED_TABLES = [
+    """
+    CREATE TABLE IF NOT EXISTS follows (
+        FOLLOWED_ID INTEGER NOT NULL,
+        FOLLOWER_ID INTEGER NOT NULL,
+        PRIMARY KEY (FOLLOWED_ID, FOLLOWER_ID)
+    ) WITHOUT ROWID;
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed_heads (
+        USER_ID INTEGER PRIMARY KEY,
+        NEXT_SLOT INTEGER NOT NULL
+    );
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS feed (
+        USER_ID INTEGER NOT NULL,
+        TRANSACTION_ID INTEGER NOT NULL,
+        SLOT INTEGER NOT NULL,
+        SENDER_ID INTEGER NOT NULL,
+        RECEIVER_ID INTEGER NOT NULL,
+        AMOUNT INTEGER NOT NULL,
+        MESSAGE TEXT,
+        PRIMARY KEY (USER_ID, TRANSACTION_ID)
+    ) WITHOUT ROWID;
+    """,
+    "CREATE UNIQUE INDEX IF NOT EXISTS ix_feed_user_id_slot ON feed (USER_ID, SLOT);",
+]
+
+#rollups.py's tables and the transaction columns it counts by: CREATED_AT (unix seconds)
+#and REQUESTED, which tells who pays an accepted transaction (a request's RECEIVER_ID)
+def rollup_tables(requested_type):
+    return [
+        add_column("transactions", "CREATED_AT", "INTEGER"),
+        add_column("transactions", "REQUESTED", "%s NOT NULL DEFAULT 0" % requested_type),
+        # pending rows can only be requests; older accepted ones cannot be told apart and count as sends
+        "UPDATE transactions SET REQUESTED = 1 WHERE ACCEPTED = 0;",
+        """
+        CREATE TABLE IF NOT EXISTS rollup_days (
+            USER_ID INTEGER NOT NULL,
+            DAY INTEGER NOT NULL,
+            SENT_COUNT INTEGER NOT NULL,
+            SENT INTEGER NOT NULL,
+            RECEIVED_COUNT INTEGER NOT NULL,
+            RECEIVED INTEGER NOT NULL,
+            PENDING_OUT_COUNT INTEGER NOT NULL,
+            PENDING_OUT INTEGER NOT NULL,
+            PENDING_IN_COUNT INTEGER NOT NULL,
+            PENDING_IN INTEGER NOT NULL,
+            PRIMARY KEY (USER_ID, DAY)
+        ) WITHOUT ROWID;
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS rollup_users (
+            USER_ID INTEGER PRIMARY KEY,
+            SENT_COUNT INTEGER NOT NULL,
+            SENT INTEGER NOT NULL,
+            RECEIVED_COUNT INTEGER NOT NULL,
+            RECEIVED INTEGER NOT NULL,
+            PENDING_OUT_COUNT INTEGER NOT NULL,
+            PENDING_OUT INTEGER NOT NULL,
+            PENDING_IN_COUNT INTEGER NOT NULL,
+            PENDING_IN INTEGER NOT NULL
+        );
+        """,
+    ]
+
+#ALTER TABLE ADD COLUMN has no IF NOT EXISTS, so this step checks first
+#(db.create_all() already creates the db1 models' columns in a new auth.db)
+def add_column(table, column, definition):
+    def step(cur):
+        cur.execute('PRAGMA table_info("%s");' % table)
+        if column.lower() not in [row[1].lower() for row in cur.fetchall()]:
+            cur.execute('ALTER TABLE "%s" ADD COLUMN %s %s;' % (table, column, definition))
+    return step
+
+#migrations for todo.db (db.DatabaseDriver)
+DRIVER_MIGRATIONS = [
+    (1, "create user and transactions tables", [
+        """
+        CREATE TABLE IF NOT EXISTS user (
+            ID INTEGER PRIMARY KEY,
+            NAME TEXT NOT NULL,
+            USERNAME CHAR(50),
+            EMAIL TEXT NOT NULL,
+            PASSWORD TEXT NOT NULL,
+            BALANCE INTEGER
+        );
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS transactions (
+            ID INTEGER PRIMARY KEY,
+            SENDER_ID INTEGER SECONDARY KEY NOT NULL,
+            RECEIVER_ID INTEGER SECONDARY KEY NOT NULL,
+            AMOUNT INTEGER,
+            ACCEPTED BOOL
+        );
+        """,
+    ]),
+    (2, "index transactions by sender/receiver and users by email", [
+        "CREATE INDEX IF NOT EXISTS ix_transactions_sender_id_id ON transactions (SENDER_ID, ID);",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_receiver_id_id ON transactions (RECEIVER_ID, ID);",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_receiver_id_accepted ON transactions (RECEIVER_ID, ACCEPTED);",
+        "CREATE INDEX IF NOT EXISTS ix_user_email ON user (EMAIL);",
+    ]),
+    (3, "ledger entries and balance snapshots", LEDGER_TABLES),
+    (4, "history indexes by status and counterparty", HISTORY_INDEXES),
+    (5, "follows and feed timelines", FEED_TABLES),
+    (6, "transaction timestamps and rollups", rollup_tables("BOOL")),
+]
+
+#migrations for auth.db (db1 models), tables themselves come from db.create_all()
+AUTH_MIGRATIONS = [
+    (1, "index transactions by sender/receiver", [
+        "CREATE INDEX IF NOT EXISTS ix_transactions_sender_id_id ON transactions (sender_id, id);",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_receiver_id_id ON transactions (receiver_id, id);",
+        "CREATE INDEX IF NOT EXISTS ix_transactions_receiver_id_accepted ON transactions (receiver_id, accepted);",
+    ]),
+    (2, "ledger entries and balance snapshots", LEDGER_TABLES),
+    (3, "history indexes by status and counterparty", HISTORY_INDEXES),
+    (4, "follows and feed timelines", FEED_TABLES),
+    (5, "transaction timestamps and rollups", rollup_tables("BOOLEAN")),
+    # tokens.py's revocations, in the database so every serve.py worker sees them
+    (6, "revoked session tokens", [
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens (
+            JTI TEXT PRIMARY KEY,
+            EXPIRES REAL NOT NULL
+        ) WITHOUT ROWID;
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires ON revoked_tokens (EXPIRES);",
+    ]),
+    # AUTOINCREMENT ids in revocation order, so tokens.py reloads only the ones it has not seen
+    (7, "number revoked session tokens", [
+        """
+        CREATE TABLE IF NOT EXISTS revoked_tokens_numbered (
+            ID INTEGER PRIMARY KEY AUTOINCREMENT,
+            JTI TEXT NOT NULL UNIQUE,
+            EXPIRES REAL NOT NULL
+        );
+        """,
+        "INSERT OR IGNORE INTO revoked_tokens_numbered (JTI, EXPIRES) SELECT JTI, EXPIRES FROM revoked_tokens;",
+        "DROP TABLE revoked_tokens;",
+        "ALTER TABLE revoked_tokens_numbered RENAME TO revoked_tokens;",
+        "CREATE INDEX IF NOT EXISTS ix_revoked_tokens_expires ON revoked_tokens (EXPIRES);",
+    ]),
+]
+
+
+def latest_version(migrations):
+    return migrations[-1][0] if migrations else 0
+
+def get_version(conn):
+    cur = conn.cursor()
+    cur.execute("PRAGMA user_version;")
+    return cur.fetchone()[0]
+
+def set_version(conn, version):
+    conn.cursor().execute("PRAGMA user_version = %d;" % int(version))
+
+
+#bring the database up to the latest version, returns the list of applied versions
+def migrate(conn, migrations=DRIVER_MIGRATIONS):
+    current = get_version(conn)
+    latest = latest_version(migrations)
+    if current > latest:
+        raise Exception(
+            "Database schema version %d is newer than this code supports (%d)" % (current, latest)
+        )
+    applied = []
+    for version, description, statements in migrations:
+        if version <= current:
+            continue
+        cur = conn.cursor()
+        cur.execute("BEGIN;")
+        try:
+            for statement in statements:
+                if callable(statement):
+                    statement(cur)
+                else:
+                    cur.execute(statement)
+            set_version(conn, version)
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        applied.append(version)
+    return applied
+
+
+#check at startup without changing anything
+def needs_migration(conn, migrations=DRIVER_MIGRATIONS):
+    return get_version(conn) < latest_version(migrations)
+
+
+#upgrade an existing file in place: python migrations.py todo.db [driver|auth]
+if __name__ == "__main__":
+    filename = sys.argv[1] if len(sys.argv) > 1 else "todo.db"
+    kind = sys.argv[2] if len(sys.argv) > 2 else ("auth" if os.path.basename(filename).startswith("auth") else "driver")
+    migrations = AUTH_MIGRATIONS if kind == "auth" else DRIVER_MIGRATIONS
+    conn = sqlite3.connect(filename)
+    before = get_version(conn)
+    applied = migrate(conn, migrations)
+    print("%s: schema version %d -> %d, applied %s" % (filename, before, get_version(conn), applied))
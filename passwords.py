@@ -0,0 +1,128 @@
+import os
+import sys
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import bcrypt
+
+import metrics
+
+
+# bcrypt work factor and the number of hashing processes (0 hashes on the calling thread)
+BCRYPT_ROUNDS = int(os.environ.get("BCRYPT_ROUNDS", 12))
+HASH_WORKERS = int(os.environ.get("PASSWORD_HASH_WORKERS", os.cpu_count() or 1))
+
+
+#run inside the pool processes
+def _hash(password, rounds):
+    return bcrypt.hashpw(password, bcrypt.gensalt(rounds=rounds))
+
+def _check(password, digest):
+    return bcrypt.checkpw(password, digest)
+
+
+def _bytes(value):
+    return value.encode("utf8") if isinstance(value, str) else value
+
+#the cost a digest was made with, e.g. 12 for b"$2b$12$..."
+def rounds_of(digest):
+    return int(_bytes(digest).split(b"$")[2])
+
+
+class PasswordHasher(object):
+    """
+    Hashes and checks bcrypt passwords in a pool of worker processes, so the CPU
+    cost is bounded by the pool size and stays off the request threads' GIL.
+    The pool is created on first use, i.e. after any prefork.
+    """
+
+    def __init__(self, rounds=BCRYPT_ROUNDS, workers=HASH_WORKERS):
+        self.rounds = rounds
+        self.workers = workers
+        self.executor = None
+        self.lock = threading.Lock()
+
+    def _pool(self):
+        if self.executor is None:
+            with self.lock:
+                if self.executor is None:
+                    self.executor = ProcessPoolExecutor(self.workers)
+        return self.executor
+
+    def _run(self, function, *args):
+        if self.workers <= 0:
+            return function(*args)
+        return self._pool().submit(function, *args).result()
+
+    def _timed(self, operation, function, *args):
+        if not metrics.ENABLED:
+            return self._run(function, *args)
+        started = time.perf_counter()
+        try:
+            return self._run(function, *args)
+        finally:
+            metrics.password_seconds.observe(time.perf_counter() - started, operation)
+
+    def hash(self, password):
+        return self._timed("hash", _hash, _bytes(password), self.rounds)
+
+    #a list of passwords spread over every worker at once (bulk imports)
+    def hash_many(self, passwords):
+        passwords = [_bytes(p) for p in passwords]
+        rounds = [self.rounds] * len(passwords)
+        if self.workers <= 0:
+            return list(map(_hash, passwords, rounds))
+        chunksize = max(1, len(passwords) // (self.workers * 4))
+        return list(self._pool().map(_hash, passwords, rounds, chunksize=chunksize))
+
+    def verify(self, password, digest):
+        if password is None or digest is None:
+            return False
+        return self._timed("verify", _check, _bytes(password), _bytes(digest))
+
+    #true when the digest was made with a different cost than the configured one
+    def needs_rehash(self, digest):
+        return rounds_of(digest) != self.rounds
+
+    def close(self):
+        if self.executor is not None:
+            self.executor.shutdown()
+            self.executor = None
+
+
+hasher = PasswordHasher()
+
+def hash_password(password):
+    return hasher.hash(password)
+
+def hash_passwords(passwords):
+    return hasher.hash_many(passwords)
+
+def verify_password(password, digest):
+    return hasher.verify(password, digest)
+
+def needs_rehash(digest):
+    return hasher.needs_rehash(digest)
+
+
+#time one hash per cost and return the highest cost that stays under target_seconds
+def benchmark(target_seconds=0.25, min_rounds=4, max_rounds=16, report=None):
+    chosen = min_rounds
+    for rounds in range(min_rounds, max_rounds + 1):
+        started = time.perf_counter()
+        _hash(b"benchmark password", rounds)
+        elapsed = time.perf_counter() - started
+        if report is not None:
+            report(rounds, elapsed)
+        if elapsed > target_seconds:
+            break
+        chosen = rounds
+    return chosen
+
+
+#pick a cost for this machine: python passwords.py [target_seconds]
+if __name__ == "__main__":
+    target = float(sys.argv[1]) if len(sys.argv) > 1 else 0.25
+    rounds = benchmark(target, report=lambda r, s: print("rounds=%d  %.1fms" % (r, s * 1000)))
+    print("BCRYPT_ROUNDS=%d stays under %.0fms per hash" % (rounds, target * 1000))
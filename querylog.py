@@ -0,0 +1,121 @@
+import atexit
+import functools
+import logging
+import os
+import re
+import sqlite3
+import threading
+
+
+# SLOW_QUERY_MS=N turns the profiler on and logs statements slower than N milliseconds
+# with their EXPLAIN QUERY PLAN, SLOW_QUERY_LOG=path writes that log to a file.
+ENABLED = "SLOW_QUERY_MS" in os.environ
+SLOW_QUERY_MS = float(os.environ.get("SLOW_QUERY_MS", 100))
+SLOW_QUERY_LOG = os.environ.get("SLOW_QUERY_LOG")
+
+logger = logging.getLogger("kessef.queries")
+
+_LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_LISTS = re.compile(r"\(\s*\?(?:\s*,\s*\?)+\s*\)")
+_SPACES = re.compile(r"\s+")
+_EXPLAINABLE = ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH")
+
+
+#the statement with literals replaced by ? and IN lists collapsed, so variants group together
+@functools.lru_cache(maxsize=4096)
+def fingerprint(statement):
+    text = _LITERALS.sub("?", statement)
+    text = _LISTS.sub("(?+)", text)
+    return _SPACES.sub(" ", text).strip().rstrip(";")
+
+
+#a plan step that reads a whole table rather than searching an index
+def is_full_scan(detail):
+    return detail.startswith("SCAN ") and "INDEX" not in detail
+
+
+class SqliteExplainer(object):
+    # runs EXPLAIN QUERY PLAN on its own connection, outside the traced pool
+    def __init__(self, filename):
+        self.filename = filename
+        self.conn = None
+        self.lock = threading.Lock()
+
+    def __call__(self, statement, parameters):
+        with self.lock:
+            if self.conn is None:
+                self.conn = sqlite3.connect(self.filename, check_same_thread=False)
+            rows = self.conn.execute("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+        return [row[-1] for row in rows]
+
+
+class QueryProfiler(object):
+    """
+    Query listener that times every statement per fingerprint.
+    A statement slower than threshold seconds is logged with its query plan. Each new
+    fingerprint is also explained once when first seen, and logged if its plan reads
+    a whole table, so a full scan shows up before it is slow.
+    """
+
+    def __init__(self, explain, threshold=SLOW_QUERY_MS / 1000.0, log=logger):
+        self.explain = explain
+        self.threshold = threshold
+        self.log = log
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+
+    def plan(self, statement, parameters):
+        if parameters is None or not statement.lstrip().upper().startswith(_EXPLAINABLE):
+            return None
+        try:
+            return self.explain(statement, parameters)
+        except Exception as e:
+            return ["(no plan: %s)" % e]
+
+    #listener(statement, parameters, seconds) for DatabaseDriver and the SQLAlchemy events
+    def __call__(self, statement, parameters, seconds):
+        key = fingerprint(statement)
+        with self.lock:
+            entry = self.fingerprints.get(key)
+            first = entry is None
+            if first:
+                entry = self.fingerprints[key] = [0, 0.0, 0.0]
+            entry[0] += 1
+            entry[1] += seconds
+            entry[2] = max(entry[2], seconds)
+        slow = seconds >= self.threshold
+        if not (slow or first):
+            return
+        plan = self.plan(statement, parameters)
+        if slow:
+            self.log.warning(
+                "slow query %.1fms: %s params=%r plan=%s", seconds * 1000, key, parameters, plan
+            )
+        elif plan and any(is_full_scan(step) for step in plan):
+            self.log.warning("full table scan: %s plan=%s", key, plan)
+
+    #fingerprints by total time: (fingerprint, count, total seconds, slowest seconds)
+    def report(self, limit=20):
+        with self.lock:
+            rows = [(key, c, total, slowest) for key, (c, total, slowest) in self.fingerprints.items()]
+        rows.sort(key=lambda row: row[2], reverse=True)
+        return rows[:limit]
+
+    def log_report(self, limit=20):
+        for key, count, total, slowest in self.report(limit):
+            self.log.info(
+                "%8d x %9.1fms total %7.2fms max  %s", count, total * 1000, slowest * 1000, key
+            )
+
+
+#a profiler for the sqlite file, logging to SLOW_QUERY_LOG (or stderr)
+#and summarizing the top fingerprints when the process exits
+def profiler_for(filename, threshold=SLOW_QUERY_MS / 1000.0):
+    if not logger.handlers:
+        handler = logging.FileHandler(SLOW_QUERY_LOG) if SLOW_QUERY_LOG else logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+    profiler = QueryProfiler(SqliteExplainer(filename), threshold)
+    atexit.register(profiler.log_report)
+    return profiler
@@ -0,0 +1,152 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+import connection_pool
+
+
+# READ_REPLICA=1 serves the read routes from a snapshot copy of the database, refreshed
+# with SQLite's online backup API every READ_REPLICA_SECONDS or after READ_REPLICA_COMMITS
+# commits, whichever comes first. A request reads from the primary instead when the
+# snapshot is older than READ_REPLICA_MAX_STALENESS seconds, or when it asks to read its
+# own writes (X-Read-Your-Writes: 1 or ?read_your_writes=true)
+ENABLED = os.environ.get("READ_REPLICA") == "1"
+REFRESH_SECONDS = float(os.environ.get("READ_REPLICA_SECONDS", 1))
+REFRESH_COMMITS = int(os.environ.get("READ_REPLICA_COMMITS", 100))
+MAX_STALENESS = float(os.environ.get("READ_REPLICA_MAX_STALENESS", 5))
+
+# the routes (view function names, the same in app.py and app1.py) the replica serves
+READ_ENDPOINTS = (
+    "get_users", "get_transactions", "get_user", "get_transactions_of_user",
+    "get_history", "get_statement", "get_pending_requests", "get_feed",
+)
+READ_YOUR_WRITES_HEADER = "X-Read-Your-Writes"
+
+
+#the replica files opened by this process; serve.py's master removes a worker's when it
+#dies without running its atexit hooks (killed, crashed)
+PATHS = []
+
+
+#the replica file of this process next to the database, e.g. todo.db.replica-1234
+def replica_path(filename):
+    return "%s.replica-%d" % (filename, os.getpid())
+
+
+#delete a replica file with its -wal and -shm files, if they are there
+def remove_files(path):
+    for suffix in ("", "-wal", "-shm"):
+        try:
+            os.remove(path + suffix)
+        except OSError:
+            pass
+
+
+#whether a request can be served from the replica: one of READ_ENDPOINTS without the
+#read-your-writes override
+def wants_replica(request):
+    if request.endpoint not in READ_ENDPOINTS:
+        return False
+    return not (
+        request.headers.get(READ_YOUR_WRITES_HEADER) == "1"
+        or request.args.get("read_your_writes") == "true"
+    )
+
+
+class Replica(object):
+    """
+    Snapshot of a database file in a file of its own (one per process, removed on exit),
+    copied from the primary by a background thread with the backup API. The copy is one
+    write transaction on the replica, which is in WAL mode, so readers keep reading the
+    previous snapshot until it commits and never wait for it.
+    A refresh when nothing was committed since the last one (PRAGMA data_version, which
+    also sees other processes' commits) only marks the snapshot as current.
+    Threads choose with use() where their reads go; callers route on active().
+    """
+
+    def __init__(self, filename, path=None, refresh_seconds=REFRESH_SECONDS,
+                 refresh_commits=REFRESH_COMMITS, max_staleness=MAX_STALENESS):
+        self.filename = filename
+        self.path = path or replica_path(filename)
+        self.refresh_seconds = refresh_seconds
+        self.refresh_commits = refresh_commits
+        self.max_staleness = max_staleness
+        self.local = threading.local()
+        self.wakeup = threading.Condition()
+        self.commits = 0
+        self.closed = False
+        #monotonic time the current snapshot was known to match the primary
+        self.snapshot_at = None
+        self.data_version = None
+        self.refreshes = 0
+        self.copies = 0
+        self.source = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        self.target = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+        PATHS.append(self.path)
+        for name, value in connection_pool.DEFAULT_PRAGMAS:
+            self.target.execute("PRAGMA %s = %s;" % (name, value))
+        # the first snapshot is taken here, so the file is complete before anyone reads it
+        self.refresh()
+        self.thread = threading.Thread(target=self.run, name="read-replica")
+        self.thread.daemon = True
+        self.thread.start()
+        atexit.register(self.close)
+
+    #copy the primary into the replica, unless it has not changed since the last copy
+    def refresh(self):
+        started = time.monotonic()
+        data_version = self.source.execute("PRAGMA data_version;").fetchone()[0]
+        if data_version != self.data_version:
+            self.source.backup(self.target)
+            self.data_version = data_version
+            self.copies += 1
+        self.snapshot_at = started
+        self.refreshes += 1
+
+    def run(self):
+        while True:
+            with self.wakeup:
+                self.wakeup.wait_for(lambda: self.closed or self.commits >= self.refresh_commits,
+                                     self.refresh_seconds)
+                if self.closed:
+                    return
+                self.commits = 0
+            try:
+                self.refresh()
+            except Exception as e:
+                print("Read replica refresh failed: %r" % e)
+
+    #called after each commit on the primary, refresh_commits of them start a refresh early
+    def note_commit(self):
+        with self.wakeup:
+            self.commits += 1
+            if self.commits >= self.refresh_commits:
+                self.wakeup.notify()
+
+    #seconds the snapshot may be behind the primary
+    def staleness(self):
+        if self.snapshot_at is None:
+            return float("inf")
+        return time.monotonic() - self.snapshot_at
+
+    #send the calling thread's reads to the replica (if replica and the snapshot is within
+    #the staleness bound) or to the primary; returns whether they go to the replica
+    def use(self, replica=True):
+        self.local.active = replica and self.staleness() <= self.max_staleness
+        return self.local.active
+
+    def active(self):
+        return getattr(self.local, "active", False)
+
+    def close(self):
+        with self.wakeup:
+            if self.closed:
+                return
+            self.closed = True
+            self.wakeup.notify()
+        self.thread.join()
+        self.source.close()
+        self.target.close()
+        remove_files(self.path)
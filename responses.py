@@ -0,0 +1,101 @@
+import db
+
+from flask import Response
+from flask import stream_with_context
+
+
+# Response formats and request-body parsing shared by app.py and app1.py, so both apps
+# answer in the same envelopes and reject malformed bodies with the same messages
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+STREAM_CHUNK_SIZE = 500
+MAX_BATCH_SIZE = 10000
+
+
+# generalized response formats
+# (the same bytes as json.dumps of the whole envelope, but data can be pre-encoded db.RawJSON)
+def success_response(data, code=200):
+    return '{"success": true, "data": ' + db.encode_json(data) + '}', code
+
+def failure_response(message, code=404):
+    return db.encode_json({"success": False, "error": message}), code
+
+# one keyset page, "next" is the id to pass as ?after= (or ?before=) for the following page
+def page_response(data, limit):
+    if isinstance(data, db.RawJSON):
+        next_after = data.last_id if data.count == limit else None
+    else:
+        next_after = data[-1]["id"] if len(data) == limit else None
+    return '{"success": true, "data": ' + db.encode_json(data) + ', "next": ' + db.encode_json(next_after) + '}', 200
+
+# same envelope as success_response, encoded a chunk of rows at a time
+def stream_response(rows, chunk_size=STREAM_CHUNK_SIZE):
+    def generate():
+        yield '{"success": true, "data": ['
+        chunk = []
+        separator = ""
+        for row in rows:
+            chunk.append(separator + db.encode_json(row))
+            separator = ", "
+            if len(chunk) >= chunk_size:
+                yield "".join(chunk)
+                chunk = []
+        yield "".join(chunk) + "]}"
+    return Response(stream_with_context(generate()), mimetype="application/json")
+
+# ?limit= of a paged route, DEFAULT_PAGE_SIZE when missing, clamped to 1..MAX_PAGE_SIZE
+def page_limit(args):
+    limit = args.get("limit", DEFAULT_PAGE_SIZE, type=int)
+    return max(1, min(limit, MAX_PAGE_SIZE))
+
+# the "transfers" list of a batch request as (receiver_id, amount) pairs,
+# with an error message in place of every malformed item
+def parse_transfers(transfers):
+    parsed = []
+    for item in transfers:
+        try:
+            receiver_id = int(item.get("receiver_id"))
+            amount = int(item.get("amount"))
+        except (AttributeError, TypeError, ValueError):
+            parsed.append("Did not supply a receiver id and amount")
+            continue
+        if amount < 0:
+            parsed.append("Not a valid amount")
+            continue
+        parsed.append((receiver_id, amount))
+    return parsed
+
+# the "accept" and "deny" id lists of a bulk answer to pending requests,
+# or an error message when they are malformed
+def parse_request_ids(body):
+    ids = []
+    for key in ("accept", "deny"):
+        value = body.get(key, [])
+        if not isinstance(value, list):
+            return "%s must be a list of transaction ids" % key
+        try:
+            ids.append([int(i) for i in value])
+        except (TypeError, ValueError):
+            return "%s must be a list of transaction ids" % key
+    accept_ids, deny_ids = ids
+    if not accept_ids and not deny_ids:
+        return "Did not supply any transaction ids"
+    if len(accept_ids) + len(deny_ids) > MAX_BATCH_SIZE:
+        return "Too many transaction ids, the limit is %d" % MAX_BATCH_SIZE
+    if set(accept_ids) & set(deny_ids):
+        return "Cannot both accept and deny a transaction"
+    return accept_ids, deny_ids
+
+# the result of a bulk answer, answered is the (accepted, denied) ids the driver returned,
+# or a false value when the balance does not cover the accepted requests;
+# ids that are not pending requests to the user come back as skipped
+def answered_response(accept_ids, deny_ids, answered):
+    if not answered:
+        return failure_response("Insufficient funds to accept the requests")
+    accepted, denied = answered
+    done = set(accepted) | set(denied)
+    return success_response({
+        "accepted": accepted,
+        "denied": denied,
+        "skipped": [i for i in accept_ids + deny_ids if i not in done]
+    })
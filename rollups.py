@@ -0,0 +1,265 @@
+import datetime
+import json
+import os
+import sqlite3
+import sys
+import time
+
+
+# ROLLUPS=1 keeps per-user and per-day transaction totals up to date with every write,
+# read by GET /api/user/<id>/statement/; python rollups.py todo.db rebuild recomputes them
+ENABLED = os.environ.get("ROLLUPS") == "1"
+
+# counters kept per (user, day) and per user, a count and an amount for each of:
+# paid out, paid in, requests the user still has to pay, requests still owed to the user
+METRICS = [
+    "sent_count", "sent",
+    "received_count", "received",
+    "pending_out_count", "pending_out",
+    "pending_in_count", "pending_in",
+]
+PERIODS = ("day", "month")
+DAY_SECONDS = 86400
+# rows read per pass of rebuild()
+REBUILD_CHUNK_SIZE = 1000000
+
+
+def now():
+    return int(time.time())
+
+#UTC day number of a CREATED_AT timestamp, None for rows from before timestamps
+def day_of(created_at):
+    return None if created_at is None else created_at // DAY_SECONDS
+
+def date_of(day):
+    return datetime.datetime.utcfromtimestamp(day * DAY_SECONDS).date()
+
+
+#what one transaction adds to the counters, as (user_id, metric index, amount) for the count
+#at that index and the amount after it. row is (sender_id, receiver_id, amount, requested,
+#accepted). A request is paid by its RECEIVER_ID, everything else by its SENDER_ID; a row
+#that is not accepted can only be a request
+def contributions(row):
+    sender_id, receiver_id, amount, requested, accepted = row
+    payer, payee = (receiver_id, sender_id) if requested or not accepted else (sender_id, receiver_id)
+    if accepted:
+        return ((payer, 0, amount), (payee, 2, amount))
+    return ((payer, 4, amount), (payee, 6, amount))
+
+
+def _upsert(table, keys):
+    columns = keys + [m.upper() for m in METRICS]
+    return "INSERT INTO %s (%s) VALUES (%s) ON CONFLICT (%s) DO UPDATE SET %s;" % (
+        table, ", ".join(columns), ", ".join("?" * len(columns)), ", ".join(keys),
+        ", ".join("%s = %s + excluded.%s" % (c, c, c) for c in columns[len(keys):])
+    )
+
+UPSERT_DAY = _upsert("rollup_days", ["USER_ID", "DAY"])
+UPSERT_USER = _upsert("rollup_users", ["USER_ID"])
+INSERT_DAY = UPSERT_DAY.split(" ON CONFLICT")[0] + ";"
+INSERT_USER = UPSERT_USER.split(" ON CONFLICT")[0] + ";"
+
+
+class Rollups(object):
+    """
+    Transaction totals per (user, UTC day) in rollup_days and per user in rollup_users,
+    changed inside the same database transaction as the rows they count, so they are
+    committed (or rolled back) together.
+    A transaction is counted on the day it was created, so an accepted request moves from
+    pending to sent/received on its request's day. Rows without CREATED_AT (from before
+    the timestamps) only count in the per-user totals.
+    """
+
+    #added and removed are lists of (sender_id, receiver_id, amount, requested, accepted,
+    #created_at); accepting a request removes its pending row and adds the accepted one
+    def apply(self, cur, added=(), removed=()):
+        days = {}
+        users = {}
+        for rows, sign in ((added, 1), (removed, -1)):
+            for row in rows:
+                day = day_of(row[5])
+                for user_id, index, amount in contributions(row[:5]):
+                    # a NULL amount counts as 0, as in rebuild()
+                    amount = amount or 0
+                    totals = users.setdefault(user_id, [0] * len(METRICS))
+                    totals[index] += sign
+                    totals[index + 1] += sign * amount
+                    if day is not None:
+                        totals = days.setdefault((user_id, day), [0] * len(METRICS))
+                        totals[index] += sign
+                        totals[index + 1] += sign * amount
+        if days:
+            cur.executemany(UPSERT_DAY, [key + tuple(totals) for key, totals in days.items()])
+        if users:
+            cur.executemany(UPSERT_USER, [(user_id,) + tuple(totals) for user_id, totals in users.items()])
+
+    def forget(self, cur, user_id):
+        cur.execute("DELETE FROM rollup_days WHERE USER_ID = ?;", (user_id,))
+        cur.execute("DELETE FROM rollup_users WHERE USER_ID = ?;", (user_id,))
+
+    def is_empty(self, cur):
+        cur.execute("SELECT NOT EXISTS (SELECT 1 FROM rollup_users) AND EXISTS (SELECT 1 FROM transactions);")
+        return bool(cur.fetchone()[0])
+
+    #recompute both tables from the transactions table with vectorized NumPy passes of
+    #chunk_size rows: each pass sums its rows per (user, day) key, and the partial sums are
+    #merged by sorting whenever they outgrow the running totals. Run it inside a write
+    #transaction (BEGIN IMMEDIATE) so no write lands between the read and the replace.
+    #Returns the number of rows read
+    def rebuild(self, cur, chunk_size=REBUILD_CHUNK_SIZE):
+        # only the rebuild needs NumPy
+        import numpy
+        keys = [numpy.zeros(0, dtype=numpy.int64)]
+        sums = [numpy.zeros((0, len(METRICS)), dtype=numpy.int64)]
+        merged = unmerged = 0
+        after = 0
+        count = 0
+        while True:
+            cur.execute(
+                """
+                SELECT ID, SENDER_ID, RECEIVER_ID, COALESCE(AMOUNT, 0), COALESCE(REQUESTED, 0),
+                       COALESCE(ACCEPTED, 0), COALESCE(CREATED_AT, -1)
+                FROM transactions WHERE ID > ? ORDER BY ID LIMIT ?;
+                """,
+                (after, chunk_size)
+            )
+            rows = cur.fetchall()
+            if not rows:
+                break
+            count += len(rows)
+            after = rows[-1][0]
+            chunk_keys, chunk_sums = _sum_chunk(numpy, numpy.array(rows, dtype=numpy.int64))
+            keys.append(chunk_keys)
+            sums.append(chunk_sums)
+            unmerged += len(chunk_keys)
+            if unmerged > max(merged, chunk_size):
+                merged_keys, merged_sums = _reduce(numpy, numpy.concatenate(keys), numpy.concatenate(sums))
+                keys, sums = [merged_keys], [merged_sums]
+                merged, unmerged = len(merged_keys), 0
+        keys, sums = _reduce(numpy, numpy.concatenate(keys), numpy.concatenate(sums))
+        user_ids = keys >> KEY_DAY_BITS
+        days = (keys & ((1 << KEY_DAY_BITS) - 1)) - 1
+        dated = days >= 0
+        user_keys, user_sums = _reduce(numpy, user_ids, sums)
+        cur.execute("DELETE FROM rollup_days;")
+        cur.execute("DELETE FROM rollup_users;")
+        cur.executemany(INSERT_DAY, numpy.column_stack([user_ids[dated], days[dated], sums[dated]]).tolist())
+        cur.executemany(INSERT_USER, numpy.column_stack([user_keys, user_sums]).tolist())
+        return count
+
+    #a statement of user_id's rollups from start to end (dates, inclusive), per day or
+    #month, with the totals for the range and of all time
+    def statement(self, cur, user_id, start, end, period="day"):
+        cur.execute(
+            "SELECT DAY, %s FROM rollup_days WHERE USER_ID = ? AND DAY BETWEEN ? AND ? ORDER BY DAY;"
+            % ", ".join(m.upper() for m in METRICS),
+            (user_id, _day_number(start), _day_number(end))
+        )
+        periods = []
+        totals = [0] * len(METRICS)
+        for row in cur.fetchall():
+            date = date_of(row[0])
+            label = date.isoformat() if period == "day" else date.strftime("%Y-%m")
+            if not periods or periods[-1][0] != label:
+                periods.append((label, [0] * len(METRICS)))
+            for i, value in enumerate(row[1:]):
+                periods[-1][1][i] += value
+                totals[i] += value
+        cur.execute(
+            "SELECT %s FROM rollup_users WHERE USER_ID = ?;" % ", ".join(m.upper() for m in METRICS), (user_id,)
+        )
+        all_time = cur.fetchone() or [0] * len(METRICS)
+        return {
+            "user_id": user_id,
+            "from": start.isoformat(),
+            "to": end.isoformat(),
+            "period": period,
+            "totals": dict(zip(METRICS, totals)),
+            "all_time": dict(zip(METRICS, all_time)),
+            "periods": [dict(zip(METRICS, values), period=label) for label, values in periods],
+        }
+
+
+#(start, end, period) from ?from=YYYY-MM-DD&to=YYYY-MM-DD&period=day|month, this month
+#so far by default; ValueError (with a message for the client) on bad ones
+def parse_range(args):
+    today = datetime.datetime.utcnow().date()
+    try:
+        start = _parse_date(args.get("from")) or today.replace(day=1)
+        end = _parse_date(args.get("to")) or today
+    except ValueError:
+        raise ValueError("from and to must be dates (YYYY-MM-DD)")
+    if start > end:
+        raise ValueError("from must not be after to")
+    period = args.get("period", "day")
+    if period not in PERIODS:
+        raise ValueError("period must be day or month")
+    return start, end, period
+
+
+def _parse_date(value):
+    return None if value is None else datetime.datetime.strptime(value, "%Y-%m-%d").date()
+
+
+def _day_number(date):
+    return (date - datetime.date(1970, 1, 1)).days
+
+
+#(user_id, day) packed into one int64 sort key, day + 1 so undated rows (-1) come first
+KEY_DAY_BITS = 21
+
+def _sum_chunk(numpy, rows):
+    sender, receiver, amount = rows[:, 1], rows[:, 2], rows[:, 3]
+    requested, accepted = rows[:, 4] != 0, rows[:, 5] != 0
+    day = numpy.where(rows[:, 6] < 0, -1, rows[:, 6] // DAY_SECONDS)
+    payer = numpy.where(requested | ~accepted, receiver, sender)
+    payee = numpy.where(requested | ~accepted, sender, receiver)
+    users, indexes, amounts, days = [], [], [], []
+    for party, index, mask in ((payer, 0, accepted), (payee, 2, accepted), (payer, 4, ~accepted), (payee, 6, ~accepted)):
+        users.append(party[mask])
+        indexes.append(numpy.full(int(mask.sum()), index, dtype=numpy.int64))
+        amounts.append(amount[mask])
+        days.append(day[mask])
+    users, indexes, amounts, days = (numpy.concatenate(a) for a in (users, indexes, amounts, days))
+    keys, inverse = numpy.unique((users << KEY_DAY_BITS) | (days + 1), return_inverse=True)
+    cells = inverse * len(METRICS) + indexes
+    # counts with bincount, amounts with add.at: bincount weights are float64 and would round
+    # amounts (and their sums) beyond 2**53
+    sums = numpy.bincount(cells, minlength=len(keys) * len(METRICS))
+    numpy.add.at(sums, cells + 1, amounts)
+    return keys, sums.reshape(len(keys), len(METRICS))
+
+
+#sum the rows of sums that share a key, keys come back sorted and unique
+def _reduce(numpy, keys, sums):
+    if len(keys) == 0:
+        return keys, sums
+    order = numpy.argsort(keys, kind="stable")
+    keys, sums = keys[order], sums[order]
+    starts = numpy.concatenate([[0], numpy.flatnonzero(keys[1:] != keys[:-1]) + 1])
+    return keys[starts], numpy.add.reduceat(sums, starts, axis=0)
+
+
+#python rollups.py todo.db rebuild | show USER_ID [FROM [TO]]
+if __name__ == "__main__":
+    if len(sys.argv) < 3 or sys.argv[2] not in ("rebuild", "show"):
+        print("usage: python rollups.py <database file> rebuild | show USER_ID [YYYY-MM-DD [YYYY-MM-DD]]")
+        sys.exit(1)
+    filename, command, args = sys.argv[1], sys.argv[2], sys.argv[3:]
+    conn = sqlite3.connect(filename, isolation_level=None)
+    conn.execute("PRAGMA busy_timeout = 5000;")
+    cur = conn.cursor()
+    rollups = Rollups()
+    if command == "rebuild":
+        cur.execute("BEGIN IMMEDIATE;")
+        try:
+            started = time.time()
+            count = rollups.rebuild(cur)
+        except BaseException:
+            conn.rollback()
+            raise
+        conn.commit()
+        print("rebuilt rollups from %d transactions in %.1fs" % (count, time.time() - started))
+    else:
+        start, end, period = parse_range(dict(zip(("from", "to"), args[1:])))
+        print(json.dumps(rollups.statement(cur, int(args[0]), start, end, period), indent=2))
@@ -0,0 +1,238 @@
+import argparse
+import importlib
+import os
+import select
+import signal
+import socket
+import sys
+import time
+import traceback
+
+import replica
+
+
+# Production entry point for either app: python serve.py app|app1
+# A master process binds the port and forks WORKERS worker processes that share the
+# listening socket. Each worker imports the app itself, so its database driver, engine,
+# connections and threads are all created after the fork, and serves it from the asyncio
+# server (async_server.py) with THREADS request threads. The workers share one SQLite
+# file in WAL mode: reads run in parallel and writes queue on SQLite's lock (busy_timeout).
+#   kill -HUP <master>   graceful reload: start workers on the current code, then stop the old ones
+#   kill -TERM <master>  graceful stop (also Ctrl-C): workers finish their requests and exit
+WORKERS = int(os.environ.get("WORKERS", os.cpu_count() or 1))
+# request threads per worker, a quarter of them (at least one) for writes; app.py gives
+# each worker as many pooled connections
+THREADS = int(os.environ.get("THREADS", 16))
+PORT = int(os.environ.get("PORT", 5000))
+BACKLOG = 2048
+# seconds a new worker has to import the app and start listening
+STARTUP_TIMEOUT = 60
+# seconds stopping workers get to finish their requests (see async_server.GRACEFUL_TIMEOUT)
+GRACEFUL_TIMEOUT = float(os.environ.get("GRACEFUL_TIMEOUT", 30))
+APPS = ("app", "app1")
+
+
+#settings the workers inherit through the environment, set once in the master so every
+#generation of workers agrees on them
+def configure_environment(workers, threads):
+    write_workers = max(1, threads // 4)
+    os.environ["WRITE_WORKERS"] = str(write_workers)
+    os.environ["READ_WORKERS"] = str(max(1, threads - write_workers))
+    # app.py then sends its writes through the group-commit writer, as under ASYNC_SERVER=1
+    os.environ.setdefault("ASYNC_SERVER", "1")
+    if workers > 1:
+        # a write in one worker cannot invalidate another worker's cached rows
+        os.environ.setdefault("CACHE_SIZE", "0")
+    # each worker has its own bcrypt pool, split the cores between them
+    os.environ.setdefault("PASSWORD_HASH_WORKERS", str(max(1, (os.cpu_count() or 1) // workers)))
+    if os.environ.get("STATELESS_SESSIONS") == "1" and not os.environ.get("SESSION_SECRET_KEYS"):
+        # one key for all workers, otherwise a token only verifies on the worker that issued it
+        os.environ["SESSION_SECRET_KEYS"] = os.urandom(32).hex()
+
+
+def listen(host, port, backlog=BACKLOG):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    return sock
+
+
+class Master(object):
+    """
+    Prefork master: owns the listening socket and the worker processes, never imports
+    the app. Workers are started in generations; the first worker of a generation starts
+    alone, so schema migrations and startup rebuilds run once before the others open the
+    database, and a reload whose first worker cannot start keeps the old generation.
+    Workers that die are replaced.
+    """
+
+    def __init__(self, app_name, sock, workers=WORKERS):
+        self.app_name = app_name
+        self.sock = sock
+        self.size = workers
+        #pid -> generation
+        self.workers = {}
+        #pid -> the replica files the worker reported when it became ready
+        self.replicas = {}
+        self.generation = 0
+        self.signals = []
+
+    def run(self):
+        for signum in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
+            signal.signal(signum, self.on_signal)
+        self.generation = 1
+        if not self.start_generation():
+            print("serve: workers failed to start", file=sys.stderr)
+            self.stop()
+            return 1
+        while True:
+            self.reap()
+            while self.signals:
+                signum = self.signals.pop(0)
+                if signum == signal.SIGHUP:
+                    self.reload()
+                else:
+                    self.stop()
+                    return 0
+            current = [pid for pid, generation in self.workers.items() if generation == self.generation]
+            if len(current) < self.size:
+                pid, ready = self.spawn()
+                if not self.wait_ready([(pid, ready)]):
+                    print("serve: worker %d failed to start" % pid, file=sys.stderr)
+            time.sleep(0.5)
+
+    def on_signal(self, signum, frame):
+        self.signals.append(signum)
+
+    #the first worker alone, then the rest together; False if one does not become ready
+    def start_generation(self):
+        first = self.spawn()
+        if not self.wait_ready([first]):
+            return False
+        return self.wait_ready([self.spawn() for _ in range(self.size - 1)])
+
+    def reload(self):
+        old = [pid for pid, generation in self.workers.items() if generation == self.generation]
+        self.generation += 1
+        if not self.start_generation():
+            print("serve: reload failed, keeping the running workers", file=sys.stderr)
+            self.generation -= 1
+            self.kill([pid for pid, generation in self.workers.items() if generation > self.generation])
+            return
+        self.kill(old)
+        print("serve: reloaded, generation %d" % self.generation, file=sys.stderr)
+
+    #stop every worker gracefully, killing the ones still running after the grace period
+    def stop(self):
+        self.kill(list(self.workers))
+        deadline = time.monotonic() + GRACEFUL_TIMEOUT + 5
+        while self.workers and time.monotonic() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.kill(list(self.workers), signal.SIGKILL)
+        self.sock.close()
+
+    def kill(self, pids, signum=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, signum)
+            except ProcessLookupError:
+                pass
+
+    def reap(self):
+        while self.workers:
+            try:
+                pid, status = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            generation = self.workers.pop(pid, None)
+            # a worker that exits normally has removed its replica files already
+            for path in self.replicas.pop(pid, ()):
+                replica.remove_files(path)
+            if generation == self.generation and status != 0:
+                print("serve: worker %d exited (status %d)" % (pid, status), file=sys.stderr)
+
+    #fork a worker, returns (pid, file descriptor that becomes readable once it is ready;
+    #the worker writes "1" and the paths of its replica files to it in one line, see run_worker())
+    def spawn(self):
+        ready, notify = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            os.close(ready)
+            # SystemExit unwinds out of the master's frames, none of which catch it, and
+            # ends the worker through the normal interpreter exit (atexit reports included)
+            sys.exit(run_worker(self.app_name, self.sock, notify))
+        os.close(notify)
+        self.workers[pid] = self.generation
+        return pid, ready
+
+    def wait_ready(self, spawned):
+        deadline = time.monotonic() + STARTUP_TIMEOUT
+        ok = True
+        for pid, ready in spawned:
+            try:
+                readable, _, _ = select.select([ready], [], [], max(0, deadline - time.monotonic()))
+                message = read_line(ready) if readable else b""
+            finally:
+                os.close(ready)
+            ok = ok and message[:1] == b"1"
+            paths = message[1:].decode("utf8")
+            if paths:
+                self.replicas[pid] = paths.split("\0")
+        return ok
+
+
+#one newline-terminated message from a pipe (not up to EOF: processes the worker forks
+#before writing it inherit the pipe), without the newline
+def read_line(fd):
+    parts = []
+    while True:
+        part = os.read(fd, 65536)
+        parts.append(part)
+        if not part or part.endswith(b"\n"):
+            return b"".join(parts).rstrip(b"\n")
+
+
+#runs in the forked worker: import the app, serve until SIGTERM, returns the exit status
+def run_worker(app_name, sock, notify):
+    # Ctrl-C reaches the whole process group; the master turns it into a graceful stop
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    try:
+        import asyncio
+        import async_server
+        app = importlib.import_module(app_name).app
+        server = async_server.AsyncWSGIServer(app, sock=sock)
+
+        def ready():
+            os.write(notify, b"1" + "\0".join(replica.PATHS).encode("utf8") + b"\n")
+            os.close(notify)
+
+        try:
+            asyncio.run(server.serve_until_stopped(on_ready=ready, timeout=GRACEFUL_TIMEOUT))
+        finally:
+            server.close()
+    except Exception:
+        traceback.print_exc()
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve app.py or app1.py from prefork worker processes")
+    parser.add_argument("app", choices=APPS)
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=PORT)
+    parser.add_argument("--workers", type=int, default=WORKERS)
+    parser.add_argument("--threads", type=int, default=THREADS)
+    args = parser.parse_args()
+    configure_environment(args.workers, args.threads)
+    sock = listen(args.host, args.port)
+    print("Serving %s on http://%s:%d (master %d, %d workers x %d threads), kill -HUP to reload"
+          % (args.app, args.host, args.port, os.getpid(), args.workers, args.threads))
+    sys.stdout.flush()
+    sys.exit(Master(args.app, sock, args.workers).run())
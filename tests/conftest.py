@@ -0,0 +1,123 @@
+import json
+import os
+import subprocess
+import sys
+import threading
+
+import pytest
+
+# the modules live flat in the repository root
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+TESTS = os.path.join(ROOT, "tests")
+sys.path.insert(0, ROOT)
+
+import db
+
+
+#DatabaseDriver on a fresh todo.db in the test's directory, closed after the test
+@pytest.fixture
+def make_driver(tmp_path):
+    drivers = []
+
+    def make(**options):
+        driver = db.DatabaseDriver(str(tmp_path / "todo.db"), **options)
+        drivers.append(driver)
+        return driver
+
+    yield make
+    for driver in drivers:
+        if driver.writer is not None:
+            driver.writer.close()
+        driver.release()
+        driver.pool.close()
+
+
+#run target(i) for i in range(count) on that many threads at once and return the results
+#in order; fails if a thread is still running after timeout seconds, re-raises the first error
+@pytest.fixture
+def run_threads():
+    def run(count, target, timeout=30):
+        results = [None] * count
+        errors = []
+        start = threading.Barrier(count)
+
+        def work(i):
+            try:
+                start.wait()
+                results[i] = target(i)
+            except BaseException as e:
+                errors.append(e)
+
+        threads = [threading.Thread(target=work, args=(i,), daemon=True) for i in range(count)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(timeout)
+        assert not any(thread.is_alive() for thread in threads), "threads did not finish in %ss" % timeout
+        if errors:
+            raise errors[0]
+        return results
+
+    return run
+
+
+#add_users(driver, count, balance) inserts count users, returns their ids
+@pytest.fixture
+def add_users():
+    def add(driver, count, balance):
+        ids = [
+            driver.insert_user_table("User %d" % i, "user%d" % i, "user%d@example.com" % i, "password", balance)
+            for i in range(count)
+        ]
+        driver.release()
+        return ids
+
+    return add
+
+
+#balance_of(driver, user_id) straight from the database, past the user cache
+@pytest.fixture
+def balance_of():
+    def balance(driver, user_id):
+        value = driver.conn.execute(
+            "SELECT %s FROM user WHERE ID = ?;" % driver.balance_column, (user_id,)
+        ).fetchone()[0]
+        driver.release()
+        return value
+
+    return balance
+
+
+#total_balance(driver) of every user, money moved between users never changes it
+@pytest.fixture
+def total_balance():
+    def total(driver):
+        value = driver.conn.execute("SELECT SUM(%s) FROM user;" % driver.balance_column).fetchone()[0]
+        driver.release()
+        return value
+
+    return total
+
+
+#run_in_app(name, function, **env) calls function(app, client) in a fresh interpreter that
+#imported name (app or app1) with env set, since the feature flags are read at import,
+#and in the test's directory, where the app creates its database. function is a top-level
+#function of a test module; returns what it returns, which must encode to JSON
+@pytest.fixture
+def run_in_app(tmp_path):
+    def run(name, function, **env):
+        script = (
+            "import importlib, json, sys\n"
+            "sys.path[:0] = [%r, %r]\n"
+            "app = importlib.import_module(%r)\n"
+            "function = getattr(importlib.import_module(%r), %r)\n"
+            "print(json.dumps(function(app, app.app.test_client())))\n"
+        ) % (ROOT, TESTS, name, function.__module__, function.__name__)
+        result = subprocess.run(
+            [sys.executable, "-c", script], cwd=str(tmp_path), env=dict(os.environ, BCRYPT_ROUNDS="4", **env),
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True, timeout=120
+        )
+        assert result.returncode == 0, result.stderr
+        return json.loads(result.stdout.splitlines()[-1])
+
+    return run
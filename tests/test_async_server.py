@@ -0,0 +1,150 @@
+import asyncio
+import socket
+import threading
+import time
+
+import pytest
+
+import async_server
+
+
+#WSGI app answering with the size of the request body
+def body_size(environ, start_response):
+    body = str(len(environ["wsgi.input"].read())).encode()
+    start_response("200 OK", [("Content-Type", "text/plain"), ("Content-Length", str(len(body)))])
+    return [body]
+
+
+#WSGI app answering with the name of the thread it runs on, in two chunks without a length
+def thread_name(environ, start_response):
+    start_response("200 OK", [("Content-Type", "text/plain")])
+    return [b"on ", threading.current_thread().name.encode()]
+
+
+#AsyncWSGIServer(app, **options) on a loop of its own, returns its port
+@pytest.fixture
+def start_server():
+    running = []
+
+    def start(app=body_size, **options):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.listen(16)
+        server = async_server.AsyncWSGIServer(app, sock=sock, read_workers=2, write_workers=2, **options)
+        loop = asyncio.new_event_loop()
+        started = threading.Event()
+
+        def run():
+            asyncio.set_event_loop(loop)
+            loop.run_until_complete(server.start())
+            started.set()
+            loop.run_forever()
+
+        thread = threading.Thread(target=run, daemon=True)
+        thread.start()
+        assert started.wait(5)
+        running.append((server, loop, thread))
+        return sock.getsockname()[1]
+
+    yield start
+    for server, loop, thread in running:
+        # graceful, so no worker thread is left waiting to hand the loop its last chunk
+        asyncio.run_coroutine_threadsafe(server.shutdown(5), loop).result(10)
+        loop.call_soon_threadsafe(loop.stop)
+        thread.join(5)
+        server.close()
+
+
+def connect(port):
+    return socket.create_connection(("127.0.0.1", port), timeout=5)
+
+
+def read_response(client):
+    data = b""
+    while True:
+        part = client.recv(65536)
+        if not part:
+            return data
+        data += part
+        head, _, body = data.partition(b"\r\n\r\n")
+        if b"Content-Length: " in head:
+            length = int(head.split(b"Content-Length: ")[1].split(b"\r\n")[0])
+            if len(body) >= length:
+                return data
+
+
+#one keep-alive connection: a chunked upload, then a request with a length
+def test_requests_share_a_connection(start_server):
+    port = start_server()
+    client = connect(port)
+    client.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nTransfer-Encoding: chunked\r\n\r\n3\r\nabc\r\n4\r\ndefg\r\n0\r\n\r\n")
+    response = read_response(client)
+    assert b"Connection: keep-alive" in response and response.endswith(b"\r\n\r\n7")
+    client.sendall(b"PUT / HTTP/1.1\r\nHost: x\r\nContent-Length: 2\r\n\r\nab")
+    assert read_response(client).endswith(b"\r\n\r\n2")
+    client.close()
+
+
+#GET runs on the read pool and everything else on the write pool; a body without a
+#length goes out chunked as the app produces it
+@pytest.mark.parametrize("method, pool", [(b"GET", b"read"), (b"POST", b"write")])
+def test_methods_run_on_their_pool(start_server, method, pool):
+    port = start_server(thread_name)
+    client = connect(port)
+    client.sendall(method + b" / HTTP/1.1\r\nHost: x\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+    response = read_response(client)
+    head, _, body = response.partition(b"\r\n\r\n")
+    assert b"Transfer-Encoding: chunked" in head
+    assert body.startswith(b"3\r\non \r\n") and body.endswith(b"\r\n0\r\n\r\n")
+    assert b"\r\n" + pool in body
+    client.close()
+
+
+#the keep-alive timeout only covers the wait for a request line: a body that keeps coming
+#for longer than it is read to the end
+def test_slow_upload_outlasts_the_keepalive_timeout(start_server):
+    port = start_server(keepalive_timeout=0.3, read_timeout=0.5)
+    client = connect(port)
+    client.sendall(b"POST / HTTP/1.1\r\nHost: x\r\nContent-Length: 10\r\n\r\n")
+    for _ in range(10):
+        time.sleep(0.1)
+        client.sendall(b"x")
+    response = read_response(client)
+    assert response.startswith(b"HTTP/1.1 200")
+    assert response.endswith(b"\r\n\r\n10")
+    client.close()
+
+
+#a request whose headers or body stop coming gets a 408
+@pytest.mark.parametrize("sent", [b"POST / HTTP/1.1\r\nHost: x\r\n", b"POST / HTTP/1.1\r\nContent-Length: 10\r\n\r\nxx"])
+def test_stalled_request_times_out(start_server, sent):
+    port = start_server(keepalive_timeout=5, read_timeout=0.3)
+    client = connect(port)
+    client.sendall(sent)
+    assert read_response(client).startswith(b"HTTP/1.1 408")
+    client.close()
+
+
+def test_idle_connection_is_closed_after_the_keepalive_timeout(start_server):
+    port = start_server(keepalive_timeout=0.3, read_timeout=5)
+    client = connect(port)
+    client.sendall(b"GET / HTTP/1.1\r\nHost: x\r\n\r\n")
+    assert read_response(client).endswith(b"\r\n\r\n0")
+    started = time.monotonic()
+    assert client.recv(1) == b""
+    assert time.monotonic() - started < 3
+    client.close()
+
+
+#ASYNC_SERVER=1 app.py: payments and user deletes are run by the group-commit writer
+def writes_through_the_writer(app, client):
+    for name in ("ann", "bob"):
+        user = {"name": name, "username": name, "email": name + "@example.com", "password": "pw", "balance": 100}
+        client.post("/api/users/", json=user)
+    client.post("/api/transactions/send/", json={"sender_id": 1, "receiver_id": 2, "amount": 30, "password": "pw"})
+    client.delete("/api/user/2/")
+    return [app.DB.writer is not None, app.DB.writer.stats()["operations"], client.get("/api/user/2/").status_code]
+
+
+def test_app_writes_go_through_the_writer(run_in_app):
+    assert run_in_app("app", writes_through_the_writer, ASYNC_SERVER="1") == [True, 2, 404]
@@ -0,0 +1,42 @@
+import pytest
+
+
+#payments and batch payments racing on one payer: the ones that go through add up to
+#at most its balance, it never goes below zero and no money appears or disappears
+@pytest.mark.parametrize("use_ledger", [False, True])
+@pytest.mark.parametrize("group_commit", [False, True])
+def test_concurrent_debits_never_overdraw(make_driver, add_users, balance_of, total_balance, run_threads,
+                                          group_commit, use_ledger):
+    driver = make_driver(group_commit=group_commit, use_ledger=use_ledger)
+    payer, *payees = add_users(driver, 5, 100)
+
+    def pay(i):
+        paid = 0
+        try:
+            for n in range(5):
+                payee = payees[(i + n) % len(payees)]
+                if n % 2:
+                    if driver.send_money_batch(payer, [(payee, 3), (payee, 4)]) is not False:
+                        paid += 7
+                elif driver.send_money_by_user_id(payer, payee, 7) is not False:
+                    paid += 7
+            return paid
+        finally:
+            driver.release()
+
+    paid = sum(run_threads(16, pay))
+    assert paid == 98
+    assert balance_of(driver, payer) == 100 - paid
+    assert total_balance(driver) == 500
+
+
+#a batch returns the ids SQLite gave its rows, None for receivers that do not exist
+def test_batch_returns_the_ids_of_its_rows(make_driver, add_users):
+    driver = make_driver()
+    payer, payee = add_users(driver, 2, 100)
+    first = driver.send_money_by_user_id(payer, payee, 1)
+    ids = driver.send_money_batch(payer, [(payee, 2), (999, 5), (payee, 3)])
+    assert ids[1] is None and first < ids[0] < ids[2]
+    rows = driver.conn.execute("SELECT ID, RECEIVER_ID, AMOUNT FROM transactions WHERE ID > ? ORDER BY ID;", (first,))
+    assert rows.fetchall() == [(ids[0], payee, 2), (ids[2], payee, 3)]
+    driver.release()
@@ -0,0 +1,111 @@
+import os
+import sqlite3
+import subprocess
+import sys
+
+import pytest
+
+import bulk
+
+
+def index_names(filename, table):
+    conn = sqlite3.connect(filename)
+    try:
+        return sorted(row[1] for row in conn.execute('PRAGMA index_list("%s");' % table))
+    finally:
+        conn.close()
+
+
+def transaction_rows(count, check=None):
+    for i in range(count):
+        if check is not None and i == count // 2:
+            check()
+        yield {"sender_id": 1, "receiver_id": 2, "amount": i, "accepted": "true"}
+
+
+#the deferred indexes are dropped and rebuilt inside the import's transaction: other
+#connections keep seeing them throughout, and a failed import leaves them (and the table) as they were
+def test_import_never_publishes_the_table_without_its_indexes(make_driver):
+    driver = make_driver()
+    driver.release()
+    indexes = index_names(driver.filename, "transactions")
+    assert indexes
+    seen = []
+    conn = bulk.connect(driver.filename)
+    try:
+        check = lambda: seen.append(index_names(driver.filename, "transactions"))
+        assert bulk.import_rows(conn, "transactions", transaction_rows(100, check), chunk_size=10) == 100
+        assert seen == [indexes]
+        assert index_names(driver.filename, "transactions") == indexes
+
+        def failing_rows():
+            yield from transaction_rows(50)
+            raise RuntimeError("killed")
+
+        with pytest.raises(RuntimeError):
+            bulk.import_rows(conn, "transactions", failing_rows(), chunk_size=10)
+        assert index_names(driver.filename, "transactions") == indexes
+        assert conn.execute("SELECT COUNT(*) FROM transactions;").fetchone()[0] == 100
+    finally:
+        conn.close()
+
+
+def test_intermediate_commits_keep_the_indexes(make_driver):
+    driver = make_driver()
+    driver.release()
+    conn = bulk.connect(driver.filename)
+    try:
+        with pytest.raises(ValueError):
+            bulk.import_rows(conn, "transactions", transaction_rows(10), transaction_rows=5, defer_indexes=True)
+        indexes = index_names(driver.filename, "transactions")
+        seen = []
+        check = lambda: seen.append(index_names(driver.filename, "transactions"))
+        assert bulk.import_rows(conn, "transactions", transaction_rows(100, check), chunk_size=10, transaction_rows=20) == 100
+        assert seen == [indexes]
+    finally:
+        conn.close()
+
+
+#only the boolean columns read "true"/"false", and "" is NULL only in nullable non-text
+#columns: text comes through exactly as it was written
+def test_csv_values_keep_their_text(make_driver):
+    driver = make_driver(cache_size=0)
+    driver.release()
+    users = [
+        "id,name,username,email,password,balance",
+        "1,true,,False,pw,",
+        "2,,False,b@example.com,pw,5",
+    ]
+    transactions = [
+        "id,sender_id,receiver_id,amount,accepted",
+        "1,1,2,,false",
+        "2,2,1,3,True",
+        "3,2,1,4,",
+    ]
+    assert driver.import_rows("user", users) == 2
+    assert driver.import_rows("transactions", transactions) == 3
+    conn = driver.conn
+    assert conn.execute("SELECT ID, NAME, USERNAME, EMAIL, BALANCE FROM user ORDER BY ID;").fetchall() == [
+        (1, "true", "", "False", None),
+        (2, "", "False", "b@example.com", 5),
+    ]
+    assert conn.execute("SELECT ID, AMOUNT, ACCEPTED FROM transactions ORDER BY ID;").fetchall() == [
+        (1, None, 0), (2, 3, 1), (3, 4, None),
+    ]
+    driver.release()
+
+
+#python bulk.py import rebuilds the rollups after a transaction import, as the HTTP route does
+def test_cli_transaction_import_rebuilds_rollups(make_driver, add_users, tmp_path):
+    driver = make_driver(use_rollups=True, cache_size=0)
+    sender, receiver = add_users(driver, 2, 100)
+    path = tmp_path / "transactions.csv"
+    path.write_text("sender_id,receiver_id,amount,accepted,requested\n%d,%d,30,true,false\n" % (sender, receiver))
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    subprocess.run(
+        [sys.executable, os.path.join(root, "bulk.py"), "import", driver.filename, "transactions", str(path)],
+        cwd=str(tmp_path), env=dict(os.environ, ROLLUPS="1"), check=True, capture_output=True
+    )
+    rows = driver.conn.execute("SELECT USER_ID, SENT, RECEIVED FROM rollup_users ORDER BY USER_ID;").fetchall()
+    driver.release()
+    assert rows == [(sender, 30, 0), (receiver, 0, 30)]
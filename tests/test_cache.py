@@ -0,0 +1,49 @@
+import threading
+
+import pytest
+
+import cache
+
+
+#a read that started before a write must not store what it read after the write's invalidation
+def test_fill_begun_before_an_invalidation_is_dropped():
+    users = cache.LRUCache(10, 30)
+    token = users.begin_fill(1)
+    users.invalidate(1)
+    assert users.fill(1, "stale", token) is False
+    assert users.get(1) is None
+    assert users.fill(1, "fresh", users.begin_fill(1)) is True
+    assert users.get(1) == "fresh"
+
+
+#reader threads keep filling the cached user while payments invalidate it: right after
+#each payment commits, the cached balance is the committed one
+@pytest.mark.parametrize("group_commit", [False, True])
+def test_cache_fills_racing_payments_never_serve_a_stale_balance(make_driver, add_users, run_threads,
+                                                                 group_commit):
+    driver = make_driver(group_commit=group_commit, cache_size=100)
+    a, b = add_users(driver, 2, 1000)
+    stop = threading.Event()
+
+    def read(i):
+        reads = 0
+        while not stop.is_set():
+            try:
+                driver.get_user(a, ["balance"])
+            finally:
+                driver.release()
+            reads += 1
+        return reads
+
+    readers = threading.Thread(target=lambda: run_threads(4, read))
+    readers.start()
+    try:
+        for n in range(1, 201):
+            assert driver.send_money_by_user_id(a, b, 1) is not False
+            assert driver.get_user(a, ["balance"])["balance"] == 1000 - n
+            driver.release()
+    finally:
+        stop.set()
+        readers.join(30)
+    assert not readers.is_alive()
+    assert driver.user_cache.stats()["hits"] > 0
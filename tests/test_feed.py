@@ -0,0 +1,83 @@
+import json
+
+import pytest
+
+
+def feed_of(driver, user_id, limit=100, before=None):
+    return [(item["id"], item["amount"], item["message"]) for item in driver.get_feed(user_id, limit, before)]
+
+
+#payments reach both parties and the followers of either, from the follow on and until
+#the unfollow; first pages come from the cache, which every commit invalidates
+@pytest.mark.parametrize("cache_size", [0, 100])
+def test_payments_fan_out_to_parties_and_followers(make_driver, add_users, cache_size):
+    driver = make_driver(use_feed=True, cache_size=cache_size)
+    ann, bob, cat, dan = add_users(driver, 4, 100)
+    driver.follow(cat, ann)
+    assert feed_of(driver, cat) == []
+    first = driver.send_money_by_user_id(ann, bob, 1, "lunch")
+    for user_id in (ann, bob, cat):
+        assert feed_of(driver, user_id) == [(first, 1, "lunch")]
+    assert feed_of(driver, dan) == []
+    driver.unfollow(cat, ann)
+    second = driver.send_money_by_user_id(bob, ann, 2, "back")
+    assert feed_of(driver, ann) == [(second, 2, "back"), (first, 1, "lunch")]
+    assert feed_of(driver, cat) == [(first, 1, "lunch")]
+    assert feed_of(driver, ann, 1, second) == [(first, 1, "lunch")]
+    driver.release()
+
+
+#requests show up once accepted, batches like single payments
+def test_accepts_and_batches_fan_out(make_driver, add_users):
+    driver = make_driver(use_feed=True)
+    ann, bob = add_users(driver, 2, 100)
+    request = driver.request_money_by_user_id(ann, bob, 5)
+    assert feed_of(driver, ann) == []
+    driver.accept_transaction(request)
+    batch = driver.send_money_batch(ann, [(bob, 1), (bob, 2)])
+    assert feed_of(driver, bob) == [(batch[1], 2, None), (batch[0], 1, None), (request, 5, None)]
+    driver.release()
+
+
+#a feed keeps its newest capacity items, and a deleted user takes their feed and follows along
+def test_feed_is_bounded_and_forgotten(make_driver, add_users):
+    driver = make_driver(use_feed=True)
+    driver.feed.capacity = 3
+    ann, bob, cat = add_users(driver, 3, 100)
+    driver.follow(cat, ann)
+    ids = [driver.send_money_by_user_id(ann, bob, n) for n in range(1, 6)]
+    assert [item[0] for item in feed_of(driver, bob)] == ids[:1:-1]
+    assert driver.conn.execute("SELECT COUNT(*) FROM feed WHERE USER_ID = ?;", (bob,)).fetchone()[0] == 3
+    driver.delete_user_by_id(cat)
+    assert driver.conn.execute("SELECT COUNT(*) FROM feed WHERE USER_ID = ?;", (cat,)).fetchone()[0] == 0
+    assert driver.conn.execute("SELECT COUNT(*) FROM follows;").fetchone()[0] == 0
+    driver.release()
+
+
+#both apps with FEED=1: follow, pay with a message, read the follower's feed
+def follow_and_pay(app, client):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    for name in ("ann", "bob", "cat"):
+        user = {"name": name, "username": name, "email": name + "@example.com", "password": "pw", "balance": 100}
+        client.post(create, json=user)
+    followed = client.post("/api/user/3/follow/", json={"user_id": 1})
+    for amount in (1, 2):
+        client.post("/api/transactions/send/",
+                    json={"sender_id": 1, "receiver_id": 2, "amount": amount, "message": "m%d" % amount, "password": "pw"})
+    return [
+        [followed.status_code, json.loads(followed.data)],
+        json.loads(client.get("/api/user/3/feed/?limit=1").data),
+        json.loads(client.get("/api/user/3/feed/?limit=1&before=2").data),
+        json.loads(client.delete("/api/user/3/follow/1/").data),
+    ]
+
+
+def test_apps_serve_the_same_feed(run_in_app):
+    result = run_in_app("app", follow_and_pay, FEED="1")
+    assert result == run_in_app("app1", follow_and_pay, FEED="1")
+    assert result[0] == [201, {"success": True, "data": {"follower_id": 3, "followed_id": 1}}]
+    assert result[1] == {"success": True, "next": 2, "data": [
+        {"id": 2, "sender_id": 1, "receiver_id": 2, "amount": 2, "message": "m2"}
+    ]}
+    assert [item["message"] for item in result[2]["data"]] == ["m1"]
+    assert result[3]["success"] is True
@@ -0,0 +1,35 @@
+import pytest
+
+
+#every request thread holds a pooled connection while it waits for its write, the writer
+#must not need one of them (it has its own)
+def test_writes_finish_while_every_pooled_connection_is_held(make_driver, add_users, run_threads):
+    driver = make_driver(pool_size=2, group_commit=True, cache_size=0)
+    a, b = add_users(driver, 2, 1000)
+
+    def pay(i):
+        try:
+            # a read first checks out a connection for the thread, as in a request
+            assert driver.get_user(a, ["id"]) is not None
+            return driver.send_money_by_user_id(a, b, 1)
+        finally:
+            driver.release()
+
+    results = run_threads(8, pay)
+    assert all(isinstance(transaction_id, int) for transaction_id in results)
+    assert driver.writer.stats()["operations"] == 8
+
+
+#an operation that raises fails only its own caller, the writer keeps serving
+def test_failing_operation_does_not_stop_the_writer(make_driver, add_users, balance_of):
+    driver = make_driver(group_commit=True, cache_size=0)
+    a, b = add_users(driver, 2, 100)
+
+    def broken(cur):
+        raise RuntimeError("broken operation")
+
+    with pytest.raises(RuntimeError):
+        driver.writer.submit(broken)
+    assert driver.writer.thread.is_alive()
+    assert isinstance(driver.send_money_by_user_id(a, b, 40), int)
+    assert balance_of(driver, a) == 60
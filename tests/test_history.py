@@ -0,0 +1,106 @@
+import itertools
+import json
+
+import pytest
+
+import history
+
+
+def test_parse_filters():
+    assert history.parse_filters({"direction": "sent", "accepted": "False", "min_amount": "3"}) == {
+        "direction": "sent", "accepted": False, "min_amount": 3
+    }
+    for bad in ({"direction": "up"}, {"accepted": "maybe"}, {"counterparty": "x"}):
+        with pytest.raises(ValueError):
+            history.parse_filters(bad)
+
+
+#a user's history from the driver, a page of limit rows at a time
+def walk(driver, user_id, limit, **filters):
+    rows = []
+    before = None
+    while True:
+        page = driver.get_history(user_id, limit, before, **filters)
+        rows.extend(entry.serialize() for entry in page)
+        if len(page) < limit:
+            return rows
+        before = page[-1]["id"]
+
+
+#what the history should be, worked out from the whole table
+def expected(driver, user_id, direction=None, accepted=None, counterparty=None, min_amount=None, max_amount=None):
+    rows = []
+    for t in driver.get_all_transactions():
+        t = t.serialize()
+        side = "sent" if t["sender_id"] == user_id else "received" if t["receiver_id"] == user_id else None
+        other = t["receiver_id"] if side == "sent" else t["sender_id"]
+        if side is None or direction not in (None, side) or accepted not in (None, bool(t["accepted"])):
+            continue
+        if counterparty not in (None, other):
+            continue
+        if (min_amount is not None and t["amount"] < min_amount) or (max_amount is not None and t["amount"] > max_amount):
+            continue
+        rows.append(dict(t, accepted=bool(t["accepted"]), direction=side))
+    return sorted(rows, key=lambda row: -row["id"])
+
+
+@pytest.fixture
+def driver(make_driver, add_users):
+    driver = make_driver()
+    ann, bob, cat = add_users(driver, 3, 1000)
+    for n in range(12):
+        other = bob if n % 2 else cat
+        if n % 3 == 0:
+            driver.send_money_by_user_id(other, ann, n + 1)
+        elif n % 3 == 1:
+            driver.request_money_by_user_id(ann, other, n + 1)
+        else:
+            driver.send_money_by_user_id(ann, other, n + 1)
+    driver.send_money_by_user_id(ann, ann, 1)
+    driver.send_money_by_user_id(bob, cat, 1)
+    yield driver
+    driver.release()
+
+
+#every filter combination, paged in twos and threes, matches the table
+def test_pages_match_the_table(driver):
+    combinations = itertools.product([None, "sent", "received"], [None, True, False], [None, 2], [None, 4])
+    for direction, accepted, counterparty, min_amount in combinations:
+        filters = {"direction": direction, "accepted": accepted, "counterparty": counterparty,
+                   "min_amount": min_amount, "max_amount": 10 if min_amount else None}
+        filters = {name: value for name, value in filters.items() if value is not None}
+        for limit in (2, 3):
+            assert walk(driver, 1, limit, **filters) == expected(driver, 1, **filters), (filters, limit)
+
+
+#each side is a range read on an index, never a scan of the table
+def test_history_reads_indexes_only(driver):
+    for filters in ({}, {"accepted": False}, {"counterparty": 2}, {"direction": "received", "min_amount": 3}):
+        sql, params = history.history_query(1, 10, **filters)
+        plan = [row[-1] for row in driver.conn.execute("EXPLAIN QUERY PLAN " + sql, params)]
+        assert not [step for step in plan if step.startswith("SCAN transactions")], plan
+
+
+#both apps answer with the same pages
+def history_pages(app, client):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    for name in ("ann", "bob"):
+        user = {"name": name, "username": name, "email": name + "@example.com", "password": "pw", "balance": 100}
+        client.post(create, json=user)
+    for amount in (1, 2, 3):
+        client.post("/api/transactions/send/", json={"sender_id": 1, "receiver_id": 2, "amount": amount, "password": "pw"})
+    client.post("/api/transactions/request/", json={"sender_id": 2, "receiver_id": 1, "amount": 4, "password": "pw"})
+    return [
+        json.loads(client.get("/api/user/1/history/?limit=2").data),
+        json.loads(client.get("/api/user/1/history/?limit=2&before=3").data),
+        json.loads(client.get("/api/user/1/history/?direction=received").data),
+        json.loads(client.get("/api/user/1/history/?accepted=nope").data),
+    ]
+
+
+def test_apps_page_the_same_history(run_in_app):
+    pages = run_in_app("app", history_pages)
+    assert pages == run_in_app("app1", history_pages)
+    assert [[entry["id"] for entry in page["data"]] for page in pages[:3]] == [[4, 3], [2, 1], [4]]
+    assert pages[0]["next"] == 3 and pages[1]["next"] == 1
+    assert pages[3] == {"success": False, "error": "accepted must be true or false"}
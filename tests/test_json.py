@@ -0,0 +1,53 @@
+import json
+
+import flask
+import pytest
+
+import db
+import responses
+
+
+#names json.dumps escapes: quotes, backslashes, control characters, DEL, non-ASCII
+#inside and outside the BMP
+NAMES = ['Zoë "q"', "back\\slash/", "tab\tnew\nline\x01\x1f\x7f", "₪ \U0001f4b8", ""]
+
+
+#SQL_JSON=1 payloads are the bytes json.dumps writes for the records
+@pytest.mark.parametrize("use_ledger", [False, True])
+def test_sql_rendered_json_matches_json_dumps(make_driver, use_ledger):
+    driver = make_driver(use_ledger=use_ledger, cache_size=0)
+    ids = [driver.insert_user_table(name, name, "e@example.com", "pw", 100) for name in NAMES]
+    driver.send_money_by_user_id(ids[0], ids[1], 5)
+    driver.request_money_by_user_id(ids[0], ids[3], 7)
+    driver.release()
+
+    pairs = [
+        (driver.get_all_users(), driver.get_all_users_json()),
+        (driver.get_users_page(2, ids[1]), driver.get_users_page_json(2, ids[1])),
+        (driver.get_all_transactions(), driver.get_all_transactions_json()),
+        (driver.get_transactions_page(10, 0), driver.get_transactions_page_json(10, 0)),
+        (driver.get_transactions_of_user(ids[0]), driver.get_transactions_of_user_json(ids[0])),
+        (driver.get_transactions_of_user(ids[4]), driver.get_transactions_of_user_json(ids[4])),
+        (driver.get_user_by_id(ids[0]), driver.get_user_json(ids[0])),
+        (driver.get_user_by_id(ids[3]), driver.get_user_json(ids[3])),
+    ]
+    driver.release()
+    for records, rendered in pairs:
+        assert isinstance(rendered, db.RawJSON)
+        assert rendered == json.dumps(records, default=db.serialize_record)
+
+
+#the envelopes spliced around pre-encoded data are the bytes of json.dumps of the whole response
+def test_envelopes_match_json_dumps():
+    data = [{"id": 1, "name": NAMES[0]}, {"id": 2, "name": NAMES[3]}]
+    assert responses.success_response(data)[0] == json.dumps({"success": True, "data": data})
+    assert responses.success_response(db.RawJSON(json.dumps(data)))[0] == json.dumps({"success": True, "data": data})
+    assert responses.page_response(data, 2)[0] == json.dumps({"success": True, "data": data, "next": 2})
+    assert responses.failure_response(NAMES[0])[0] == json.dumps({"success": False, "error": NAMES[0]})
+
+
+def test_streamed_envelope_matches_json_dumps():
+    data = [{"id": i, "name": NAMES[i % len(NAMES)]} for i in range(7)]
+    with flask.Flask("responses").test_request_context():
+        response = responses.stream_response(iter(data), chunk_size=3)
+        assert "".join(response.response) == json.dumps({"success": True, "data": data})
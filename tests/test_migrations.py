@@ -0,0 +1,68 @@
+import sqlite3
+
+import pytest
+
+import migrations
+
+
+@pytest.fixture
+def conn(tmp_path):
+    conn = sqlite3.connect(str(tmp_path / "todo.db"))
+    yield conn
+    conn.close()
+
+
+def index_names(conn):
+    return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index' AND sql IS NOT NULL;")}
+
+
+@pytest.mark.parametrize("steps", [migrations.DRIVER_MIGRATIONS, migrations.AUTH_MIGRATIONS])
+def test_versions_count_up_from_one(steps):
+    assert [version for version, _, _ in steps] == list(range(1, len(steps) + 1))
+
+
+#a new file gets every migration once, running again changes nothing
+def test_fresh_database_reaches_the_latest_version(conn):
+    latest = migrations.latest_version(migrations.DRIVER_MIGRATIONS)
+    assert migrations.needs_migration(conn)
+    assert migrations.migrate(conn) == list(range(1, latest + 1))
+    assert migrations.get_version(conn) == latest
+    indexes = index_names(conn)
+    assert migrations.migrate(conn) == []
+    assert not migrations.needs_migration(conn)
+    assert index_names(conn) == indexes
+    assert "ix_transactions_sender_id_id" in indexes
+
+
+#the tables the app used to create by hand, with rows in them, upgrade in place
+def test_hand_made_tables_upgrade_with_their_rows(conn):
+    conn.executescript("""
+        CREATE TABLE user (ID INTEGER PRIMARY KEY, NAME TEXT NOT NULL, USERNAME CHAR(50),
+                           EMAIL TEXT NOT NULL, PASSWORD TEXT NOT NULL, BALANCE INTEGER);
+        CREATE TABLE transactions (ID INTEGER PRIMARY KEY, SENDER_ID INTEGER SECONDARY KEY NOT NULL,
+                                   RECEIVER_ID INTEGER SECONDARY KEY NOT NULL, AMOUNT INTEGER, ACCEPTED BOOL);
+        INSERT INTO user VALUES (1, 'A', 'a', 'a@example.com', 'pw', 10), (2, 'B', 'b', 'b@example.com', 'pw', 0);
+        INSERT INTO transactions VALUES (1, 1, 2, 5, 1);
+    """)
+    migrations.migrate(conn)
+    assert migrations.get_version(conn) == migrations.latest_version(migrations.DRIVER_MIGRATIONS)
+    assert conn.execute("SELECT ID, BALANCE FROM user ORDER BY ID;").fetchall() == [(1, 10), (2, 0)]
+    assert conn.execute("SELECT SENDER_ID, RECEIVER_ID, AMOUNT FROM transactions;").fetchall() == [(1, 2, 5)]
+
+
+#a failing migration leaves the version and schema of the last one that worked
+def test_failed_migration_rolls_back(conn):
+    steps = [
+        (1, "one", ["CREATE TABLE one (ID INTEGER PRIMARY KEY);"]),
+        (2, "two", ["CREATE TABLE two (ID INTEGER PRIMARY KEY);", "CREATE TABLE one (ID INTEGER);"]),
+    ]
+    with pytest.raises(sqlite3.OperationalError):
+        migrations.migrate(conn, steps)
+    assert migrations.get_version(conn) == 1
+    assert conn.execute("SELECT name FROM sqlite_master WHERE name = 'two';").fetchone() is None
+
+
+def test_newer_database_is_refused(conn):
+    migrations.set_version(conn, migrations.latest_version(migrations.DRIVER_MIGRATIONS) + 1)
+    with pytest.raises(Exception, match="newer than this code supports"):
+        migrations.migrate(conn)
@@ -0,0 +1,58 @@
+import json
+
+import pytest
+
+
+def create_users(app, client, count):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    for i in range(count):
+        user = {"name": "User %d" % i, "username": "user%d" % i, "email": "user%d@example.com" % i,
+                "password": "pw", "balance": 100}
+        assert client.post(create, json=user).status_code in (200, 201)
+
+
+#the routes answer JSON text without a JSON mimetype
+def get_json(client, url):
+    return json.loads(client.get(url).data)
+
+
+#the ids of every ?limit=2 page, following next as ?after=, of the streamed list and of the
+#whole list, and what a page past the end looks like
+def walk_users(app, client):
+    create_users(app, client, 5)
+    pages = []
+    after = 0
+    while after is not None:
+        body = get_json(client, "/api/users/?limit=2&after=%d" % after)
+        pages.append([user["id"] for user in body["data"]])
+        after = body["next"]
+    streamed = get_json(client, "/api/users/?stream=true&after=1")
+    everything = get_json(client, "/api/users/")
+    return {
+        "pages": pages,
+        "streamed": [user["id"] for user in streamed["data"]],
+        "all": [user["id"] for user in everything["data"]],
+        "past_the_end": get_json(client, "/api/users/?after=5"),
+    }
+
+
+@pytest.mark.parametrize("name, env", [("app", {}), ("app", {"SQL_JSON": "1"}), ("app1", {})])
+def test_keyset_pages_and_stream_cover_the_list(run_in_app, name, env):
+    result = run_in_app(name, walk_users, **env)
+    assert result["pages"] == [[1, 2], [3, 4], [5]]
+    assert result["streamed"] == [2, 3, 4, 5]
+    assert result["all"] == [1, 2, 3, 4, 5]
+    assert result["past_the_end"] == {"success": True, "data": [], "next": None}
+
+
+#the driver's pages and streams, with chunks smaller than the result
+def test_driver_pages_and_streams(make_driver, add_users):
+    driver = make_driver()
+    payer, payee = add_users(driver, 2, 100)
+    ids = [driver.send_money_by_user_id(payer, payee, 1) for _ in range(5)]
+    assert [t["id"] for t in driver.get_transactions_page(2, ids[1])] == ids[2:4]
+    assert [t["id"] for t in driver.iter_transactions(ids[0], chunk_size=2)] == ids[1:]
+    assert [u["id"] for u in driver.iter_users(chunk_size=1)] == [payer, payee]
+    page = driver.get_transactions_page_json(2, ids[2])
+    assert (page.count, page.last_id) == (2, ids[4])
+    driver.release()
@@ -0,0 +1,37 @@
+import json
+
+import db
+
+
+def test_record_reads_like_a_dict():
+    user = db.User((1, "Ann", "ann", "ann@example.com", "pw", 10))
+    assert user["balance"] == 10 and user.get("missing", 0) == 0
+    assert "email" in user and "transactions" not in user
+    assert user.serialize() == {"id": 1, "name": "Ann", "username": "ann", "email": "ann@example.com",
+                                "password": "pw", "balance": 10}
+
+
+#extra values are added after the columns, and replace a column they name
+def test_extra_values_extend_and_replace_columns():
+    user = db.User((1, "Ann", "ann", "ann@example.com", "pw", 10), {"balance": 7, "transactions": []})
+    assert user["balance"] == 7 and user["transactions"] == []
+    assert list(user.serialize()) == ["id", "name", "username", "email", "password", "balance", "transactions"]
+
+
+def test_record_types_are_shared_per_layout():
+    assert db.record_type("User", ["id", "balance"]) is db.record_type("User", ("id", "balance"))
+    assert db.record_type("User", ["id", "balance"]) is not db.record_type("User", ["balance", "id"])
+
+
+#records from a query encode to what the dicts they replaced did
+def test_query_records_encode_like_dicts(make_driver, add_users):
+    driver = make_driver()
+    payer, payee = add_users(driver, 2, 100)
+    driver.send_money_by_user_id(payer, payee, 5)
+    transactions = driver.get_all_transactions()
+    assert isinstance(transactions[0], db.Transaction)
+    assert json.loads(db.encode_json(transactions)) == [
+        {"id": transactions[0]["id"], "sender_id": payer, "receiver_id": payee, "amount": 5, "accepted": 1}
+    ]
+    assert db.encode_json(driver.get_all_users()) == json.dumps([u.serialize() for u in driver.get_all_users()])
+    driver.release()
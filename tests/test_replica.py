@@ -0,0 +1,53 @@
+import os
+
+import pytest
+
+import replica
+
+
+#READ_REPLICA with automatic refreshes out of the way, so the test decides when the copy is
+#made, and without app.py's user cache, which holds the row create_user read back from the primary
+REPLICA_ENV = {"READ_REPLICA": "1", "READ_REPLICA_SECONDS": "3600", "READ_REPLICA_COMMITS": "1000000", "CACHE_SIZE": "0"}
+USER = {"name": "Zoë", "username": "zoe", "email": "zoe@example.com", "password": "pw", "balance": 100}
+
+
+def the_replica(app):
+    if app.__name__ == "app":
+        return app.DB.replica
+    import db1
+    return db1.REPLICA
+
+
+#a user created after the last copy: the read routes miss it on the replica, see it when
+#they ask to read their own writes or once the replica is refreshed; writes always go to the primary
+def read_after_write(app, client):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    statuses = [client.post(create, json=USER).status_code]
+    statuses.append(client.get("/api/user/1/").status_code)
+    statuses.append(client.get("/api/user/1/", headers={replica.READ_YOUR_WRITES_HEADER: "1"}).status_code)
+    statuses.append(client.get("/api/user/1/?read_your_writes=true").status_code)
+    the_replica(app).refresh()
+    statuses.append(client.get("/api/user/1/").status_code)
+    return statuses
+
+
+@pytest.mark.parametrize("name", ["app", "app1"])
+def test_reads_go_to_the_replica_unless_they_read_their_writes(run_in_app, tmp_path, name):
+    assert run_in_app(name, read_after_write, **REPLICA_ENV) == [201 if name == "app" else 200, 404, 200, 200, 200]
+    # the primary is in the directory the app was started in, the replica is gone on exit
+    database = "todo.db" if name == "app" else "auth.db"
+    assert os.path.exists(str(tmp_path / database))
+    assert not [f for f in os.listdir(str(tmp_path)) if ".replica-" in f]
+
+
+#past READ_REPLICA_MAX_STALENESS a read goes to the primary even without asking
+def stale_read(app, client):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    client.post(create, json=USER)
+    the_replica(app).snapshot_at -= 10
+    return client.get("/api/user/1/").status_code
+
+
+@pytest.mark.parametrize("name", ["app", "app1"])
+def test_stale_replica_is_not_read(run_in_app, name):
+    assert run_in_app(name, stale_read, READ_REPLICA_MAX_STALENESS="5", **REPLICA_ENV) == 200
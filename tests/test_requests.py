@@ -0,0 +1,82 @@
+import json
+
+import pytest
+
+import responses
+
+
+def test_parse_request_ids():
+    assert responses.parse_request_ids({"accept": [1, "2"], "deny": [3]}) == ([1, 2], [3])
+    assert responses.parse_request_ids({"deny": [3]}) == ([], [3])
+    assert responses.parse_request_ids({"accept": 1}) == "accept must be a list of transaction ids"
+    assert responses.parse_request_ids({"deny": ["x"]}) == "deny must be a list of transaction ids"
+    assert responses.parse_request_ids({}) == "Did not supply any transaction ids"
+    assert responses.parse_request_ids({"accept": [1], "deny": [1]}) == "Cannot both accept and deny a transaction"
+    too_many = list(range(responses.MAX_BATCH_SIZE + 1))
+    assert responses.parse_request_ids({"accept": too_many}).startswith("Too many transaction ids")
+
+
+def test_answered_response_lists_skipped_ids():
+    body, code = responses.answered_response([1, 2, 5], [3], ([1, 2], [3]))
+    assert json.loads(body) == {"success": True, "data": {"accepted": [1, 2], "denied": [3], "skipped": [5]}}
+    body, code = responses.answered_response([1], [], False)
+    assert code == 404 and json.loads(body)["error"] == "Insufficient funds to accept the requests"
+
+
+#ann answers bob's and cat's requests at once: accepted ones are paid, denied ones deleted,
+#anything else (someone else's request, a payment, one already answered) is skipped
+@pytest.mark.parametrize("use_ledger", [False, True])
+def test_answer_requests(make_driver, add_users, balance_of, total_balance, use_ledger):
+    driver = make_driver(use_ledger=use_ledger)
+    ann, bob, cat = add_users(driver, 3, 100)
+    first = driver.request_money_by_user_id(bob, ann, 10)
+    second = driver.request_money_by_user_id(cat, ann, 20)
+    third = driver.request_money_by_user_id(bob, ann, 30)
+    other = driver.request_money_by_user_id(ann, bob, 5)
+    payment = driver.send_money_by_user_id(bob, ann, 1)
+    assert [r["id"] for r in driver.get_pending_requests(ann, 10)] == [third, second, first]
+    assert driver.answer_requests(ann, [first, second, other, payment], [third]) == ([first, second], [third])
+    assert (balance_of(driver, ann), balance_of(driver, bob), balance_of(driver, cat)) == (71, 109, 120)
+    assert driver.get_pending_requests(ann, 10) == []
+    assert driver.get_transaction_by_id(third) is None
+    assert driver.answer_requests(ann, [first], []) == ([], [])
+    assert total_balance(driver) == 300
+    driver.release()
+
+
+#when the accepted total is more than the balance nothing is applied, denials included
+def test_unaffordable_answer_changes_nothing(make_driver, add_users, balance_of):
+    driver = make_driver()
+    ann, bob = add_users(driver, 2, 100)
+    small = driver.request_money_by_user_id(bob, ann, 60)
+    large = driver.request_money_by_user_id(bob, ann, 60)
+    denied = driver.request_money_by_user_id(bob, ann, 1)
+    assert driver.answer_requests(ann, [small, large], [denied]) is False
+    assert balance_of(driver, ann) == 100
+    assert [r["id"] for r in driver.get_pending_requests(ann, 10)] == [denied, large, small]
+    driver.release()
+
+
+#both apps answer the same
+def answer_over_http(app, client):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    for name in ("ann", "bob"):
+        user = {"name": name, "username": name, "email": name + "@example.com", "password": "pw", "balance": 100}
+        client.post(create, json=user)
+    for amount in (10, 20, 30):
+        client.post("/api/transactions/request/", json={"sender_id": 2, "receiver_id": 1, "amount": amount, "password": "pw"})
+    return [
+        json.loads(client.get("/api/user/1/requests/?limit=2").data),
+        json.loads(client.post("/api/user/1/requests/", json={"password": "nope", "accept": [1]}).data),
+        json.loads(client.post("/api/user/1/requests/", json={"password": "pw", "accept": [1, 2, 9], "deny": [3]}).data),
+        json.loads(client.get("/api/user/1/?fields=balance").data),
+    ]
+
+
+def test_apps_answer_the_same(run_in_app):
+    result = run_in_app("app", answer_over_http)
+    assert result == run_in_app("app1", answer_over_http)
+    assert [r["id"] for r in result[0]["data"]] == [3, 2] and result[0]["next"] == 2
+    assert result[1] == {"success": False, "error": "Incorrect password"}
+    assert result[2]["data"] == {"accepted": [1, 2], "denied": [3], "skipped": [9]}
+    assert result[3]["data"] == {"balance": 70}
@@ -0,0 +1,63 @@
+import glob
+import os
+import signal
+import socket
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+#wait up to timeout seconds for condition() to return something true, and return it
+def wait_for(condition, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = condition()
+        if result:
+            return result
+        time.sleep(0.1)
+    raise AssertionError("timed out")
+
+
+def answers(port):
+    try:
+        with socket.create_connection(("127.0.0.1", port), timeout=5) as client:
+            client.sendall(b"GET /api/users/?limit=1 HTTP/1.1\r\nHost: x\r\nConnection: close\r\n\r\n")
+            return client.recv(12) == b"HTTP/1.1 200"
+    except OSError:
+        return False
+
+
+#a worker killed with SIGKILL cannot remove its replica file, the master does when it
+#reaps it, and the replacement worker gets a file of its own
+def test_master_removes_a_killed_workers_replica(tmp_path):
+    env = dict(os.environ, READ_REPLICA="1", CACHE_SIZE="0")
+    port = free_port()
+    master = subprocess.Popen(
+        [sys.executable, os.path.join(ROOT, "serve.py"), "app", "--host", "127.0.0.1",
+         "--port", str(port), "--workers", "1", "--threads", "4"],
+        cwd=str(tmp_path), env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    # todo.db.replica-<pid>, without its -journal, -wal and -shm files
+    replicas = lambda: [p for p in glob.glob(str(tmp_path / "todo.db.replica-*")) if p.rsplit("-", 1)[1].isdigit()]
+    try:
+        # the worker has reported its replica once it answers requests
+        wait_for(lambda: answers(port))
+        first, = replicas()
+        os.kill(int(first.rsplit("-", 1)[1]), signal.SIGKILL)
+        second, = wait_for(lambda: [p for p in replicas() if p != first])
+        wait_for(lambda: not glob.glob(first + "*"))
+        assert os.path.exists(second)
+    finally:
+        master.send_signal(signal.SIGTERM)
+        master.wait(30)
+    assert not glob.glob(str(tmp_path / "todo.db.replica-*"))
@@ -0,0 +1,71 @@
+import sqlite3
+
+import pytest
+
+import migrations
+import tokens
+
+
+#SessionTokens(["key"], auth.db) factory, every instance stands for another serve.py worker
+@pytest.fixture
+def make_tokens(tmp_path):
+    filename = str(tmp_path / "auth.db")
+    conn = sqlite3.connect(filename)
+    for version, description, statements in migrations.AUTH_MIGRATIONS:
+        if "revoked session tokens" in description:
+            for statement in statements:
+                conn.execute(statement)
+    conn.commit()
+    conn.close()
+    instances = []
+
+    def make(**options):
+        instances.append(tokens.SessionTokens(["test-key"], filename, **options))
+        return instances[-1]
+
+    yield make
+    for instance in instances:
+        instance.close()
+
+
+def test_update_token_is_used_once(make_tokens):
+    session_tokens = make_tokens()
+    update_token = session_tokens.issue(42, "update")
+    assert session_tokens.verify(update_token, "update") == 42
+    assert session_tokens.consume(update_token) == 42
+    assert session_tokens.consume(update_token) is None
+    assert session_tokens.verify(update_token, "update") is None
+
+
+def test_replay_on_another_worker_is_rejected(make_tokens):
+    first, second = make_tokens(), make_tokens()
+    update_token = first.issue(42, "update")
+    assert first.consume(update_token) == 42
+    assert second.consume(update_token) is None
+
+
+def test_concurrent_replays_renew_once(make_tokens, run_threads):
+    workers = [make_tokens(), make_tokens()]
+    update_token = workers[0].issue(42, "update")
+    results = run_threads(16, lambda i: workers[i % 2].consume(update_token))
+    assert results.count(42) == 1
+    assert results.count(None) == 15
+
+
+def test_session_token_is_not_an_update_token(make_tokens):
+    session_tokens = make_tokens()
+    assert session_tokens.consume(session_tokens.issue(42, "session")) is None
+
+
+#verify reads revocations from memory: another worker's revocation shows up at the next
+#refresh, not on every verify
+def test_revocation_reaches_other_workers_at_refresh(make_tokens):
+    first, second = make_tokens(), make_tokens(refresh_seconds=3600)
+    session_token = first.issue(42, "session")
+    assert second.verify(session_token) == 42
+    assert first.revoke(session_token)
+    assert first.verify(session_token) is None
+    assert second.verify(session_token) == 42
+    second.refresh_revocations()
+    assert second.verify(session_token) is None
+    assert make_tokens().verify(session_token) is None
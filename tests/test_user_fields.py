@@ -0,0 +1,47 @@
+import json
+
+import pytest
+
+
+#a paid user asked for some fields, for an unknown one, and for transactions
+def fetch_fields(app, client):
+    create = "/api/users/" if app.__name__ == "app" else "/register/"
+    for name in ("ann", "bob"):
+        user = {"name": name, "username": name, "email": name + "@example.com", "password": "pw", "balance": 100}
+        client.post(create, json=user)
+    client.post("/api/transactions/send/", json={"sender_id": 1, "receiver_id": 2, "amount": 30, "password": "pw"})
+    results = {}
+    for query in ("fields=balance,id", "fields=id&include=transactions", "fields=password", "fields="):
+        response = client.get("/api/user/1/?" + query)
+        results[query] = [response.status_code, json.loads(response.data)]
+    return results
+
+
+@pytest.mark.parametrize("name", ["app", "app1"])
+def test_get_user_returns_the_requested_fields(run_in_app, name):
+    results = run_in_app(name, fetch_fields)
+    assert results["fields=balance,id"] == [200, {"success": True, "data": {"id": 1, "balance": 70}}]
+    status, body = results["fields=id&include=transactions"]
+    assert set(body["data"]) == {"id", "transactions"}
+    assert [(t["receiver_id"], t["amount"]) for t in body["data"]["transactions"]] == [(2, 30)]
+    # passwords are a column of todo.db's user table, but not something auth.db gives out
+    if name == "app1":
+        assert results["fields=password"][0] == 404
+    assert results["fields="][1]["data"]["username"] == "ann"
+
+
+#the projection is the same with and without the user cache and the ledger
+@pytest.mark.parametrize("cache_size", [0, 100])
+@pytest.mark.parametrize("use_ledger", [False, True])
+def test_driver_projects_fields(make_driver, add_users, cache_size, use_ledger):
+    driver = make_driver(cache_size=cache_size, use_ledger=use_ledger)
+    payer, payee = add_users(driver, 2, 100)
+    driver.get_user(payer)
+    driver.send_money_by_user_id(payer, payee, 30)
+    user = driver.get_user(payer, ["balance", "id"])
+    assert user.serialize() == {"id": payer, "balance": 70}
+    assert driver.get_user(payer, ["nonsense"]).serialize() == {"id": payer}
+    assert [t["amount"] for t in driver.get_user(payer, ["id"], include_transactions=True)["transactions"]] == [30]
+    assert driver.get_user(payer).serialize()["username"] == "user0"
+    assert driver.get_user(999, ["id"]) is None
+    driver.release()
@@ -0,0 +1,160 @@
+import atexit
+import os
+import sqlite3
+import threading
+import time
+
+import connection_pool
+
+from itsdangerous import BadSignature
+from itsdangerous import SignatureExpired
+from itsdangerous import URLSafeTimedSerializer
+
+
+SESSION_LIFETIME = int(os.environ.get("SESSION_LIFETIME", 24 * 60 * 60))
+UPDATE_LIFETIME = int(os.environ.get("UPDATE_LIFETIME", 30 * 24 * 60 * 60))
+#seconds a revocation made by another process can take to be seen
+REVOCATION_REFRESH_SECONDS = float(os.environ.get("REVOCATION_REFRESH_SECONDS", 1))
+#seconds between dropping expired revocations from memory
+PRUNE_SECONDS = 60
+
+
+#comma separated, newest first: the first key signs, all of them verify
+def secret_keys_from_env():
+    keys = [k for k in os.environ.get("SESSION_SECRET_KEYS", "").split(",") if k]
+    if not keys:
+        # tokens then only survive as long as this process
+        keys = [os.urandom(32).hex()]
+    return keys
+
+
+class SessionTokens(object):
+    """
+    Self-contained session/update tokens signed with HMAC (itsdangerous).
+    Verifying one is pure CPU: the signature, the token kind and its age are checked, the
+    user id is read from the payload and the token id is looked up in an in-memory set of
+    revocations. Revocations are written to the revoked_tokens table of the database file,
+    so every process serving the app sees them: each instance reads the ones it has not
+    seen yet at most every refresh_seconds, and only when PRAGMA data_version says the file
+    changed. They are dropped once the token would have expired anyway.
+    """
+
+    LIFETIMES = {"session": SESSION_LIFETIME, "update": UPDATE_LIFETIME}
+
+    def __init__(self, secret_keys, filename, max_keys=3, refresh_seconds=REVOCATION_REFRESH_SECONDS):
+        self.filename = filename
+        self.max_keys = max_keys
+        self.refresh_seconds = refresh_seconds
+        self.lock = threading.Lock()
+        self.secret_keys = []
+        for key in reversed(secret_keys):
+            self.rotate(key)
+        #revoked token id -> time it expires, read up to revoked_tokens.ID last_revocation_id
+        self.revoked = {}
+        self.last_revocation_id = 0
+        self.data_version = None
+        self.checked_at = 0
+        self.pruned_at = time.monotonic()
+        #one connection in autocommit mode, so each statement is its own transaction;
+        #db_lock serializes the threads using it
+        self.db_lock = threading.Lock()
+        self.conn = sqlite3.connect(filename, isolation_level=None, check_same_thread=False)
+        for name, value in connection_pool.DEFAULT_PRAGMAS:
+            self.conn.execute("PRAGMA %s = %s;" % (name, value))
+        self.refresh_revocations()
+        atexit.register(self.close)
+
+    def _serializers(self, kind):
+        return [URLSafeTimedSerializer(key, salt="kessef-%s-token" % kind) for key in self.secret_keys]
+
+    #sign with new_key from now on, tokens signed with the previous max_keys - 1 keys stay valid
+    def rotate(self, new_key):
+        with self.lock:
+            self.secret_keys = ([new_key] + self.secret_keys)[:self.max_keys]
+            self.signers = {kind: self._serializers(kind) for kind in self.LIFETIMES}
+
+    def issue(self, user_id, kind="session"):
+        payload = {"u": user_id, "j": os.urandom(8).hex()}
+        return self.signers[kind][0].dumps(payload)
+
+    def expiration(self, kind="session"):
+        return time.time() + self.LIFETIMES[kind]
+
+    #the payload of a validly signed token, unexpired if max_age is given, otherwise None
+    def _load(self, token, kind, max_age=None):
+        for signer in self.signers[kind]:
+            try:
+                return signer.loads(token, max_age=max_age)
+            except SignatureExpired:
+                return None
+            except BadSignature:
+                continue
+        return None
+
+    #the user id in a valid, unexpired and unrevoked token, otherwise None
+    def verify(self, token, kind="session"):
+        payload = self._load(token, kind, self.LIFETIMES[kind])
+        if payload is None:
+            return None
+        if time.monotonic() - self.checked_at >= self.refresh_seconds:
+            self.refresh_revocations(wait=False)
+        if payload.get("j") in self.revoked:
+            return None
+        return payload.get("u")
+
+    def revoke(self, token, kind="session"):
+        payload = self._load(token, kind)
+        if payload is None:
+            return False
+        self._revoke(payload.get("j"), kind)
+        return True
+
+    #verify and revoke in one step: the user id for the one call (in any process) that
+    #revokes a valid token, None for every other, so an update token is used only once
+    def consume(self, token, kind="update"):
+        payload = self._load(token, kind, self.LIFETIMES[kind])
+        if payload is None or not self._revoke(payload.get("j"), kind):
+            return None
+        return payload.get("u")
+
+    #True if this call revoked jti, False if it already was. The check and the insert are
+    #one statement on a unique column, so they are atomic across threads and processes
+    def _revoke(self, jti, kind):
+        now = time.time()
+        expires = now + self.LIFETIMES[kind]
+        with self.db_lock:
+            cursor = self.conn.execute(
+                "INSERT OR IGNORE INTO revoked_tokens (JTI, EXPIRES) VALUES (?, ?);", (jti, expires)
+            )
+            revoked = cursor.rowcount == 1
+            self.conn.execute("DELETE FROM revoked_tokens WHERE EXPIRES <= ?;", (now,))
+            self.revoked[jti] = expires
+        return revoked
+
+    #read the revocations other instances (or processes) added since the last call, if the
+    #file changed at all; with wait=False it returns at once when another thread holds db_lock
+    def refresh_revocations(self, wait=True):
+        if not self.db_lock.acquire(wait):
+            return
+        try:
+            self.checked_at = time.monotonic()
+            if self.checked_at - self.pruned_at >= PRUNE_SECONDS:
+                self.pruned_at = self.checked_at
+                now = time.time()
+                self.revoked = {jti: expires for jti, expires in self.revoked.items() if expires > now}
+            data_version = self.conn.execute("PRAGMA data_version;").fetchone()[0]
+            if data_version == self.data_version:
+                return
+            self.data_version = data_version
+            cursor = self.conn.execute(
+                "SELECT ID, JTI, EXPIRES FROM revoked_tokens WHERE ID > ? ORDER BY ID;", (self.last_revocation_id,)
+            )
+            for revocation_id, jti, expires in cursor:
+                self.revoked[jti] = expires
+                self.last_revocation_id = revocation_id
+        finally:
+            self.db_lock.release()
+
+    def close(self):
+        with self.db_lock:
+            self.conn.close()
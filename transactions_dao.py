@@ -1,61 +1,278 @@
+from sqlalchemy import bindparam
+from sqlalchemy import text
+
+import feed
+import history
+import ledger
+import rollups
+
 from db1 import db
 from db1 import User, Transactions
+from db1 import FEED
+from db1 import LEDGER
+from db1 import ROLLUPS
+from db1 import begin_write
+from db1 import reading_replica
+from db1 import session_cursor
 
 
-#handeling a transaction - sending money    
-def send_money_by_user_id(self, sender_id, receiver_id, amount, message):
-    transaction_function = "send"
-    accepted_sender = self.__update_sender(sender_id, amount, transaction_function)
-    if accepted_sender == False:
-        return None
-    self.__update_receiver(receiver_id, amount, transaction_function)
-    new_transaction = Transactions(sender_id=sender_id, receiver_id=receiver_id, amount=amount, accepted=True, message=message)
+#the same exception for the column and the ledger balances
+InsufficientFunds = ledger.InsufficientFunds
+
+
+#handeling a transaction - sending money
+def send_money_by_user_id(sender_id, receiver_id, amount, message):
+    if LEDGER is not None:
+        new_transaction = Transactions(sender_id=sender_id, receiver_id=receiver_id, amount=amount, accepted=True, message=message)
+        db.session.add(new_transaction)
+        db.session.flush()
+        try:
+            LEDGER.transfer(session_cursor(), new_transaction.id, sender_id, receiver_id, amount)
+        except InsufficientFunds:
+            db.session.rollback()
+            return None
+    else:
+        try:
+            _transfer(sender_id, receiver_id, amount)
+        except InsufficientFunds:
+            db.session.rollback()
+            return None
+        new_transaction = Transactions(sender_id=sender_id, receiver_id=receiver_id, amount=amount, accepted=True, message=message)
+        db.session.add(new_transaction)
+        db.session.flush()
+    _roll_up(added=[(sender_id, receiver_id, amount, False, True, new_transaction.created_at)])
+    _commit_with_feed([(new_transaction.id, sender_id, receiver_id, amount, message)])
+    return new_transaction.id
+
+#pay many receivers from one sender with one debit, grouped credits and executemany
+#inserts, committed once. transfers is a list of (receiver_id, amount, message); returns
+#a serialized transaction per transfer (None where the receiver does not exist), or None
+#if the sender cannot cover the total
+def send_money_batch(sender_id, transfers, chunk_size=500):
+    receiver_ids = list(set(t[0] for t in transfers))
+    existing = set()
+    for start in range(0, len(receiver_ids), chunk_size):
+        chunk = receiver_ids[start:start + chunk_size]
+        existing.update(row[0] for row in db.session.query(User.id).filter(User.id.in_(chunk)))
+    valid = [(i, t) for i, t in enumerate(transfers) if t[0] in existing]
+    results = [None] * len(transfers)
+    if not valid:
+        return results
+
+    if LEDGER is not None:
+        begin_write()
+    else:
+        try:
+            _debit(sender_id, sum(t[1] for _, t in valid))
+        except InsufficientFunds:
+            db.session.rollback()
+            return None
+        credits = {}
+        for _, (receiver_id, amount, _message) in valid:
+            credits[receiver_id] = credits.get(receiver_id, 0) + amount
+        user_table = User.__table__
+        db.session.execute(
+            user_table.update()
+            .where(user_table.c.id == bindparam("credit_id"))
+            .values(balance=user_table.c.balance + bindparam("credit")),
+            [{"credit_id": receiver_id, "credit": amount} for receiver_id, amount in credits.items()]
+        )
+    #ids are assigned here rather than read back one by one, which is safe because
+    #the debit (or begin_write) above already holds SQLite's write lock until commit
+    next_id = (db.session.query(db.func.max(Transactions.id)).scalar() or 0) + 1
+    created_at = rollups.now()
+    rows = []
+    for n, (i, (receiver_id, amount, message)) in enumerate(valid):
+        rows.append({
+            "id": next_id + n,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "amount": amount,
+            "accepted": True,
+            "message": message,
+            "created_at": created_at
+        })
+        results[i] = {
+            "id": next_id + n,
+            "sender_id": sender_id,
+            "receiver_id": receiver_id,
+            "amount": amount,
+            "accepted": True
+        }
+    db.session.execute(Transactions.__table__.insert(), rows)
+    if LEDGER is not None:
+        try:
+            LEDGER.transfer_many(
+                session_cursor(), sender_id, [(r["receiver_id"], r["amount"], r["id"]) for r in rows]
+            )
+        except InsufficientFunds:
+            db.session.rollback()
+            return None
+    _roll_up(added=[(sender_id, r["receiver_id"], r["amount"], False, True, created_at) for r in rows])
+    _commit_with_feed([(r["id"], sender_id, r["receiver_id"], r["amount"], r["message"]) for r in rows])
+    return results
+
+#a page of sent and received transactions as dicts, newest first (see history.py)
+def get_history(user_id, limit, before=None, **filters):
+    sql, params = history.history_query(user_id, limit, before, **filters)
+    rows = db.session.execute(text(sql), params)
+    return [history.serialize(row) for row in rows]
+
+#requests waiting for user_id to pay them, newest first
+def get_pending_requests(user_id, limit, before=None):
+    return get_history(user_id, limit, before, direction="received", accepted=False)
+
+#accept and deny many of user_id's pending requests in one transaction, like
+#DatabaseDriver.answer_requests; returns the (accepted, denied) ids, or None if the
+#user cannot cover the accepted total
+def answer_requests(user_id, accept_ids, deny_ids, chunk_size=500):
+    #read the requests under the write lock, so a concurrent accept cannot pay them twice
+    begin_write()
+    ids = list(set(accept_ids) | set(deny_ids))
+    pending = {}
+    for start in range(0, len(ids), chunk_size):
+        chunk = ids[start:start + chunk_size]
+        rows = db.session.query(
+            Transactions.id, Transactions.sender_id, Transactions.amount, Transactions.message, Transactions.created_at
+        ).filter(Transactions.receiver_id == user_id, Transactions.accepted == False, Transactions.id.in_(chunk))
+        pending.update((row[0], row[1:]) for row in rows)
+    accepted = [t for t in dict.fromkeys(accept_ids) if t in pending]
+    denied = [t for t in dict.fromkeys(deny_ids) if t in pending]
+    transactions_table = Transactions.__table__
+    if accepted:
+        try:
+            if LEDGER is not None:
+                LEDGER.transfer_many(session_cursor(), user_id, [(pending[t][0], pending[t][1], t) for t in accepted])
+            else:
+                _debit(user_id, sum(pending[t][1] for t in accepted))
+                credits = {}
+                for t in accepted:
+                    sender_id, amount, _message, _created_at = pending[t]
+                    credits[sender_id] = credits.get(sender_id, 0) + amount
+                user_table = User.__table__
+                db.session.execute(
+                    user_table.update()
+                    .where(user_table.c.id == bindparam("credit_id"))
+                    .values(balance=user_table.c.balance + bindparam("credit")),
+                    [{"credit_id": sender_id, "credit": amount} for sender_id, amount in credits.items()]
+                )
+        except InsufficientFunds:
+            db.session.rollback()
+            return None
+        db.session.execute(
+            transactions_table.update().where(transactions_table.c.id == bindparam("transaction_id")).values(accepted=True, requested=True),
+            [{"transaction_id": t} for t in accepted]
+        )
+    if denied:
+        db.session.execute(
+            transactions_table.delete().where(transactions_table.c.id == bindparam("transaction_id")),
+            [{"transaction_id": t} for t in denied]
+        )
+    _roll_up(
+        added=[(pending[t][0], user_id, pending[t][1], True, True, pending[t][3]) for t in accepted],
+        removed=[(pending[t][0], user_id, pending[t][1], True, False, pending[t][3]) for t in accepted + denied]
+    )
+    _commit_with_feed([(t, pending[t][0], user_id, pending[t][1], pending[t][2]) for t in accepted])
+    return accepted, denied
+
+#dict of user_id's totals from start to end (dates) per day or month, see rollups.py
+def get_statement(user_id, start, end, period="day"):
+    return ROLLUPS.statement(session_cursor(), user_id, start, end, period)
+
+#a page of the user's feed as dicts, newest first (see feed.py)
+def get_feed(user_id, limit, before=None):
+    rows = FEED.page(session_cursor(), user_id, limit, before, fill=not reading_replica())
+    return [dict(zip(feed.FEED_FIELDS, row)) for row in rows]
+
+def follow(follower_id, followed_id):
+    FEED.follow(session_cursor(), follower_id, followed_id)
+    db.session.commit()
+
+def unfollow(follower_id, followed_id):
+    FEED.unfollow(session_cursor(), follower_id, followed_id)
+    db.session.commit()
+
+#handeling a transaction - requesting money
+def request_money_by_user_id(sender_id, receiver_id, amount, message):
+    new_transaction = Transactions(
+        sender_id=sender_id, receiver_id=receiver_id, amount=amount, accepted=False, requested=True, message=message
+    )
     db.session.add(new_transaction)
+    _roll_up(added=[(sender_id, receiver_id, amount, True, False, new_transaction.created_at)])
     db.session.commit()
     return new_transaction.id
 
-#handeling a transaction - requesting money   
-def request_money_by_user_id(self, sender_id, receiver_id, amount, message):
-    new_transaction = Transactions(sender_id=sender_id, receiver_id=receiver_id, amount=amount, accepted=False, message=message)
-    return new_transaction.id
+#deny a request (or remove any transaction), its rollup counts go with it
+def delete_transaction(transactions):
+    _roll_up(removed=[_rollup_row(transactions)])
+    db.session.delete(transactions)
+    db.session.commit()
 
-def accept_transaction(self, transaction_id):
+#the receiver of a request pays its sender, accepting twice is a no-op
+def accept_transaction(transaction_id):
+    #read the accepted flag under the write lock, so two accepts cannot both pay
+    begin_write()
     transactions = Transactions.query.filter_by(id=transaction_id).first()
-    sender_id = transactions.sender_id
-    receiver_id = transactions.receiver_id
-    amount = transactions.amount
-    accepted_receiver = self.__update_receiver(receiver_id, amount, "request")
-    if accepted_receiver == False:
+    if transactions is None:
+        db.session.rollback()
+        return None
+    if transactions.accepted:
+        db.session.rollback()
+        return transactions.id
+    try:
+        if LEDGER is not None:
+            LEDGER.transfer(
+                session_cursor(), transactions.id, transactions.receiver_id, transactions.sender_id, transactions.amount
+            )
+        else:
+            _transfer(transactions.receiver_id, transactions.sender_id, transactions.amount)
+    except InsufficientFunds:
+        db.session.rollback()
         return None
-    self.__update_sender(sender_id, amount, "request")
+    _roll_up(removed=[_rollup_row(transactions)])
     transactions.accepted = True
-    db.session.commit()
-    return transactions.id      
+    transactions.requested = True
+    _roll_up(added=[_rollup_row(transactions)])
+    _commit_with_feed([(
+        transactions.id, transactions.sender_id, transactions.receiver_id, transactions.amount, transactions.message
+    )])
+    return transactions.id
 
 
 #helper transaction methods
-def __update_sender(self, sender_id, amount, transaction_function):
-    sender = User.query.filter_by(id=sender_id).first()
-    balance = sender.balance
-    if transaction_function == "send":
-        new_balance = balance - amount
-        if new_balance < 0:
-            return False
-    elif transaction_function == "request":
-        new_balance = balance + amount
-    sender.balance = new_balance
-    db.session.commit()
-    return True
-
-def __update_receiver(self, receiver_id, amount, transaction_function):
-    receiver = User.query.filter_by(id=receiver_id).first()
-    balance = receiver.balance
-    if transaction_function == "send":
-        new_balance = balance + amount
-    elif transaction_function == "request":
-        new_balance = balance - amount
-        if new_balance < 0:
-            return False
-    receiver.balance = new_balance
+#rollup rows in the caller's transaction, committed with it
+def _roll_up(added=(), removed=()):
+    if ROLLUPS is not None:
+        ROLLUPS.apply(session_cursor(), added, removed)
+
+def _rollup_row(transactions):
+    return (
+        transactions.sender_id, transactions.receiver_id, transactions.amount,
+        transactions.requested, transactions.accepted, transactions.created_at
+    )
+
+#fan the accepted transactions out with the rest of the transaction, then drop the cached
+#feeds once it has committed
+def _commit_with_feed(items):
+    if FEED is None:
+        db.session.commit()
+        return
+    users = FEED.fan_out(session_cursor(), items)
     db.session.commit()
-    return True
\ No newline at end of file
+    FEED.invalidate(users)
+
+#conditional debit then credit, the caller commits both together with the ledger row.
+#The debit UPDATE is the first write of the transaction, so SQLite takes the write
+#lock there and no balance is read before it.
+def _transfer(debit_id, credit_id, amount):
+    _debit(debit_id, amount)
+    User.query.filter(User.id == credit_id).update(
+        {User.balance: User.balance + amount}, synchronize_session=False
+    )
+
+def _debit(user_id, amount):
+    debited = User.query.filter(User.id == user_id, User.balance >= amount).update(
+        {User.balance: User.balance - amount}, synchronize_session=False
+    )
+    if debited != 1:
+        raise InsufficientFunds(user_id)
@@ -1,10 +1,28 @@
+import ledger
+import passwords
+
 from db1 import db
 from db1 import User
+from db1 import LEDGER
+from db1 import session_cursor
+
+USER_FIELDS = ["id", "name", "username", "email", "balance"]
 
 def get_user_by_id(id):
     return User.query.filter_by(id=id).first()
 
 
+#serialized user with only the requested columns, selected without loading the whole row
+def get_user_fields(id, fields):
+    columns = [getattr(User, f) for f in fields]
+    if LEDGER is not None and "balance" in fields:
+        columns[fields.index("balance")] = db.literal_column(ledger.balance_sql("user.id")).label("balance")
+    row = db.session.query(*columns).select_from(User).filter(User.id == id).first()
+    if row is None:
+        return None
+    return dict(zip(fields, row))
+
+
 def get_user_by_username(username):
     return User.query.filter(User.username == username).first()
 
@@ -22,7 +40,14 @@ def verify_credentials(username, password):
     if optional_user is None:
         return False, None
 
-    return optional_user.verify_password(password), optional_user
+    if not optional_user.verify_password(password):
+        return False, optional_user
+
+    # while we have the plain password, move digests made with another work factor to the current one
+    if passwords.needs_rehash(optional_user.password_digest):
+        optional_user.password_digest = passwords.hash_password(password)
+        db.session.commit()
+    return True, optional_user
 
 
 
@@ -31,8 +56,12 @@ def create_user(name, username, email, password, balance):
     if optional_user is not None:
         return False, optional_user
     
-    user = User(name=name, username=username, email=email, password=password, balance=balance)
+    password_digest = passwords.hash_password(password)
+    user = User(name=name, username=username, email=email, password_digest=password_digest, balance=balance)
     db.session.add(user)
+    if LEDGER is not None:
+        db.session.flush()
+        LEDGER.open_account(session_cursor(), user.id, balance)
     db.session.commit()
 
     return True, user